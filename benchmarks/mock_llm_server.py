@@ -0,0 +1,140 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "git init\nls # for context"
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, which would otherwise wait for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        settings = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        request_number = settings.count_request()
+        time.sleep(settings.latency)
+
+        if settings.fail_every and request_number % settings.fail_every == 0:
+            self.send_json(settings.error_status, {"error": {"message": "injected failure", "type": "server_error"}},
+                           {"Retry-After": settings.retry_after})
+            return
+        if body.get("stream"):
+            self.send_stream(settings.reply, settings.chunk_delay)
+            return
+        choices = [
+            {"index": index, "message": {"role": "assistant", "content": settings.reply}, "finish_reason": "stop"}
+            for index in range(body.get("n", 1))
+        ]
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{request_number}",
+            "object": "chat.completion",
+            "model": body.get("model", "mock"),
+            "choices": choices,
+            "usage": {"prompt_tokens": len(json.dumps(body.get("messages", []))) // 4, "completion_tokens": 5},
+        })
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, reply, chunk_delay):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_chunk(data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        # a few characters per event, like the tokens of a real response
+        for start in range(0, len(reply), 4):
+            event = {"choices": [{"index": 0, "delta": {"content": reply[start:start + 4]}}]}
+            write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+            time.sleep(chunk_delay)
+        write_chunk(b"data: [DONE]\n\n")
+        write_chunk(b"")
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    A local stand-in for an OpenAI-compatible chat completions API, for the benchmarks and the tests.
+    Every response has the same content, after a configurable latency, and every n-th request can fail.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0., chunk_delay=0., fail_every=0, error_status=503, reply=DEFAULT_REPLY,
+                 retry_after="0"):
+        """
+        :param port: 0 picks a free one
+        :param latency: seconds before the response starts
+        :param chunk_delay: seconds between the events of a streamed response
+        :param fail_every: every n-th request fails with error_status, 0 disables the failures
+        :param error_status:
+        :param reply: the content of every response
+        :param retry_after: the Retry-After header of the failures, seconds or an HTTP date
+        """
+        super().__init__(("127.0.0.1", port), MockLLMHandler)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.fail_every = fail_every
+        self.error_status = error_status
+        self.reply = reply
+        self.retry_after = retry_after
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+            return self.requests
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock chat completions API, "
+                                                 "point CHAT_COMMAND_API_URL at it to try chat without a real LLM.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0., help="Seconds before every response")
+    parser.add_argument("--chunk_delay", type=float, default=0.01, help="Seconds between the streamed events")
+    parser.add_argument("--fail_every", type=int, default=0, help="Every n-th request fails")
+    parser.add_argument("--error_status", type=int, default=503)
+    parser.add_argument("--retry_after", default="0", help="The Retry-After header of the failures")
+    parser.add_argument("--reply", default=DEFAULT_REPLY, help="The content of every response")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.port, args.latency, args.chunk_delay, args.fail_every, args.error_status,
+                           args.reply.replace("\\n", "\n"), args.retry_after)
+    print(f"🤖 Serving {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
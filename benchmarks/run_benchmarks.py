@@ -0,0 +1,296 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mock_llm_server import MockLLMServer  # noqa: E402
+
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+REQUEST_TYPES = ("fix_command", "suggest_from_text", "additional_instructions", "received_context")
+HISTORY_LENGTHS = (0, 20, 200)
+OUTPUT_SIZES = (200, 1024 * 1024)
+# a regression is only reported above both the relative tolerance and this much, to ignore the noise of tiny phases
+MIN_REGRESSION_MS = 2.
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def make_output(size):
+    lines = []
+    total = 0
+    number = 0
+    while total < size:
+        line = f"step {number}: compiling module_{number % 97}.c" if number % 50 else f"error: build failed ({number})"
+        lines.append(line)
+        total += len(line) + 1
+        number += 1
+    return "\n".join(lines)
+
+
+def make_history(length):
+    messages = []
+    for index in range(length):
+        if index % 2 == 0:
+            messages.append({"role": "user", "content": f"Please fix this shell command:\nmake target_{index}\n"
+                                                        f"This command's current output:\n{'x' * 150}\nend of output."})
+        else:
+            messages.append({"role": "assistant", "content": f"make clean && make target_{index - 1}"})
+    return messages
+
+
+class Benchmark:
+    """
+    Measures every phase of a request against a local mock API, in this process through ChatCommand,
+    and end to end through chat_wrapper.sh.
+    """
+    def __init__(self, runs, server, chat_command_path):
+        self.runs = runs
+        self.server = server
+        self.path = chat_command_path
+        self.results = {}
+
+    def environment(self, **extra):
+        env = dict(
+            os.environ,
+            CHAT_COMMAND_PATH=self.path,
+            OPENAI_API_KEY="benchmark",
+            CHAT_COMMAND_API_URL=self.server.url,
+            # every request has to reach the mock server
+            CHAT_COMMAND_CACHE="0",
+            CHAT_COMMAND_RULES="0",
+            CHAT_COMMAND_LEARN="0",
+            CHAT_COMMAND_RETRIES="2",
+            CHAT_COMMAND_CAPTURE="0",
+            CHAT_COMMAND_PYTHON=sys.executable,
+        )
+        for name in ("CHAT_COMMAND_LAST_COMMAND", "CHAT_COMMAND_LAST_OUTPUT", "CHAT_COMMAND_LAST_OUTPUT_FILE",
+                     "CHAT_COMMAND_CONV_ID", "CHAT_COMMAND_STREAM"):
+            env.pop(name, None)
+        env.update(extra)
+        return env
+
+    def record(self, scenario, phase, seconds):
+        self.results.setdefault(f"{scenario}:{phase}", []).append(seconds * 1000)
+
+    def report(self):
+        """
+        :return: {"scenario:phase": {"p50": ms, "p95": ms}}
+        """
+        return {
+            name: {"p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3)}
+            for name, values in self.results.items()
+        }
+
+    def measure_startup(self):
+        env = self.environment()
+        for _ in range(self.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "import chat_command"], cwd=REPO_DIR, env=env, check=True)
+            self.record("startup", "import", time.perf_counter() - start)
+
+    def measure_phases(self, request_type, history_length, output_size, stream=False, scenario=None):
+        if scenario is None:
+            scenario = f"{request_type}/history={history_length}/output={output_size}" + ("/stream" if stream else "")
+        conv_id = 1000 + history_length
+        output = make_output(output_size)
+        output_file = os.path.join(self.path, "benchmark_output.txt")
+        with open(output_file, "w") as file:
+            file.write(output)
+
+        extra = {"CHAT_COMMAND_CONV_ID": str(conv_id), "CHAT_COMMAND_STREAM": "1" if stream else "0"}
+        if request_type == "received_context":
+            extra.update(CHAT_COMMAND_LAST_COMMAND="ls", CHAT_COMMAND_LAST_OUTPUT_FILE=output_file)
+
+        with patched_environment(self.environment(**extra)), contextlib.redirect_stdout(io.StringIO()):
+            # chat_command sets up the logging into CHAT_COMMAND_PATH when it is imported
+            import history_store
+            from chat_command import ChatCommand
+
+            store = history_store.ConversationStore(os.path.join(self.path, "chat_history"))
+            if not os.path.exists(store.path(conv_id)):
+                store.append(conv_id, make_history(history_length))
+
+            for _ in range(self.runs):
+                # the history is read from the file every time, as in a new process
+                history_store.clear_cache()
+                start = time.perf_counter()
+                chat = ChatCommand("make build", "", cache_mode="bypass", last_status=2)
+                loaded = time.perf_counter()
+
+                if request_type == "fix_command":
+                    chat.last_output = chat.truncate_output(output)
+                    prompt = chat.make_prompt_fix_command()
+                elif request_type == "suggest_from_text":
+                    prompt = chat.make_prompt_suggest_from_text("build the project")
+                elif request_type == "additional_instructions":
+                    chat.messages.append({"role": "assistant", "content": "make build"})
+                    prompt = chat.make_prompt_additional_instructions("use cmake instead")
+                else:
+                    prompt = chat.make_prompt_received_context()
+                chat.append_user_message(prompt)
+                data = {"messages": chat.fit_context()}
+                built = time.perf_counter()
+
+                if stream:
+                    # the suggestions are parsed while the response streams in
+                    chat.stream_suggestions(data)
+                    received = parsed = time.perf_counter()
+                else:
+                    response = chat.get_api_response(data)
+                    received = time.perf_counter()
+                    chat.extract_suggestions(response)
+                    parsed = time.perf_counter()
+
+                self.record(scenario, "history_load", loaded - start)
+                self.record(scenario, "prompt_build", built - loaded)
+                self.record(scenario, "request", received - built)
+                if not stream:
+                    self.record(scenario, "parse", parsed - received)
+
+    def measure_wrapper(self, request_type):
+        """
+        Runs `chat` from chat_wrapper.sh in a non-interactive bash, answering its questions through stdin.
+        """
+        output_file = os.path.join(self.path, "benchmark_output.txt")
+        with open(output_file, "w") as file:
+            file.write(make_output(OUTPUT_SIZES[0]))
+        # (preparation, the measured call)
+        steps = {
+            # the last command is rerun by the wrapper
+            "fix_command": ("ls /nonexistent_benchmark_directory", "chat <<< n"),
+            "suggest_from_text": (":", "chat 'build the project' <<< n"),
+            "additional_instructions": (":", "chat 'build the project' <<< $'use cmake instead\\nn'"),
+            # what the wrapper runs after a context command
+            "received_context": (f"export CHAT_COMMAND_LAST_COMMAND=ls CHAT_COMMAND_LAST_OUTPUT_FILE={output_file}",
+                                 "chat -n --with_context <<< n"),
+        }
+        preparation, call = steps[request_type]
+        script = "\n".join([
+            f"source {os.path.join(REPO_DIR, 'chat_wrapper.sh')}",
+            "set -o history",
+            preparation,
+            "start=$EPOCHREALTIME",
+            call,
+            'echo "benchmark_elapsed $start $EPOCHREALTIME" >&2',
+        ])
+        for _ in range(self.runs):
+            result = subprocess.run(
+                ["bash", "--norc", "--noprofile", "-c", script], env=self.environment(), cwd=self.path,
+                capture_output=True, text=True,
+            )
+            for line in result.stderr.splitlines():
+                if line.startswith("benchmark_elapsed "):
+                    _, start, end = line.split()
+                    self.record(f"wrapper/{request_type}", "total", float(end) - float(start))
+                    break
+            else:
+                raise RuntimeError(f"The wrapper did not finish: {result.stderr[-500:]}")
+
+
+@contextlib.contextmanager
+def patched_environment(env):
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def install(chat_command_path):
+    # the same files that setup.py installs
+    for path in glob.glob(os.path.join(REPO_DIR, "*.py")) + [os.path.join(REPO_DIR, "chat_wrapper.sh")]:
+        shutil.copy2(path, chat_command_path)
+    os.makedirs(os.path.join(chat_command_path, "chat_history"), exist_ok=True)
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: list of the descriptions of the regressions
+    """
+    regressions = []
+    for name, measured in sorted(report.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        limit = max(expected["p50"] * (1 + tolerance), expected["p50"] + MIN_REGRESSION_MS)
+        if measured["p50"] > limit:
+            regressions.append(f"{name}: p50 {measured['p50']:.1f} ms, baseline {expected['p50']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark `chat` against a local mock LLM server.")
+    parser.add_argument("--runs", type=int, default=20, help="Measurements of every scenario")
+    parser.add_argument("--latency", type=float, default=0., help="Seconds the mock server takes to respond")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="Where the baseline is kept")
+    parser.add_argument("--save_baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="How much slower (0.5 = 50%%) than the baseline a phase may be")
+    parser.add_argument("--skip_wrapper", action="store_true", help="Do not benchmark through chat_wrapper.sh")
+    args = parser.parse_args()
+
+    server = MockLLMServer(latency=args.latency).start()
+    flaky_server = MockLLMServer(latency=args.latency, fail_every=2).start()
+    with tempfile.TemporaryDirectory() as chat_command_path:
+        install(chat_command_path)
+        benchmark = Benchmark(args.runs, server, chat_command_path)
+        benchmark.measure_startup()
+        for request_type in REQUEST_TYPES:
+            for history_length in HISTORY_LENGTHS:
+                for output_size in OUTPUT_SIZES:
+                    benchmark.measure_phases(request_type, history_length, output_size)
+        benchmark.measure_phases("fix_command", HISTORY_LENGTHS[1], OUTPUT_SIZES[0], stream=True)
+        if not args.skip_wrapper:
+            for request_type in REQUEST_TYPES:
+                benchmark.measure_wrapper(request_type)
+
+        # every other request fails and is retried
+        benchmark.server = flaky_server
+        benchmark.measure_phases("fix_command", HISTORY_LENGTHS[1], OUTPUT_SIZES[0], scenario="errors/fix_command")
+    server.stop()
+    flaky_server.stop()
+
+    report = benchmark.report()
+    width = max(len(name) for name in report)
+    print(f"{'scenario:phase':<{width}}  {'p50 ms':>9}  {'p95 ms':>9}")
+    for name, measured in sorted(report.items()):
+        print(f"{name:<{width}}  {measured['p50']:>9.2f}  {measured['p95']:>9.2f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+        print(f"💾 Saved the baseline to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        # a regression check that silently passes without a baseline would not check anything
+        print(f"❌ No baseline at {args.baseline}, run with --save_baseline on this machine to store one.")
+        sys.exit(1)
+    with open(args.baseline) as file:
+        regressions = compare(report, json.load(file), args.tolerance)
+    if regressions:
+        print("❌ Slower than the baseline:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        sys.exit(1)
+    print("✅ No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
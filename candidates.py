@@ -0,0 +1,57 @@
+import shlex
+
+from context_gathering import strip_context_marker
+
+MAX_SUGGESTIONS = 5
+
+
+def equivalence_key(suggestion):
+    """
+    :param suggestion:
+    :return: key that is the same for the commands that differ only in whitespace, quoting, a trailing semicolon,
+    the context marker, or the order of their flags (`ls -l -a` and `ls -a -l`)
+    """
+    command = strip_context_marker(suggestion).rstrip(";").strip()
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    words = []
+    flags = set()
+    for i, token in enumerate(tokens):
+        following = tokens[i + 1] if i + 1 < len(tokens) else "-"
+        # a flag may take the next word as its value (`tar -f x`, `grep -e x`), then it keeps its place,
+        # and bundled flags stay as they are, `-fx` is not `-xf` nor `-f x`
+        if token.startswith("-") and len(token) > 1 and ("=" in token or following.startswith("-")):
+            flags.add(token)
+        else:
+            words.append(token)
+    return tuple(words), frozenset(flags)
+
+
+def rank_candidates(completions, excluded=(), limit=MAX_SUGGESTIONS):
+    """
+    Pools the suggestions of several completions of the same request.
+    The equivalent suggestions are merged, and they are ranked by how many completions suggested them,
+    weighted by how early in the completion they came. The first completion wins the ties.
+    :param completions: list of lists of cleaned suggestions, one for every completion
+    :param excluded: commands that should not be suggested, such as the one that has to be fixed
+    :param limit: the maximum number of suggestions
+    :return: list of the best suggestions, the best first
+    """
+    excluded_keys = {equivalence_key(command) for command in excluded if command}
+    scores = {}
+    representatives = {}
+    for suggestions in completions:
+        for position, suggestion in enumerate(suggestions):
+            key = equivalence_key(suggestion)
+            if not key[0] or key in excluded_keys:
+                continue
+            # dicts keep the insertion order, which breaks the ties
+            representatives.setdefault(key, suggestion)
+            scores[key] = scores.get(key, 0.) + 1 / (1 + position)
+    ranked = sorted(scores, key=lambda key: -scores[key])
+    if not ranked:
+        # better to show the excluded ones than nothing at all
+        return completions[0][:limit] if completions else []
+    return [representatives[key] for key in ranked[:limit]]
@@ -0,0 +1,5 @@
+# Entry point used by the shell. It is kept minimal, as Python only caches the bytecode of imported modules.
+from chat_command import main
+
+if __name__ == "__main__":
+    main()
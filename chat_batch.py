@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import sys
+import time
+
+from chat_command import ChatCommand
+from config import Config
+from transport import RETRY_STATUSES, Transport, TransportError, parse_retry_after
+
+RATE_LIMITED_STATUS = 429
+# after every successful request, the rate grows back by this share of the configured one
+RATE_INCREASE = 0.1
+MIN_RATE = 0.05
+# the state of the interactive session must not leak into the independent records
+SESSION_VARIABLES = (
+    "CHAT_COMMAND_CONV_ID", "CHAT_COMMAND_LAST_COMMAND", "CHAT_COMMAND_LAST_OUTPUT", "CHAT_COMMAND_LAST_OUTPUT_FILE"
+)
+
+
+class TokenBucket:
+    """
+    Paces the requests to at most `rate` per second, allowing bursts of up to `burst` requests.
+    Every rate limited response halves the rate and pauses the requests for the time the API asked for,
+    the rate then grows back to the configured one while the requests succeed.
+    """
+    def __init__(self, rate, burst=1.):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE)
+
+    def on_rate_limited(self, retry_after=0.):
+        self.rate = max(MIN_RATE, self.rate / 2)
+        self.tokens = 0.
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+class BatchRunner:
+    """
+    Answers many independent fix or query records without any interaction.
+    Every record gets a ChatCommand of its own, with the same prompts, known errors, cache and cleaning
+    as the interactive `chat`. At most `concurrency` records are in flight at once,
+    and the API requests are paced by a token bucket that backs off when the API rate limits them.
+    """
+    def __init__(self, config, concurrency, rate, retries):
+        """
+        :param config:
+        :param concurrency: the maximum number of records processed at the same time
+        :param rate: the maximum number of API requests per second
+        :param retries: number of additional attempts of a failed request
+        """
+        self.config = config
+        self.concurrency = concurrency
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst=max(1., rate))
+        # the prompts are built and the requests are sent in these threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.transport = None
+        self.router = None
+        self.response_cache = None
+        self.succeeded = 0
+        self.failed = 0
+
+    async def run(self, records, output):
+        """
+        :param records: list of (id, record)
+        :param output: file the results are written to as JSON lines, in the order they complete
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def solve_and_write(record_id, record):
+            async with semaphore:
+                result = await self.solve(record_id, record)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            if "error" in result:
+                self.failed += 1
+            else:
+                self.succeeded += 1
+            print(f"\r⏳ {self.succeeded + self.failed}/{len(records)}", end="", file=sys.stderr, flush=True)
+
+        try:
+            await asyncio.gather(*(solve_and_write(record_id, record) for record_id, record in records))
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            print(file=sys.stderr)
+
+    async def solve(self, record_id, record):
+        loop = asyncio.get_running_loop()
+        result = {"id": record_id, "command": record.get("command", ""), "query": record.get("query", "")}
+        try:
+            chat, cache_key, suggestions = await loop.run_in_executor(self.executor, self.prepare, record)
+            source = "rules"
+            if suggestions is None and cache_key is not None:
+                suggestions = self.get_response_cache().get(cache_key)
+                source = "cache"
+            if not suggestions:
+                response = await self.request(chat)
+                suggestions = chat.extract_suggestions(response)
+                source = "api"
+                if response.get("usage"):
+                    result["usage"] = response["usage"]
+                if cache_key is not None:
+                    self.get_response_cache().put(cache_key, suggestions)
+        except (TransportError, KeyError, IndexError, TypeError, ValueError) as e:
+            result["error"] = str(e)
+            return result
+        result.update(suggestions=suggestions, source=source)
+        return result
+
+    def prepare(self, record):
+        """
+        Builds the prompt of a record, and answers it right away if it is a known error.
+        :param record: {"command": ..., "output": ..., "query": ..., "status": ...}, the command or the query is needed
+        :return: ChatCommand with the request in its messages, the cache key, and the suggestions of the known errors
+        """
+        command = str(record.get("command") or "")
+        query = str(record.get("query") or "")
+        if not command and not query:
+            raise ValueError("the record has neither a command nor a query")
+        status = record.get("status")
+        chat = ChatCommand(
+            command, str(record.get("output") or ""),
+            last_status=status if isinstance(status, int) else None
+        )
+        # the records did not happen here
+        chat.include_environment = False
+        if query:
+            prompt = chat.make_prompt_suggest_from_text(query)
+            cache_key = chat.response_cache_key("suggest_from_text", text=query)
+        else:
+            prompt = chat.make_prompt_fix_command()
+            cache_key = chat.response_cache_key("fix_command")
+        chat.append_user_message(prompt)
+        suggestions = chat.rule_suggestions() if not query else None
+        return chat, cache_key, suggestions
+
+    async def request(self, chat):
+        """
+        Sends the request through the router, pacing it and its retries with the token bucket.
+        :return: response json
+        :raises TransportError: if there was no successful response
+        """
+        loop = asyncio.get_running_loop()
+        data = chat.make_request_data({"messages": chat.messages, **chat.candidate_fields()})
+        transport = self.get_transport()
+        router = self.get_router()
+        error = None
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            retry_after = None
+            try:
+                # the same endpoints and failover as the interactive requests
+                response, _ = await loop.run_in_executor(self.executor, router.post, transport, data)
+            except TransportError as e:
+                error = e
+            else:
+                if response.status_code == 200:
+                    self.bucket.on_success()
+                    return response.json()
+                error = f"status {response.status_code}: {response.text[:500]}"
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                retry_after = response.headers.get("Retry-After")
+                if response.status_code == RATE_LIMITED_STATUS:
+                    # the bucket waits before the next attempt
+                    self.bucket.on_rate_limited(parse_retry_after(retry_after) if retry_after else 0.)
+                    continue
+            if attempt < self.retries:
+                await asyncio.sleep(transport.backoff_delay(attempt, retry_after))
+        raise TransportError(f"no successful response: {error}")
+
+    def get_transport(self):
+        if self.transport is None:
+            import requests
+
+            session = requests.Session()
+            # one connection for every concurrent request
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # the retries are paced by the batch itself
+            self.transport = Transport(session, self.config.connect_timeout, self.config.read_timeout, retries=0)
+        return self.transport
+
+    def get_router(self):
+        if self.router is None:
+            from router import Endpoint, Router
+
+            # shared by the concurrent requests, so that they all learn which endpoints work
+            self.router = Router(
+                [Endpoint(*endpoint) for endpoint in self.config.endpoints], self.config.router_file_path
+            )
+        return self.router
+
+    def get_response_cache(self):
+        if self.response_cache is None:
+            from response_cache import ResponseCache
+
+            self.response_cache = ResponseCache(
+                self.config.cache_file_path, self.config.cache_ttl, self.config.cache_size
+            )
+        return self.response_cache
+
+
+def read_records(path):
+    """
+    :param path: JSON lines file, - for stdin
+    :return: list of (id, record), the id is the record's "id" or its line number
+    """
+    records = []
+    with (contextlib.nullcontext(sys.stdin) if path == "-" else open(path, encoding='utf-8')) as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("not an object")
+            except ValueError as e:
+                print(f"⚠️ Skipping line {number} of {path}: {e}", file=sys.stderr)
+                continue
+            records.append((record.get("id", number), record))
+    return records
+
+
+def finished_ids(path):
+    """
+    :param path: the results of a previous run
+    :return: set of the ids of the records that were answered, the failed ones are tried again
+    """
+    ids = set()
+    try:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run
+                    continue
+                if isinstance(result, dict) and "error" not in result and "id" in result:
+                    ids.add(result["id"])
+    except OSError:
+        pass
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="chatBatch",
+        description="Get suggestions for many failed commands or queries at once, without any interaction. "
+                    "Every input line is a JSON object with the command and its output, or a query "
+                    "(and optionally an id and the exit status). The results are written as JSON lines "
+                    "as they complete, and an interrupted run continues where it stopped when started again."
+    )
+    parser.add_argument("input", help="JSON lines file with the records, - for stdin")
+    parser.add_argument("-o", "--output", help="Where the results are appended. Defaults to INPUT.results.jsonl, "
+                                               "- for stdout")
+    parser.add_argument("--concurrency", type=int, default=8, help="Records processed at the same time")
+    parser.add_argument("--rate", type=float, default=5., help="Maximum API requests per second")
+    parser.add_argument("--retries", type=int, default=5, help="Additional attempts of a failed request")
+    parser.add_argument("--restart", action="store_true", help="Ignore the results of a previous run")
+    args = parser.parse_args()
+    if args.output is None:
+        if args.input == "-":
+            parser.error("--output is needed when the records are read from stdin")
+        args.output = f"{os.path.splitext(args.input)[0]}.results.jsonl"
+
+    for name in SESSION_VARIABLES:
+        os.environ.pop(name, None)
+    config = Config()
+    records = read_records(args.input)
+    done = set() if args.restart or args.output == "-" else finished_ids(args.output)
+    pending = [(record_id, record) for record_id, record in records if record_id not in done]
+    print(f"📦 {len(pending)} of {len(records)} records to process.", file=sys.stderr)
+    if not pending:
+        return
+
+    runner = BatchRunner(config, args.concurrency, args.rate, args.retries)
+    with contextlib.ExitStack() as stack:
+        if args.output == "-":
+            output = sys.stdout
+        else:
+            output = stack.enter_context(open(args.output, 'w' if args.restart else 'a', encoding='utf-8'))
+        # the prompt builders tell the user what they are doing, which is not interesting here
+        stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        try:
+            asyncio.run(runner.run(pending, output))
+        except KeyboardInterrupt:
+            print("\n⏹️ Interrupted, run the same command again to continue.", file=sys.stderr)
+            sys.exit(1)
+    print(f"✅ {runner.succeeded} answered, {runner.failed} failed. The results are in {args.output}.",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
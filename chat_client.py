@@ -0,0 +1,56 @@
+# Thin client for the chat daemon.
+# It only uses the standard library, so the shell can start it with `python -S` and skip most of the startup cost.
+# If the daemon is not running, the request is executed by chat.py directly.
+import json
+import os
+import socket
+import sys
+
+from config import DAEMON_SOCKET_NAME
+
+INTERRUPT_MESSAGE = b"INT\n"
+
+
+def run_without_daemon(argv):
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chat.py")
+    os.execv(sys.executable, [sys.executable, script, *argv])
+
+
+def main():
+    argv = sys.argv[1:]
+    socket_path = os.path.join(os.getenv("CHAT_COMMAND_PATH", ""), DAEMON_SOCKET_NAME)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        run_without_daemon(argv)
+
+    request = {"action": "run", "argv": argv, "env": dict(os.environ), "cwd": os.getcwd()}
+    payload = json.dumps(request).encode() + b"\n"
+    sys.stdout.flush()
+    # the daemon talks to the terminal directly through these descriptors
+    sent = socket.send_fds(client, [payload], [0, 1, 2])
+    client.sendall(payload[sent:])
+
+    response = b""
+    while not response.endswith(b"\n"):
+        try:
+            chunk = client.recv(64)
+        except KeyboardInterrupt:
+            client.sendall(INTERRUPT_MESSAGE)
+            continue
+        if not chunk:
+            break
+        response += chunk
+    client.close()
+
+    try:
+        sys.exit(json.loads(response)["exit"])
+    except (ValueError, KeyError):
+        print("❌ The chat daemon stopped unexpectedly.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,24 @@
 import sys
 import os
-import requests
-import argparse
 import logging
-import pickle
+import time
 
-import examples
 from config import Config
+from metrics import Timings, setup_logging, write_metrics
 
-logging.basicConfig(
-    filename=f'{os.getenv("CHAT_COMMAND_PATH")}/basic.log',
-    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s'
-)
+setup_logging(os.getenv("CHAT_COMMAND_PATH"))
 
+# shared between requests when running inside the daemon, so that the connections stay warm
+_session = None
+_system_prompt = None
 
-SYSTEM_PROMPT = f"""
+
+def get_system_prompt():
+    global _system_prompt
+    if _system_prompt is None:
+        import examples
+
+        _system_prompt = f"""
 You are a helpful expert that assists the user with shell commands.
 Your response should contain only the commands. No explanations or additional information.
 All commands that need to be executed together should be on the same line.
@@ -22,54 +26,233 @@ Do not start your responses with the cd command into the current directory.
 The commands should be complete and executable as they are. So do not use placeholders like <your_file>.
 
 If, given the context, multiple responses are equally likely, output up to 3 possible variants, separated by the new line characters.
+If the user describes their environment, rely on it instead of asking for it again.
 In case you believe more context is needed, produce a command that, when executed, would provide this context as its output. Append \"# for context\" at the end of such command.
 {examples.context_request()}
 
 If you provide multiple suggestions in one response, make sure they are significantly different from each other, and none of them repeats the command that you need to fix.
 It is unlikely the user wants 3 different ways to obtain more context: mix in a potential solution as well.
+"""
+    return _system_prompt
+
+
+# when several completions are requested at once
+CANDIDATES_TEMPERATURE = 0.7
+# how many times in a row the local model may ask for context before the configured one is asked instead
+LOCAL_CONTEXT_REQUESTS = 2
+ESCALATION_MESSAGES = {
+    "empty": "had no suggestions",
+    "invalid": "suggested commands that cannot run here",
+    "context": "keeps asking for context",
+    "rejected": "did not help",
+}
+
+SUMMARY_PROMPT = """
+You summarize a conversation between a user and an assistant that suggests shell commands.
+Keep the user's goals, the commands that were executed or rejected, and the important parts of their outputs,
+such as errors, file names and versions. Be concise, use at most 150 words.
 """
 
 
 class ChatCommand:
-    def __init__(self, last_command, last_output):
-        self.config = Config()
+    def __init__(self, last_command, last_output, cache_mode="use", last_status=None, timings=None, shell_names=(),
+                 last_output_file="", last_output_note=""):
+        """
+        :param last_command:
+        :param last_output:
+        :param cache_mode: "use" the cached responses, "refresh" them or "bypass" the cache
+        :param last_status: exit code of the last command, if it was recorded
+        :param timings: Timings of this invocation, if it is already measured
+        :param shell_names: the aliases and functions of the user's shell, which are valid commands as well
+        :param last_output_file: where the output is, instead of last_output, as it may be too large for an argument
+        :param last_output_note: why the output is incomplete, if it is
+        """
+        self.timings = timings if timings is not None else Timings()
+        with self.timings.measure("config"):
+            self.config = Config()
+        self.cache_mode = cache_mode if self.config.cache_enabled else "bypass"
+        # asking again skips the known and the remembered fixes as well
+        self.ask_model = cache_mode == "refresh"
+        self.learned_fixes = None
+        # the request that the accepted suggestion will be remembered for
+        self.fix_context = None
+        self.response_cache = None
+        self.transport = None
+        self.router = None
+        self.last_endpoint = None
+        self.context_window = None
+        self.validator = None
+        self.shell_names = shell_names
+        # the position of the suggestions in the conversation, and the command the user chose from them
+        self.accepted = None
+        self.local_transport = None
+        # the local model answered the last request, and whether it is not asked anymore in this session
+        self.answered_locally = False
+        self.escalated = False
+        self.local_context_requests = 0
+        # the first prompts describe the user's environment, so that the model asks for less context
+        self.include_environment = self.config.environment_bytes > 0
 
         self.last_chat_command = os.getenv("CHAT_COMMAND_LAST_COMMAND", "")
-        self.last_chat_output = self.truncate_output(os.getenv("CHAT_COMMAND_LAST_OUTPUT", ""))
-        self.last_command = last_command
-        self.last_output = self.truncate_output(last_output)
-        # if the last command was the one executed by `chat` (and was not reran),
-        # we dont need to mention it after our request, as it will be in the chat history already
-        self.dont_mention_last_command = self.last_chat_command == self.last_command and self.last_output == ""
+        with self.timings.measure("history_load"):
+            self.last_chat_output = self.read_last_chat_output()
+            self.last_command = last_command
+            self.last_output = self.reduce_last_output(last_output, last_output_file, last_output_note)
+            self.last_status = last_status
+            # if the last command was the one executed by `chat` (and was not reran),
+            # we dont need to mention it after our request, as it will be in the chat history already
+            self.dont_mention_last_command = self.last_chat_command == self.last_command and self.last_output == ""
+
+            self.system_prompt = get_system_prompt()
+            self.messages = self.init_chat_history()
 
-        self.system_prompt = SYSTEM_PROMPT
-        self.messages = self.init_chat_history()
+    def get_api_response(self, data, on_content=None):
+        """
+        Sends the request to the model.
+        :param data: request fields, at least the messages
+        :param on_content: if given, the response is streamed and this is called with every received piece of text
+        :return: response json (assembled from the stream in the non-streamed format, if streaming)
+        """
+        request_data = self.make_request_data(data)
+        if on_content is not None:
+            request_data["stream"] = True
+        logging.info(f"Sending request with prompt:\n{request_data['messages'][-1]['content']}")
 
-    def get_api_response(self, data):
+        start = time.perf_counter()
+        response = self.post_to_endpoints(request_data, stream=on_content is not None)
+        # without streaming, the (short) body is already read as well
+        self.timings.set("ttfb", time.perf_counter() - start)
+        if response.status_code != 200:
+            self.timings.set_source("error")
+            try:
+                details = response.json()
+            except ValueError:
+                details = f"{response.status_code} {response.text[:500]}"
+            print(f"❌ LLM request failed:\n {details}")
+            sys.exit(1)
+        if on_content is not None:
+            from streaming import iter_stream_content
+
+            content = []
+            # chunk_size=None yields the data as soon as it arrives
+            for piece in iter_stream_content(response.iter_content(chunk_size=None)):
+                if not content:
+                    self.timings.set("ttfb", time.perf_counter() - start)
+                content.append(piece)
+                on_content(piece)
+            response_json = {"choices": [{"message": {"role": "assistant", "content": "".join(content)}}]}
+        else:
+            response_json = response.json()
+            missing_choices = request_data.get("n", 1) - len(response_json.get("choices", []))
+            if missing_choices > 0:
+                response_json["choices"] += self.request_more_choices(request_data, missing_choices)
+        self.timings.set("network", time.perf_counter() - start)
+        self.timings.count_usage(request_data["model"], response_json.get("usage"))
+        logging.info(f"Received response: {response_json}")
+        return response_json
+
+    def post_to_endpoints(self, request_data, stream=False):
+        """
+        Sends the request to the best endpoint, and fails over to the next ones if it does not work.
+        :param request_data: the body of the request, its model is set to the one of the endpoint
+        :param stream:
+        :return: the response, with any status that is not a failure of the endpoint itself
+        """
+        from transport import TransportError
+
+        def announce_failover(endpoint, next_endpoint):
+            print(f"⚠️ {endpoint.model} did not respond, trying {next_endpoint.model}...")
+
+        try:
+            response, self.last_endpoint = self.get_router().post(
+                self.get_transport(), request_data, stream=stream, on_failover=announce_failover
+            )
+        except TransportError as e:
+            self.timings.set_source("error")
+            print(f"❌ LLM request failed:\n {e}")
+            sys.exit(1)
+        return response
+
+    def request_more_choices(self, request_data, count):
+        """
+        Some OpenAI-compatible servers ignore n and return a single completion,
+        the missing ones are requested from the same endpoint in parallel.
+        :param request_data:
+        :param count: the number of missing completions
+        :return: list of the received choices, the failed requests are skipped
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from transport import TransportError
+
+        logging.info(f"{self.last_endpoint.name} ignored n, requesting {count} more completions in parallel")
+        single_request_data = {key: value for key, value in request_data.items() if key != "n"}
+        endpoint = self.last_endpoint
+
+        def request_choices(_):
+            try:
+                response = self.get_transport().post(endpoint.url, single_request_data, endpoint.headers, retries=0)
+                if response.status_code == 200:
+                    return response.json().get("choices", [])
+                logging.warning(f"A request for another completion failed with status {response.status_code}")
+            except (TransportError, ValueError) as e:
+                logging.warning(f"A request for another completion failed: {e}")
+            return []
+
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            return [choice for choices in pool.map(request_choices, range(count)) for choice in choices]
+
+    def candidate_fields(self):
+        """
+        :return: the request fields that ask for several completions at once, empty if it is not enabled
+        """
+        if self.config.candidates <= 1:
+            return {}
+        # identical completions would be useless
+        return {"n": self.config.candidates, "temperature": CANDIDATES_TEMPERATURE}
+
+    def get_router(self):
+        if self.router is None:
+            from router import Endpoint, Router
+
+            self.router = Router(
+                [Endpoint(*endpoint) for endpoint in self.config.endpoints], self.config.router_file_path
+            )
+        return self.router
+
+    def make_request_data(self, data):
+        """
+        :param data: request fields, at least the messages
+        :return: the body of the API request
+        """
         request_data = {
             "model": self.config.model,
             "max_tokens": 200,
             "temperature": 0.,
         }
         request_data.update(data)
-        logging.info(f"Asking {request_data['model']} for suggestions.")
-        logging.info(f"Sending request with prompt:\n{request_data['messages'][-1]['content']}")
-        response = requests.post(self.config.api_url, json=request_data, headers=self.config.headers)
-        logging.info(f"Received response: {response.json()}")
-        if response.status_code != 200:
-            print(f"❌ LLM request failed:\n {response.json()}")
-            sys.exit(1)
-        return response.json()
+        return request_data
+
+    def get_transport(self):
+        if self.transport is None:
+            from transport import Transport
+
+            self.transport = Transport(
+                get_session(), self.config.connect_timeout, self.config.read_timeout, self.config.retries,
+                hedge_percentile=self.config.hedge_percentile, latency_file_path=self.config.latency_file_path,
+            )
+        return self.transport
 
     def make_prompt_fix_command(self, clipboard=False):
         print("🤖 Attempting to fix the last command...")
-        prompt = self.init_prompt(include_last_command=True)
+        prompt = self.init_prompt(include_last_command=True, include_environment=True)
         if self.dont_mention_last_command:
             prompt += f"Something still went wrong."
         else:
             prompt += f"Please fix this shell command:"
             prompt += f"\n{self.last_command}"
             prompt += f"\nThis command's current output:\n{self.last_output}\nend of output."
+            if self.last_status is not None:
+                prompt += f"\nIt exited with code {self.last_status}."
         # prompt += f"\nThe current directory is: {os.getcwd()}"
         prompt += self.add_clipboard_content(clipboard)
         prompt += "\nSuggest a command to fix the issue."
@@ -77,7 +260,7 @@ class ChatCommand:
 
     def make_prompt_suggest_from_text(self, text, clipboard=False):
         print("🤖 Generating suggestions based on the provided query...")
-        prompt = self.init_prompt(include_last_command=True)
+        prompt = self.init_prompt(include_last_command=True, include_environment=True)
         prompt += f"I want to do the following: {text}"
         if not self.dont_mention_last_command:
             prompt += f"\nHere is the last executed command (it may not be helpful to this request): {self.last_command}"
@@ -98,45 +281,478 @@ class ChatCommand:
         prompt += f"\nConsidering this, suggest up to 3 commands that would be helpful."
         return prompt
 
-    def make_prompt_received_context(self):
+    def make_prompt_rejected(self):
+        print(f"🔼 Asking {self.config.model}, as the local model {ESCALATION_MESSAGES['rejected']}...")
+        # the rejection is the last message already
+        prompt = self.init_prompt(include_last_command=False)
+        prompt += "Suggest different commands."
+        return prompt
+
+    def make_prompt_received_context(self, context=None):
+        """
+        :param context: list of (command, output) that were gathered in this process,
+        otherwise the context is the last command executed by the shell
+        """
         print("🤖 Analyzing the context...")
-        prompt = self.init_prompt(include_last_command=True)
+        if context is None:
+            prompt = self.init_prompt(include_last_command=True)
+        else:
+            prompt = self.init_prompt(include_last_command=False)
+            for command, output in context:
+                prompt += f"I executed {command}"
+                prompt += f"\nThe output was:\n{output}\nend of output.\n"
         prompt += f"Given this new context, continue solving the task."
         return prompt
 
     def produce_llm_command(self, request_type, **kwargs):
         """
-        Presents command choices to the user based on the given request type.
-        Recurses when the user provides additional instructions.
+        Runs the whole session: presents command choices to the user based on the given request type,
+        and requests new ones for the user's additional instructions and for the context the user let run,
+        until a command is chosen for the shell or none at all.
+        The conversation stays in memory in the meantime, and it is saved once at the end,
+        also when the session ends with an error of the API or Ctrl-C, so that none of its turns are lost.
         :param request_type:
         :param kwargs:
         :return:
         """
-        if request_type == "fix_command":
-            prompt = self.make_prompt_fix_command(**kwargs)
-        elif request_type == "suggest_from_text":
-            prompt = self.make_prompt_suggest_from_text(**kwargs)
-        elif request_type == "additional_instructions":
-            prompt = self.make_prompt_additional_instructions(**kwargs)
-        elif request_type == "received_context":
-            prompt = self.make_prompt_received_context()
+        request = (request_type, kwargs)
+        try:
+            while request is not None:
+                request_type, kwargs = request
+                suggestions, displayed = self.request_suggestions(request_type, **kwargs)
+                request = self.choose_command(suggestions, displayed=displayed)
+        finally:
+            self.write_history()
+
+    def request_suggestions(self, request_type, **kwargs):
+        """
+        :param request_type:
+        :param kwargs:
+        :return: list of suggestions, and whether they were already shown while they were streamed
+        """
+        self.timings.start_request(request_type)
+        with self.timings.measure("prompt"):
+            if request_type == "fix_command":
+                prompt = self.make_prompt_fix_command(**kwargs)
+            elif request_type == "suggest_from_text":
+                prompt = self.make_prompt_suggest_from_text(**kwargs)
+            elif request_type == "additional_instructions":
+                prompt = self.make_prompt_additional_instructions(**kwargs)
+            elif request_type == "received_context":
+                prompt = self.make_prompt_received_context(**kwargs)
+            elif request_type == "rejected":
+                prompt = self.make_prompt_rejected()
+            else:
+                raise ValueError(f"Unknown request type: {request_type}")
+
+            # has to be checked before the new message is added
+            cache_key = self.response_cache_key(request_type, **kwargs)
+            self.append_user_message(prompt)
+        if request_type in ("fix_command", "suggest_from_text"):
+            context = self.learned_fix_context(request_type, **kwargs)
+            # a query such as "run the tests" means something else in another project,
+            # a failing command and its output identify the problem by themselves
+            scope = f"{request_type}:{os.getcwd()}" if request_type == "suggest_from_text" else request_type
+            self.fix_context = (scope, context) if context is not None else None
+        if request_type == "fix_command" and self.dont_mention_last_command and self.config.learning_enabled:
+            # the command that chat suggested last time did not help
+            self.get_learned_fixes().forget(self.last_chat_command)
+
+        with self.timings.measure("lookup"):
+            suggestions = None
+            if request_type == "fix_command" and not kwargs.get("clipboard"):
+                suggestions = self.rule_suggestions()
+            if suggestions is None:
+                suggestions = self.learned_suggestions()
+            if suggestions is None:
+                suggestions = self.cached_suggestions(cache_key)
+            if suggestions is None and request_type == "fix_command":
+                suggestions = self.prefetched_suggestions()
+        displayed = False
+        asked = suggestions is None
+        if asked:
+            suggestions, displayed = self.query_model()
+        else:
+            # the suggestions that were looked up did not come from the local model
+            self.answered_locally = False
+        problems = self.validate_suggestions(suggestions)
+        if asked and problems and all(problems):
+            print("⚠️ None of the suggested commands can run here, asking again...")
+            self.messages.append({"role": "assistant", "content": "\n".join(suggestions)})
+            self.append_user_message(
+                "None of these commands can run here:\n" +
+                "\n".join(f"{suggestion} ({problem})" for suggestion, problem in zip(suggestions, problems)) +
+                "\nSuggest commands that only use the programs that are available."
+            )
+            suggestions, displayed = self.query_model()
+            problems = self.validate_suggestions(suggestions)
+        # the cache is keyed on the configured model, the local model's answers are not kept as its own
+        if asked and cache_key is not None and not self.answered_locally:
+            self.get_response_cache().put(cache_key, suggestions)
+        return self.annotate_suggestions(suggestions, problems, displayed), displayed
+
+    def query_model(self):
+        """
+        Requests the suggestions for the conversation so far.
+        If a local model is configured, it is asked first, and the configured model only when its answer
+        does not look good enough.
+        :return: list of suggestions, and whether they were already shown while they were streamed
+        """
+        with self.timings.measure("prompt"):
+            data = {"messages": self.fit_context()}
+        if self.config.local_api_url and not self.escalated:
+            suggestions = self.query_local_model(data)
+            if suggestions is not None:
+                self.answered_locally = True
+                return suggestions, False
+        self.answered_locally = False
+        start = time.perf_counter()
+        if self.config.stream:
+            suggestions, displayed = self.stream_suggestions(data), True
         else:
-            raise ValueError(f"Unknown request type: {request_type}")
+            response = self.get_api_response(dict(data, **self.candidate_fields()))
+            suggestions, displayed = self.extract_suggestions(response), False
+        if self.config.local_api_url:
+            self.timings.add_tier("remote", time.perf_counter() - start)
+        return suggestions, displayed
+
+    def query_local_model(self, data):
+        """
+        Asks the small model of the local endpoint.
+        :param data: request fields, at least the messages
+        :return: list of suggestions, or None if the configured model has to be asked instead
+        """
+        from transport import TransportError
+
+        request_data = self.make_request_data(dict(data, model=self.config.local_model))
+        logging.info(f"Asking the local model {self.config.local_model} at {self.config.local_api_url}")
+        start = time.perf_counter()
+        suggestions = []
+        try:
+            response = self.get_local_transport().post(
+                self.config.local_api_url, request_data, self.config.local_headers, retries=0
+            )
+            if response.status_code == 200:
+                response_json = response.json()
+                self.timings.count_usage(request_data["model"], response_json.get("usage"))
+                suggestions = self.extract_suggestions(response_json)
+                reason = self.escalation_reason(suggestions)
+            else:
+                reason = f"status {response.status_code}"
+        except (TransportError, ValueError, KeyError, IndexError, TypeError) as e:
+            reason = f"error: {e}"
+        self.timings.add_tier("local", time.perf_counter() - start, escalation=reason)
+        if reason is None:
+            return suggestions
+        logging.info(f"Escalating from the local model ({reason}), its suggestions were {suggestions}")
+        print(f"🔼 Asking {self.config.model}, the local model {ESCALATION_MESSAGES.get(reason, 'failed')}...")
+        self.escalated = True
+        return None
+
+    def escalation_reason(self, suggestions):
+        """
+        :param suggestions: the local model's suggestions
+        :return: why they are not good enough, None if they are
+        """
+        from context_gathering import CONTEXT_MARKER
+
+        if not suggestions or not any(suggestion.strip() for suggestion in suggestions):
+            return "empty"
+        problems = self.validate_suggestions(suggestions)
+        if problems and all(problems):
+            return "invalid"
+        if all(CONTEXT_MARKER in suggestion for suggestion in suggestions):
+            self.local_context_requests += 1
+            if self.local_context_requests > LOCAL_CONTEXT_REQUESTS:
+                return "context"
+        else:
+            self.local_context_requests = 0
+        return None
+
+    def get_local_transport(self):
+        if self.local_transport is None:
+            from transport import Transport
+
+            self.local_transport = Transport(
+                get_session(), self.config.connect_timeout, self.config.local_timeout, retries=0
+            )
+        return self.local_transport
+
+    def validate_suggestions(self, suggestions):
+        """
+        :param suggestions:
+        :return: list with why every suggestion cannot run here, or None for the ones that can,
+        empty if the suggestions are not validated
+        """
+        if not self.config.validate:
+            return []
+        with self.timings.measure("validate"):
+            validator = self.get_validator()
+            problems = [validator.problem(suggestion) for suggestion in suggestions]
+        for suggestion, problem in zip(suggestions, problems):
+            if problem:
+                logging.info(f"Suggestion {suggestion} cannot run here: {problem}")
+        return problems
+
+    @staticmethod
+    def annotate_suggestions(suggestions, problems, displayed):
+        """
+        Marks the suggestions that cannot run here, and moves them after the ones that can.
+        :param suggestions:
+        :param problems: as returned by validate_suggestions
+        :param displayed: the suggestions were already shown, so their numbers cannot change anymore
+        :return: list of suggestions
+        """
+        if not any(problems):
+            return suggestions
+        annotated = [
+            f"{suggestion} # ⚠️ {problem}" if problem else suggestion
+            for suggestion, problem in zip(suggestions, problems)
+        ]
+        if displayed:
+            for index, (suggestion, problem) in enumerate(zip(suggestions, problems), start=1):
+                if problem:
+                    print(f"⚠️ {index}. {problem}")
+            return annotated
+        return (
+            [suggestion for suggestion, problem in zip(annotated, problems) if not problem] +
+            [suggestion for suggestion, problem in zip(annotated, problems) if problem]
+        )
+
+    def get_validator(self):
+        if self.validator is None:
+            from path_index import PathIndex
+            from validation import CommandValidator
+
+            self.validator = CommandValidator(PathIndex(self.config.path_index_file_path), self.shell_names)
+        return self.validator
+
+    def fit_context(self):
+        """
+        :return: the messages to send, fitted into the token budget
+        """
+        if self.context_window is None:
+            from context_window import ContextWindow
+
+            self.context_window = ContextWindow(
+                self.config.context_tokens, self.config.summary_file_path, self.summarize_messages
+            )
+        return self.context_window.fit(self.messages)
+
+    def summarize_messages(self, previous_summary, messages):
+        print("📜 Summarizing the earlier part of the conversation...")
+        transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if previous_summary:
+            transcript = f"Summary so far:\n{previous_summary}\n\nThe conversation continued:\n{transcript}"
+        response = self.get_api_response({
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            "max_tokens": 300,
+        })
+        return response['choices'][0]['message']['content'].strip()
+
+    def response_cache_key(self, request_type, text="", clipboard=False, context=None):
+        """
+        Only the first request of a conversation is cached, as the later ones depend on the whole history.
+        The output is fingerprinted with its volatile parts (paths, ids, timestamps) masked.
+        The first prompt describes the current directory, so the answers are kept per directory.
+        :param request_type:
+        :param text: the user's query
+        :param clipboard: requests with clipboard content are not cached
+        :return: the key, or None if the request should not be cached
+        """
+        if (
+                self.cache_mode == "bypass" or
+                request_type not in ("fix_command", "suggest_from_text") or
+                clipboard or
+                len(self.messages) > 1
+        ):
+            return None
+        from normalize import fingerprint, normalize_command
+        from response_cache import ResponseCache
+
+        return ResponseCache.make_key(
+            self.config.model, request_type,
+            normalize_command(self.last_command), fingerprint(self.last_output),
+            normalize_command(self.last_chat_command), fingerprint(self.last_chat_output),
+            text.strip(), os.getcwd(),
+        )
 
-        self.append_user_message(prompt)
-        data = {"messages": self.messages}
-        suggestions = self.extract_suggestions(self.get_api_response(data))
-        # request selection until the user inputs something other than a new instruction
-        self.choose_command(suggestions)
+    def cached_suggestions(self, cache_key):
+        if cache_key is None or self.cache_mode == "refresh":
+            return None
+        suggestions = self.get_response_cache().get(cache_key)
+        if suggestions:
+            logging.info(f"Using cached suggestions: {suggestions}")
+            print("⚡ Reusing the suggestions for the same problem (chat --refresh_cache to ask again).")
+            self.timings.set_source("cache")
+            return suggestions
+        return None
 
-    def choose_command(self, suggestions):
+    def rule_suggestions(self):
+        """
+        Answers the common failures with their usual fix, without the network.
+        :return: list of suggestions, or None if no rule matched
+        """
+        # the command that failed is chat's own suggestion, maybe the usual fix itself, the model knows better
+        if not self.config.rules_enabled or self.ask_model or self.dont_mention_last_command:
+            return None
+        command, output = self.last_failure()
+        if not output:
+            return None
+        from error_rules import get_rule_index
+
+        suggestions = self.clean_suggestions(get_rule_index(self.config.rules_dir).match(command, output))
+        if suggestions:
+            logging.info(f"Using the suggestions of the error rules: {suggestions}")
+            print("⚡ This is a known error, suggesting the usual fix (chat --refresh_cache to ask the model).")
+            self.timings.set_source("rules")
+            return suggestions
+        return None
+
+    def last_failure(self):
+        """
+        :return: the command that went wrong and its output: the one chat executed if it was not rerun since
+        """
+        if self.dont_mention_last_command:
+            return self.last_chat_command, self.last_chat_output
+        return self.last_command, self.last_output
+
+    def learned_fix_context(self, request_type, text="", clipboard=False):
+        """
+        :return: the text that identifies the request among the remembered fixes, or None for a clipboard request
+        """
+        if clipboard:
+            return None
+        from normalize import mask_volatile, normalize_command
+
+        if request_type == "suggest_from_text":
+            return mask_volatile(text)
+        command, output = self.last_failure()
+        return f"{normalize_command(command)}\n{mask_volatile(output)}"
+
+    def learned_suggestions(self):
+        """
+        :return: the accepted suggestions of the similar past requests, or None if there are none
+        """
+        if (
+                not self.config.learning_enabled or self.ask_model or self.fix_context is None or
+                # the command that failed is chat's own suggestion, a remembered one would be offered again
+                self.fix_context[0] == "fix_command" and self.dont_mention_last_command
+        ):
+            return None
+        request_type, context = self.fix_context
+        found = self.get_learned_fixes().search(request_type, context, self.config.learned_threshold)
+        if found:
+            logging.info(f"Using remembered suggestions: {found}")
+            print("♻️ This previously worked for a similar problem (chat --refresh_cache to ask the model).")
+            self.timings.set_source("learned")
+            return [command for command, _ in found]
+        return None
+
+    def get_learned_fixes(self):
+        if self.learned_fixes is None:
+            from learned_fixes import LearnedFixes
+
+            self.learned_fixes = LearnedFixes(
+                self.config.learned_file_path, self.config.learned_size, self.config.learned_max_age_days
+            )
+        return self.learned_fixes
+
+    def prefetch_fix_command(self):
+        """
+        Requests the fix of the last command in the background, right after it failed.
+        The suggestions are kept for the `chat` call that would send exactly the same messages.
+        """
+        prefetch = self.get_prefetch()
+        cache_key = self.response_cache_key("fix_command")
+        if cache_key is not None and self.get_response_cache().get(cache_key):
+            return
+        if self.rule_suggestions():
+            return
+        if not prefetch.acquire():
+            logging.info("Skipping the prefetch, too many of them were started recently")
+            return
+        self.timings.start_request("prefetch")
+        self.append_user_message(self.make_prompt_fix_command())
+        key = self.prefetch_key()
+        prefetch.start(key)
+        logging.info(f"Prefetching the fix for: {self.last_command}")
+        suggestions = self.extract_suggestions(
+            self.get_api_response({"messages": self.fit_context(), **self.candidate_fields()})
+        )
+        prefetch.finish(key, suggestions)
+
+    def prefetched_suggestions(self):
+        if self.cache_mode == "refresh":
+            return None
+        suggestions = self.get_prefetch().take(self.prefetch_key(), self.config.read_timeout)
+        if suggestions:
+            logging.info(f"Using prefetched suggestions: {suggestions}")
+            print("⚡ The suggestions were prepared while you were reading the error.")
+            self.timings.set_source("prefetch")
+            return suggestions
+        return None
+
+    def prefetch_key(self):
+        from response_cache import ResponseCache
+
+        return ResponseCache.make_key(self.config.model, self.messages)
+
+    def get_prefetch(self):
+        from prefetch import Prefetch
+
+        return Prefetch(
+            self.config.prefetch_file_path, self.config.prefetch_rate_file_path, self.config.prefetch_per_minute
+        )
+
+    def get_environment(self):
+        from environment import EnvironmentSnapshot
+        from path_index import PathIndex
+
+        return EnvironmentSnapshot(
+            self.config.environment_file_path, PathIndex(self.config.path_index_file_path),
+            self.config.environment_bytes
+        )
+
+    def get_response_cache(self):
+        if self.response_cache is None:
+            from response_cache import ResponseCache
+
+            self.response_cache = ResponseCache(
+                self.config.cache_file_path, self.config.cache_ttl, self.config.cache_size
+            )
+        return self.response_cache
+
+    def stream_suggestions(self, data):
+        """
+        Streams the model's response and shows every suggestion as soon as its line is complete.
+        :param data:
+        :return: list of suggestions, same as extract_suggestions would produce
+        """
+        def show_suggestion(suggestion):
+            if len(stream.suggestions) == 1:
+                print("ℹ️ Suggested commands:")
+            print(f"{len(stream.suggestions)}. {suggestion}", flush=True)
+
+        from streaming import SuggestionStream
+
+        stream = SuggestionStream(self.clean_suggestion, show_suggestion)
+        response = self.get_api_response(data, on_content=stream.feed)
+        stream.close()
+        return self.extract_suggestions(response)
+
+    def choose_command(self, suggestions, displayed=False):
         """
         Prompts the user to choose a command from the suggestions.
         Distinguishes between a single suggestion and multiple suggestions.
         In case the user's response is not one of the given options,
         it is treated as addressed to the LLM, and thus it is sent to the model.
         :param suggestions: list of 1 or more suggestions
-        :return:
+        :param displayed: the suggestions were already shown to the user while they were streamed
+        :return: (request type, kwargs) of the request that continues the session, None if it is over
         """
         self.messages.append({
             "role": "assistant",
@@ -145,52 +761,134 @@ class ChatCommand:
 
         try:
             if len(suggestions) > 1:
-                print("ℹ️ Suggested commands:")
-                for index, suggestion in enumerate(suggestions, start=1):
-                    print(f"{index}. {suggestion}")
-
-                print(f"❔ Enter your selection ([1]-{len(suggestions)}/n/<new instructions>): ", end="")
-                response = input()
-                if response.lower() == 'n':
-                    self.append_user_message("I do not want to execute any of these commands.")
-                    self.write_history()
-                else:
-                    try:
-                        if response == '':
-                            response = '1'
-                        response = int(response) - 1
-                        if response < 0 or response >= len(suggestions):
-                            raise ValueError
-                        self.send_command(suggestions[response])
-                    except ValueError:
-                        self.produce_llm_command("additional_instructions", text=response)
+                if not displayed:
+                    print("ℹ️ Suggested commands:")
+                    for index, suggestion in enumerate(suggestions, start=1):
+                        print(f"{index}. {suggestion}")
+
+                context_commands = self.gatherable_context_commands(suggestions)
+                gather_option = ""
+                if context_commands:
+                    print(f"ℹ️ Enter a to run all {len(context_commands)} context commands at once.")
+                    gather_option = "/a"
+                options = f"[1]-{len(suggestions)}{gather_option}/n/<new instructions>"
+                print(f"❔ Enter your selection ({options}): ", end="")
+                with self.timings.measure("think"):
+                    response = input()
+                if response.lower() == 'a' and context_commands:
+                    return self.gather_context(context_commands)
+                elif response.lower() == 'n':
+                    return self.reject()
+                try:
+                    if response == '':
+                        response = '1'
+                    choice = int(response) - 1
+                    if choice < 0 or choice >= len(suggestions):
+                        raise ValueError
+                except ValueError:
+                    self.escalate_rejected()
+                    return "additional_instructions", {"text": response}
+                return self.execute(suggestions[choice])
             else:
                 suggestion = suggestions[0]
-                print(f"ℹ️ Suggested command: {suggestion}")
-                response = input("❔ Execute? ([y]/n/<new instructions>): ")
+                if not displayed:
+                    print(f"ℹ️ Suggested command: {suggestion}")
+                with self.timings.measure("think"):
+                    response = input("❔ Execute? ([y]/n/<new instructions>): ")
                 if response.lower() == 'y' or response == '':
-                    self.send_command(suggestion)
+                    return self.execute(suggestion)
                 elif response.lower() == 'n':
-                    self.append_user_message("I do not want to execute any of these commands.")
-                    self.write_history()
-                else:
-                    self.produce_llm_command("additional_instructions", text=response)
+                    return self.reject()
+                self.escalate_rejected()
+                return "additional_instructions", {"text": response}
         except KeyboardInterrupt:
             print()
             sys.exit(1)
 
-    def send_command(self, command):
-        context_flag = False
-        if "# for context" in command:
-            context_flag = True
+    def reject(self):
+        """
+        :return: the request for the configured model if the rejected suggestions were the local model's,
+        otherwise None, as the session is over
+        """
+        self.append_user_message("I do not want to execute any of these commands.")
+        if self.escalate_rejected():
+            return "rejected", {}
+        return None
+
+    def escalate_rejected(self):
+        """
+        The user did not take the suggestions, so the next ones come from the configured model.
+        :return: whether the rejected suggestions were the local model's
+        """
+        if not self.answered_locally:
+            return False
+        logging.info("Escalating from the local model, the user rejected its suggestions")
+        self.timings.set_escalation("rejected")
+        self.escalated = True
+        self.answered_locally = False
+        return True
+
+    def execute(self, suggestion):
+        """
+        Runs a context command right here, and hands any other command to the shell.
+        :param suggestion:
+        :return: the request that continues the session, None if it is over
+        """
+        from context_gathering import CONTEXT_MARKER, strip_context_marker
 
+        if CONTEXT_MARKER in suggestion:
+            return self.gather_context([strip_context_marker(suggestion)])
+        self.send_command(suggestion)
+        return None
+
+    @staticmethod
+    def gatherable_context_commands(suggestions):
+        """
+        :param suggestions:
+        :return: the context commands that can run together without harm, if there are at least two of them
+        """
+        from context_gathering import CONTEXT_MARKER, is_read_only, strip_context_marker
+
+        commands = [
+            strip_context_marker(suggestion) for suggestion in suggestions
+            if CONTEXT_MARKER in suggestion and is_read_only(strip_context_marker(suggestion))
+        ]
+        return commands if len(commands) > 1 else []
+
+    def gather_context(self, commands):
+        """
+        Runs the context commands concurrently, their outputs are sent in a single request.
+        :param commands:
+        :return: the request with the context
+        """
+        from context_gathering import run_context_commands
+
+        print("🔎 Gathering the context...")
+        context = run_context_commands(commands, self.config.context_timeout, self.config.context_max_bytes)
+        for command, output in context:
+            print(f"$ {command}\n{output}")
+        logging.info(f"Gathered context from: {commands}")
+        print("📝 Context obtained, calling chat again.")
+        return "received_context", {"context": context}
+
+    def send_command(self, command):
+        """
+        Hands the chosen command to the shell, which executes it and adds it to its history.
+        :param command:
+        """
         # cut off the comment
         command = command.split("#")[0].strip()
 
-        with open(self.config.result_file_path, 'w') as file:
-            file.write(f"{command}\n{self.config.conv_id}\n{int(context_flag)}\n")
+        # renamed into place, so that the shell never reads a half written file
+        temporary_path = f"{self.config.result_file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(f"{command}\n{self.config.conv_id}\n")
+        os.replace(temporary_path, self.config.result_file_path)
         logging.info(f"Command written to file: {command}")
-        self.write_history()
+        # the suggestions are the last message, the system prompt is not a part of the conversation
+        self.accepted = (len(self.messages) - 2, command)
+        if self.fix_context is not None and self.config.learning_enabled:
+            self.get_learned_fixes().record(*self.fix_context, command)
 
     def init_chat_history(self):
         """
@@ -198,18 +896,25 @@ class ChatCommand:
         Includes the system prompt and previous interactions in this session.
         :return:
         """
+        from history_store import ConversationStore
+
+        self.history_store = ConversationStore(
+            self.config.history_dir, self.config.history_max_age_days, self.config.history_max_bytes
+        )
         chat_history = [{"role": "system", "content": self.system_prompt}]
         if os.environ.get("CHAT_COMMAND_CONV_ID"):
-            with open(self.config.history_file_path, 'rb') as file:
-                chat_history.extend(pickle.load(file))
+            chat_history.extend(self.history_store.load(self.config.conv_id))
             logging.info(f"Chat history loaded from file: {self.config.history_file_path}")
+        # the stored messages, and how many of them are still the same in memory
+        self.stored_messages = self.unchanged_messages = len(chat_history) - 1
         return chat_history
 
-    def init_prompt(self, include_last_command=True):
+    def init_prompt(self, include_last_command=True, include_environment=False):
         """
         Initializes the user prompt for the model.
         Considers the last message in history, as well as the last command and its output.
         :param include_last_command:
+        :param include_environment: whether to describe the current directory, the system and the installed programs
         :return: prompt that is empty or has the new line at the end
         """
         prompt = ""
@@ -217,6 +922,10 @@ class ChatCommand:
             # this ensures we don't write 2 user messages in a row or overwrite some information
             prompt = self.messages[-1]["content"] + "\n"
             self.messages.pop()
+            self.unchanged_messages = min(self.unchanged_messages, len(self.messages) - 1)
+        if include_environment and self.include_environment:
+            with self.timings.measure("environment"):
+                prompt += self.get_environment().describe()
         if include_last_command and self.last_chat_command:
             prompt += f"I executed {self.last_chat_command}"
             prompt += f"\nThe output was:\n{self.last_chat_output}\nend of output.\n"
@@ -226,9 +935,22 @@ class ChatCommand:
         self.messages.append({"role": "user", "content": user_message})
 
     def write_history(self):
-        # system prompt is not written, as it is assumed to be always the same
-        with open(self.config.history_file_path, 'wb') as file:
-            pickle.dump(self.messages[1:], file)
+        """
+        Appends the new messages to the stored conversation.
+        The system prompt is not written, as it is assumed to be always the same.
+        """
+        history = self.messages[1:]
+        keep = self.unchanged_messages if self.unchanged_messages < self.stored_messages else None
+        self.history_store.append(self.config.conv_id, history[self.unchanged_messages:], keep=keep)
+        self.get_history_index().add(
+            self.config.conv_id, self.unchanged_messages, history[self.unchanged_messages:], self.accepted
+        )
+        self.stored_messages = self.unchanged_messages = len(history)
+
+    def get_history_index(self):
+        from history_index import HistoryIndex
+
+        return HistoryIndex(self.config.history_index_path, self.config.history_dir)
 
     def extract_suggestions(self, response):
         """
@@ -236,7 +958,17 @@ class ChatCommand:
         :param response: json
         :return: list of suggestions
         """
-        suggestions = self.clean_suggestions(response['choices'][0]['message']['content'].splitlines())
+        with self.timings.measure("parse"):
+            choices = response['choices']
+            if len(choices) > 1:
+                from candidates import rank_candidates
+
+                suggestions = rank_candidates(
+                    [self.clean_suggestions(choice['message']['content'].splitlines()) for choice in choices],
+                    excluded=[self.last_failure()[0]],
+                )
+            else:
+                suggestions = self.clean_suggestions(choices[0]['message']['content'].splitlines())
         logging.info(f"Extracted clean suggestions: {suggestions}")
         return suggestions
 
@@ -254,22 +986,32 @@ class ChatCommand:
                 suggestions[i] = ""
 
         for suggestion in suggestions:
-            suggestion = suggestion.strip()
-            if suggestion:
-                if (
-                        suggestion.startswith("```") or
-                        suggestion.startswith("#") or
-                        suggestion.lower() == "or"
-                ):
-                    continue
-
-                # sometimes the model "indexes" the suggestions
-                if not suggestion.startswith("./"):
-                    suggestion = suggestion.lstrip('0123456789. -')
-
+            suggestion = self.clean_suggestion(suggestion)
+            if suggestion is not None:
                 cleaned_suggestions.append(suggestion)
         return cleaned_suggestions
 
+    @staticmethod
+    def clean_suggestion(suggestion):
+        """
+        Cleans a single line of the model's output.
+        :param suggestion:
+        :return: the cleaned suggestion, or None if the line is not a suggestion
+        """
+        suggestion = suggestion.strip()
+        if (
+                not suggestion or
+                suggestion.startswith("```") or
+                suggestion.startswith("#") or
+                suggestion.lower() == "or"
+        ):
+            return None
+
+        # sometimes the model "indexes" the suggestions
+        if not suggestion.startswith("./"):
+            suggestion = suggestion.lstrip('0123456789. -')
+        return suggestion
+
     @staticmethod
     def add_clipboard_content(clipboard):
         if clipboard:
@@ -280,38 +1022,121 @@ class ChatCommand:
             return f"\nClipboard content that might be helpful:\n{clipboard_content}\nend of clipboard content."
         return ""
 
+    @classmethod
+    def reduce_last_output(cls, output, output_file="", note=""):
+        """
+        :param output: the output of the last command
+        :param output_file: the file with the output, read instead of output
+        :param note: such as "stopped after 10 seconds", when the shell stopped rerunning the command
+        :return: the output reduced to the budget, once
+        """
+        if output_file:
+            from output_reducer import reduce_file
+
+            output = reduce_file(output_file)
+        else:
+            output = cls.truncate_output(output)
+        if note:
+            # the same as the note of a context command that was stopped, so the model knows the output is incomplete
+            output += f"\n[{note}, the output is cut short]"
+        return output
+
     @staticmethod
     def truncate_output(output):
-        max_length = 1000
-        if len(output) > max_length:
-            return output[:max_length//2] + "\n...\n" + output[-(max_length//2):]
-        return output
+        from output_reducer import reduce_text
+
+        return reduce_text(output)
+
+    @staticmethod
+    def read_last_chat_output():
+        """
+        Reads the output of the command that `chat` executed last.
+        The shell saves it to a file, older shell sessions may still pass it in the environment.
+        :return:
+        """
+        from output_reducer import reduce_file, reduce_text
+
+        output_file = os.getenv("CHAT_COMMAND_LAST_OUTPUT_FILE")
+        if output_file:
+            return reduce_file(output_file)
+        return reduce_text(os.getenv("CHAT_COMMAND_LAST_OUTPUT", ""))
+
 
+def get_session():
+    """
+    Returns the HTTP session used for the API requests.
+    It is created once per process, so the daemon reuses its keep-alive connections.
+    :return:
+    """
+    global _session
+    if _session is None:
+        import requests
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("command")
-    parser.add_argument("output")
-    parser.add_argument("query", help="Description of what needs to be done (or empty for nothing)")
-    parser.add_argument("clipboard", type=int, choices=[0, 1],
-                        help="Include clipboard content in the prompt for suggestions (0 or 1)")
-    parser.add_argument("with_context", type=int, choices=[0, 1],
-                        help="This is a follow-up request that provides context")
-
-    args = parser.parse_args()
-    # unpack the values
-    args.clipboard = bool(args.clipboard)
-    args.with_context = bool(args.with_context)
-    if args.query == "\"\"":
-        args.query = ""
-
-    chat = ChatCommand(args.command, args.output)
-    if args.with_context:
-        chat.produce_llm_command("received_context")
-    elif args.query:
-        chat.produce_llm_command("suggest_from_text", text=args.query, clipboard=args.clipboard)
+        _session = requests.Session()
+    return _session
+
+
+def main(argv=None):
+    """
+    Single entry point of the chat command: parses the user's arguments and runs the request.
+    The shell passes the last command and its output through the hidden --last_command and --last_output(_file) options.
+    :param argv:
+    :return:
+    """
+    timings = Timings()
+    import argparse
+    from handle_cli_args import build_parser
+
+    parser = build_parser()
+    # the values may start with a dash, so the shell passes them as --option=value
+    parser.add_argument("--last_command", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--last_output", default="", help=argparse.SUPPRESS)
+    # large outputs are passed through a file, as they may not fit into the arguments
+    parser.add_argument("--last_output_file", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--last_status", default="", help=argparse.SUPPRESS)
+    # why the shell stopped rerunning the command before it finished, such as "stopped after 10 seconds"
+    parser.add_argument("--last_output_note", default="", help=argparse.SUPPRESS)
+    # sent by the shell hook in the background when a command fails
+    parser.add_argument("--prefetch", action="store_true", help=argparse.SUPPRESS)
+    # when the shell started chat, $EPOCHREALTIME (its decimal separator depends on the locale)
+    parser.add_argument("--started_at", default="", help=argparse.SUPPRESS)
+    # the aliases and functions defined in the shell, separated by spaces
+    parser.add_argument("--shell_names", default="", help=argparse.SUPPRESS)
+    # where the shell that started chat expects the chosen command
+    parser.add_argument("--result_file", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    try:
+        timings.set_started_at(float(args.started_at.replace(",", ".")))
+    except ValueError:
+        pass
+
+    if args.no_cache:
+        cache_mode = "bypass"
+    elif args.refresh_cache:
+        cache_mode = "refresh"
     else:
-        chat.produce_llm_command("fix_command", clipboard=args.clipboard)
+        cache_mode = "use"
+
+    last_status = int(args.last_status) if args.last_status.lstrip("-").isdigit() else None
+    chat = ChatCommand(
+        args.last_command, args.last_output, cache_mode=cache_mode, last_status=last_status, timings=timings,
+        shell_names=args.shell_names.split(), last_output_file=args.last_output_file,
+        last_output_note=args.last_output_note
+    )
+    if args.result_file:
+        chat.config.result_file_path = args.result_file
+    try:
+        if args.prefetch:
+            chat.prefetch_fix_command()
+        elif args.with_context:
+            chat.produce_llm_command("received_context")
+        elif args.query:
+            chat.produce_llm_command("suggest_from_text", text=args.query, clipboard=args.clipboard)
+        else:
+            chat.produce_llm_command("fix_command", clipboard=args.clipboard)
+    finally:
+        if chat.config.metrics_enabled:
+            write_metrics(chat.config.metrics_file_path, timings.record())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+import chat_command
+from config import Config
+
+# sent by the client when the user presses Ctrl-C while the daemon is handling their request
+INTERRUPT_MESSAGE = b"INT\n"
+MAX_FDS = 3
+
+
+class ChatDaemon:
+    """
+    Long-lived per-user server that runs `chat` requests without starting a new interpreter.
+    The client passes its stdin, stdout and stderr over a Unix socket,
+    so the prompts and the questions to the user are shown in the user's terminal as usual.
+    Requests are handled one at a time, the daemon keeps the HTTP session and the loaded histories warm.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.state_lock = threading.Lock()
+        self.running_request = False
+
+    def serve(self):
+        if is_running(self.socket_path):
+            print("ℹ️ The chat daemon is already running.")
+            return
+        if os.path.exists(self.socket_path):
+            # left over from a daemon that did not shut down cleanly
+            os.unlink(self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the owner may connect, as the requests carry the API key
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(8)
+        signal.signal(signal.SIGINT, self.handle_interrupt)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # establish the session before the first request arrives
+        chat_command.get_session()
+        logging.info(f"Chat daemon listening on {self.socket_path}")
+
+        try:
+            while True:
+                conn, _ = server.accept()
+                with conn:
+                    if not self.handle_connection(conn):
+                        break
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            logging.info("Chat daemon stopped")
+
+    def handle_interrupt(self, signum, frame):
+        # outside of a request, the signal may only come late from a finished request's watcher
+        if self.running_request:
+            raise KeyboardInterrupt
+
+    def handle_connection(self, conn):
+        """
+        Reads a single request from the client and executes it.
+        :param conn:
+        :return: False if the daemon should stop
+        """
+        data, fds, _, _ = socket.recv_fds(conn, 65536, MAX_FDS)
+        while not data.endswith(b"\n"):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        try:
+            if not data.strip():
+                return True
+            request = json.loads(data)
+            if request.get("action") == "stop":
+                conn.sendall(b'{"exit": 0}\n')
+                return False
+            if request.get("action") == "ping":
+                conn.sendall(b'{"exit": 0}\n')
+                return True
+            if len(fds) != MAX_FDS:
+                raise ValueError("the client did not pass its standard streams")
+
+            exit_code = self.run_request(conn, request, fds)
+            fds = []
+            conn.sendall(json.dumps({"exit": exit_code}).encode() + b"\n")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Chat daemon failed to handle a request: {e}")
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return True
+
+    def run_request(self, conn, request, fds):
+        stdin = os.fdopen(fds[0], 'r', encoding='utf-8', errors='replace')
+        stdout = os.fdopen(fds[1], 'w', buffering=1, encoding='utf-8', errors='replace')
+        stderr = os.fdopen(fds[2], 'w', buffering=1, encoding='utf-8', errors='replace')
+        saved_streams = sys.stdin, sys.stdout, sys.stderr
+        saved_environ = dict(os.environ)
+        saved_cwd = os.getcwd()
+
+        watcher = threading.Thread(target=self.watch_client, args=(conn,), daemon=True)
+        exit_code = 0
+        try:
+            # the request should behave exactly as if it was started from the user's shell
+            os.environ.clear()
+            os.environ.update(request.get("env", {}))
+            os.chdir(request.get("cwd", saved_cwd))
+            sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+            with self.state_lock:
+                self.running_request = True
+            watcher.start()
+            chat_command.main(request.get("argv", []))
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except KeyboardInterrupt:
+            print()
+            exit_code = 1
+        except Exception:
+            logging.exception("Request failed inside the chat daemon")
+            print("❌ The chat daemon failed to handle the request, see basic.log for details.", file=stderr)
+            exit_code = 1
+        finally:
+            with self.state_lock:
+                self.running_request = False
+            if watcher.is_alive():
+                # wakes up the watcher, the exit code can still be sent back
+                conn.shutdown(socket.SHUT_RD)
+                watcher.join()
+            sys.stdin, sys.stdout, sys.stderr = saved_streams
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            os.chdir(saved_cwd)
+            for stream in (stdout, stderr, stdin):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        return exit_code
+
+    def watch_client(self, conn):
+        """
+        Interrupts the running request if the user pressed Ctrl-C or the client went away.
+        :param conn:
+        :return:
+        """
+        try:
+            message = conn.recv(len(INTERRUPT_MESSAGE))
+        except OSError:
+            message = b""
+        with self.state_lock:
+            if self.running_request and (message == INTERRUPT_MESSAGE or not message):
+                signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+
+def is_running(socket_path):
+    return send_control(socket_path, "ping")
+
+
+def send_control(socket_path, action):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(json.dumps({"action": action}).encode() + b"\n")
+            return client.recv(64).startswith(b'{"exit": 0}')
+    except OSError:
+        return False
+
+
+def main():
+    action = sys.argv[1] if len(sys.argv) > 1 else "status"
+    socket_path = Config().daemon_socket_path
+
+    if action == "serve":
+        ChatDaemon(socket_path).serve()
+    elif action == "start":
+        if is_running(socket_path):
+            print("ℹ️ The chat daemon is already running.")
+            return
+        subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), "serve"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        print("🚀 Started the chat daemon.")
+    elif action == "stop":
+        if send_control(socket_path, "stop"):
+            print("🛑 Stopped the chat daemon.")
+        else:
+            print("ℹ️ The chat daemon is not running.")
+    elif action == "status":
+        if is_running(socket_path):
+            print(f"✅ The chat daemon is running ({socket_path}).")
+        else:
+            print("ℹ️ The chat daemon is not running.")
+    else:
+        print(f"❌ Unknown action: {action}. Use one of: start, stop, status, serve.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
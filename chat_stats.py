@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import time
+
+from config import BOLD, RESET, METRICS_FILE_NAME
+from metrics import LOG_BACKUPS
+
+INVOCATION_PHASES = ("startup", "config", "history_load", "total")
+REQUEST_PHASES = ("prompt", "environment", "lookup", "ttfb", "network", "parse", "validate", "think")
+# the sources that answer without waiting for the model
+FAST_SOURCES = ("rules", "learned", "cache", "prefetch")
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def read_records(path, since):
+    """
+    :param path: the metrics file, its rotated parts are read as well
+    :param since: epoch seconds, older records are skipped
+    :return: list of the records of the invocations, the oldest first
+    """
+    records = []
+    for part in [f"{path}.{number}" for number in range(LOG_BACKUPS, 0, -1)] + [path]:
+        try:
+            with open(part, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("time", 0) >= since:
+                        records.append(record)
+        except OSError:
+            continue
+    return records
+
+
+def summarize(records):
+    """
+    :param records:
+    :return: dict with the durations of every phase, the number of requests per source and the tokens per model
+    """
+    durations = {phase: [] for phase in INVOCATION_PHASES + REQUEST_PHASES}
+    sources = {}
+    tokens = {}
+    tiers = {}
+    background = 0
+    for record in records:
+        requests = record.get("requests", [])
+        # the prefetches run in the background, nobody waits for them
+        in_background = any(request["type"] == "prefetch" for request in requests)
+        if not in_background:
+            for phase, ms in record.get("phases", {}).items():
+                durations.setdefault(phase, []).append(ms)
+        for request in requests:
+            for phase, ms in request.get("phases", {}).items():
+                durations.setdefault(phase, []).append(ms)
+            if request.get("model"):
+                used = tokens.setdefault(request["model"], {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+                used["requests"] += 1
+                used["prompt_tokens"] += request.get("prompt_tokens", 0)
+                used["completion_tokens"] += request.get("completion_tokens", 0)
+            for tier in request.get("tiers", []):
+                summary = tiers.setdefault(tier["tier"], {"ms": [], "escalations": {}})
+                summary["ms"].append(tier["ms"])
+                if tier.get("escalation"):
+                    # the errors differ in their details
+                    reason = tier["escalation"].split(":")[0]
+                    summary["escalations"][reason] = summary["escalations"].get(reason, 0) + 1
+            if request["type"] == "prefetch":
+                background += 1
+            else:
+                sources[request["source"]] = sources.get(request["source"], 0) + 1
+    return {"durations": durations, "sources": sources, "tokens": tokens, "tiers": tiers, "background": background}
+
+
+def print_summary(summary, invocations, days):
+    requests = sum(summary["sources"].values())
+    print(f"📊 {BOLD}chat in the last {days:g} days{RESET}: {invocations} invocations, {requests} requests")
+    print()
+    print(f"{BOLD}{'phase':<14}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{RESET}")
+    for phase, values in summary["durations"].items():
+        if values:
+            print(f"{phase:<14}{len(values):>8}{percentile(values, 0.5):>10.1f}"
+                  f"{percentile(values, 0.9):>10.1f}{percentile(values, 0.99):>10.1f}")
+    print("(total is the time spent waiting, without the think time)")
+
+    if requests:
+        print()
+        print(f"{BOLD}Where the suggestions came from:{RESET}")
+        for source, count in sorted(summary["sources"].items(), key=lambda item: -item[1]):
+            print(f"  {source:<10}{count:>6} ({count / requests:.0%})")
+        cache_hits = summary["sources"].get("cache", 0)
+        fast = sum(summary["sources"].get(source, 0) for source in FAST_SOURCES)
+        print(f"Cache hit rate: {cache_hits / requests:.0%}, fast path rate: {fast / requests:.0%}")
+    if summary["background"]:
+        print(f"Background prefetches: {summary['background']}")
+
+    if summary["tiers"]:
+        print()
+        print(f"{BOLD}{'model tier':<14}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'escalated':>11}{RESET}")
+        for tier, values in sorted(summary["tiers"].items()):
+            escalated = sum(values["escalations"].values())
+            reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(values["escalations"].items()))
+            print(f"{tier:<14}{len(values['ms']):>8}{percentile(values['ms'], 0.5):>10.1f}"
+                  f"{percentile(values['ms'], 0.9):>10.1f}{escalated / len(values['ms']):>11.0%}"
+                  + (f"  ({reasons})" if reasons else ""))
+
+    if summary["tokens"]:
+        print()
+        print(f"{BOLD}Tokens per model:{RESET}")
+        for model, used in sorted(summary["tokens"].items()):
+            print(f"  {model}: {used['requests']} requests, {used['prompt_tokens']} prompt "
+                  f"and {used['completion_tokens']} completion tokens")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="chatStats", description="Show how long the phases of the chat requests took, and where the time went."
+    )
+    parser.add_argument("--days", type=float, default=7, help="Only the requests of this many last days. Defaults to 7")
+    args = parser.parse_args()
+
+    path = os.path.join(os.getenv("CHAT_COMMAND_PATH", ""), METRICS_FILE_NAME)
+    records = read_records(path, time.time() - args.days * 24 * 60 * 60)
+    if not records:
+        print(f"ℹ️ No requests were recorded in the last {args.days:g} days.")
+        return
+    print_summary(summarize(records), len(records), args.days)
+
+
+if __name__ == "__main__":
+    main()
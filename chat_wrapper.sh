@@ -1,25 +1,17 @@
 function chat() {
-    contains_help_flag() {
-        for arg in "$@"; do
-            if [[ "$arg" == "-h" || "$arg" == "--help" ]]; then
-                return 0  # True, help flag found
-            fi
-        done
-        return 1  # False, help flag not found
-    }
     # Check if the help option is present
-    if contains_help_flag "$@"; then
-        # Display the help message (not let it get consumed by bash)
-        $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/handle_cli_args.py "$@"
-        return
-    else
-        # delegate argument parsing to an actual programming language
-        all_args=$($CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/handle_cli_args.py "$@")
-        # Set IFS to tab to split the output properly (newline just refuses to work for some reason)
-        IFS=$'\t'
-        # Read the output into separate variables
-        read -r query clipboard no_exec with_context <<< "$all_args"
-    fi
+    local no_exec=false
+    for arg in "$@"; do
+        if [[ "$arg" == "-h" || "$arg" == "--help" ]]; then
+            # Display the help message (not let it get consumed by bash)
+            $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat.py "$@"
+            return
+        fi
+        # the rest of the arguments is parsed by Python, but rerunning happens before it starts
+        if [[ "$arg" == "--no_rerun" || "$arg" =~ ^-[a-zA-Z]*n[a-zA-Z]*$ ]]; then
+            no_exec=true
+        fi
+    done
 
     # find the most recent non-chat command
     local command_found=false
@@ -36,10 +28,29 @@ function chat() {
         ((i++))
     done
 
-    local output="<output is not available>"
+    # the files of this shell, so that chat can run in several terminals at once
+    local session_dir
+    session_dir=$(__chat_session_dir)
+
+    # the output is passed to Python as an option: the text itself, or the file it was saved to
+    local output_option="--last_output=<output is not available>"
+    local rerun_output_file="$session_dir/rerun_output"
+    local status_option="--last_status="
+    # why the rerun was stopped before the command finished, if it was
+    local note_option="--last_output_note="
+
+    # the output recorded by chatCapture, if it belongs to this command
+    local recorded_command=""
+    if [[ -f "$session_dir/command" && -f "$session_dir/output" ]]; then
+        recorded_command=$(< "$session_dir/command")
+    fi
 
     if ! $command_found; then
         echo "⏭️ No non-chat command found in the last 3 commands."
+    elif [[ -n "$recorded_command" && "$recorded_command" == "$last_command" ]]; then
+        echo "📼 Using the recorded output of: $last_command"
+        output_option="--last_output_file=$session_dir/output"
+        status_option="--last_status=$(< "$session_dir/status")"
     # Check if the last command is the same as the last command suggested and executed by 'chat',
     # and it is not run often (more than once in the last 5 commands).
     # Then, we can skip it
@@ -51,27 +62,48 @@ function chat() {
 
         if [[ $count == 1 ]]; then
             echo "⏭️ This command was the last executed by 'chat', skipping rerun."
-            local output=""
+            output_option="--last_output="
         else
             if ! $no_exec; then
                 echo "🔄 This command was executed $count times in the last 5 commands, rerunning."
-                local output=$(eval "$last_command" 2>&1)
+                __chat_rerun "$last_command" "$rerun_output_file"
+                output_option="--last_output_file=$rerun_output_file"
+                note_option="--last_output_note=$(< "$rerun_output_file.note")"
             fi
         fi
     else
         # skip this if flag -n is passed
         if ! $no_exec; then
             echo "🔄 Rerunning: $last_command"
-            # Execute the last command and capture both stdout and stderr
-            local output=$(eval "$last_command" 2>&1)
+            # Execute the last command (in a subshell, as before) and capture both stdout and stderr
+            __chat_rerun "$last_command" "$rerun_output_file"
+            output_option="--last_output_file=$rerun_output_file"
+            note_option="--last_output_note=$(< "$rerun_output_file.note")"
         fi
     fi
 
+    # the aliases and functions of this shell are valid commands too, but Python cannot see them
+    local shell_names
+    if [[ -n $ZSH_VERSION ]]; then
+        shell_names="${(k)aliases} ${(k)functions}"
+    else
+        shell_names=$(compgen -a -A function | tr '\n' ' ')
+    fi
+
+    # Python renames the chosen command into this file when it is written completely
+    local command_file_path="$session_dir/command_to_execute"
+    rm -f "$command_file_path"
+
     # Pass all arguments to the Python script along with last command and its output
-    $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat_command.py "$last_command" "$output" "$query" "$clipboard" "$with_context"
+    # (as --option=value, since they may start with a dash)
+    if [[ -S "$CHAT_COMMAND_PATH/daemon.sock" ]]; then
+        # the daemon is (probably) running, the client falls back to chat.py if it is not
+        $CHAT_COMMAND_PYTHON -S "$CHAT_COMMAND_PATH"/chat_client.py --last_command="$last_command" "$output_option" "$status_option" "$note_option" --started_at="$EPOCHREALTIME" --shell_names="$shell_names" --result_file="$command_file_path" "$@"
+    else
+        $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat.py --last_command="$last_command" "$output_option" "$status_option" "$note_option" --started_at="$EPOCHREALTIME" --shell_names="$shell_names" --result_file="$command_file_path" "$@"
+    fi
 
     # get the command to be executed from the file
-    local command_file_path="$CHAT_COMMAND_PATH/command_to_execute.txt"
     if [[ -s "$command_file_path" ]]; then
         # Open the file descriptor (using descriptor 3 as its right after the standard ones)
         exec 3< "$command_file_path"
@@ -80,9 +112,6 @@ function chat() {
         # Read the conversation id from the second line (can be used by next requests in this session)
         export CHAT_COMMAND_CONV_ID=""
         read -r CHAT_COMMAND_CONV_ID <&3
-        # Read whether the command is for context or not
-        local command_context_flag
-        read -r command_context_flag <&3
         # Close the file descriptor
         exec 3<&-
 
@@ -95,30 +124,118 @@ function chat() {
             history -s "$command"
         fi
 
-        eval "$command" | tee /tmp/chat_command_output.txt
+        eval "$command" | tee "$session_dir/chat_output"
         export CHAT_COMMAND_LAST_COMMAND="$command"
-        export CHAT_COMMAND_LAST_OUTPUT=$(col -b < /tmp/chat_command_output.txt)
+        # Python reads and cleans up the output itself, it may be too large for an environment variable
+        export CHAT_COMMAND_LAST_OUTPUT_FILE="$session_dir/chat_output"
+        unset CHAT_COMMAND_LAST_OUTPUT
 
-        # its single use
+        # its single use (the context commands were already run by chat itself)
         rm -f "$command_file_path"
-
-        if [[ "$command_context_flag" -eq 1 ]]; then
-            # the previous command was for context, so once it was obtained,
-            # we can save the user calling chat again.
-            # The environment variables will allow chat to see the result.
-            echo "📝 Context obtained, calling chat again."
-            chat -n --with_context
-        fi
     else
         echo "❌ No command to execute."
     fi
 }
 
+function __chat_session_dir() {
+    # the directory of the files of this shell, created on the first use
+    local session_dir="$CHAT_COMMAND_PATH/sessions/$$"
+    if [[ ! -d "$session_dir" ]]; then
+        mkdir -p "$session_dir"
+        # clean up after the shells that are gone
+        local old_session_dir
+        for old_session_dir in "$CHAT_COMMAND_PATH"/sessions/*; do
+            if [[ -d "$old_session_dir" ]] && ! kill -0 "${old_session_dir##*/}" 2>/dev/null; then
+                rm -rf "$old_session_dir"
+            fi
+        done
+    fi
+    echo "$session_dir"
+}
+
+function __chat_milliseconds() {
+    # Sets REPLY to the seconds given like 10 or 2.5 (or $EPOCHREALTIME) in whole milliseconds, without a subshell
+    local whole="${1%%[.,]*}" fraction="${1#*[.,]}"
+    [[ "$fraction" == "$1" ]] && fraction=""
+    fraction="${fraction}000"
+    REPLY=$(( ${whole:-0} * 1000 + 10#${fraction:0:3} ))
+}
+
+function __chat_kill_tree() {
+    # Stops the process and everything it started: first held, so that it starts nothing new meanwhile
+    local child
+    kill -STOP "$1" 2>/dev/null
+    for child in $(pgrep -P "$1" 2>/dev/null); do
+        __chat_kill_tree "$child"
+    done
+    kill -TERM "$1" 2>/dev/null
+    kill -CONT "$1" 2>/dev/null
+}
+
+function __chat_rerun() {
+    # Reruns the command like `(eval "$1") > "$2" 2>&1`, but a hung or endless command does not keep chat
+    # from the model: it is stopped after CHAT_COMMAND_RERUN_TIMEOUT seconds, once its output reaches
+    # CHAT_COMMAND_RERUN_MAX_BYTES, or on Ctrl-C. Why it was stopped is written to "$2.note"
+    local timeout="${CHAT_COMMAND_RERUN_TIMEOUT:-10}"
+    local max_bytes="${CHAT_COMMAND_RERUN_MAX_BYTES:-1048576}"
+    local REPLY deadline
+    : > "$2"; : > "$2.note"
+    # measured on the clock rather than by counting the ticks, which run late when the machine is busy
+    # ($SECONDS is only exact to a second, for a bash older than 5.0)
+    __chat_milliseconds "$timeout"
+    deadline=$REPLY
+    __chat_milliseconds "${EPOCHREALTIME:-$SECONDS}"
+    (( deadline += REPLY ))
+    (
+        # the command gets its own process group, so that everything it started is stopped together,
+        # and Ctrl-C only reaches this loop
+        set -m 2>/dev/null
+        # written as it comes, nothing past the limit, and the command gets SIGPIPE on its next write.
+        # Reaching the limit is told by the note that output_reducer.py writes
+        { (eval "$1") < /dev/null 2>&1 | $CHAT_COMMAND_PYTHON -S "$CHAT_COMMAND_PATH"/output_reducer.py "$2" "$max_bytes"; } 2>/dev/null &
+        local pid=$! note=""
+        # the checks below stay in the foreground process group
+        set +m 2>/dev/null
+        trap 'note="interrupted with Ctrl-C"' INT
+        # only builtins besides the sleep
+        while [[ -z "$note" && ! -s "$2.note" ]] && kill -0 "$pid" 2>/dev/null; do
+            __chat_milliseconds "${EPOCHREALTIME:-$SECONDS}"
+            if (( REPLY >= deadline )); then
+                note="stopped after $timeout seconds"
+            else
+                sleep 0.05
+            fi
+        done
+        # also when the command ended on its own right after the limit
+        if [[ -z "$note" && -s "$2.note" ]]; then
+            note="$(< "$2.note")"
+        fi
+        if [[ -n "$note" ]]; then
+            if kill -0 -- -"$pid" 2>/dev/null; then
+                kill -TERM -- -"$pid" 2>/dev/null
+                kill -CONT -- -"$pid" 2>/dev/null
+            else
+                # without job control (zsh may refuse it in a subshell) the command has no process group
+                # of its own, the processes it started are looked up one by one
+                __chat_kill_tree "$pid"
+            fi
+            echo "⏱️ The rerun was $note, the output is cut short."
+            echo "$note" > "$2.note"
+        fi
+    )
+}
+
+function __chat_conversation_id() {
+    # the same as new_conversation_id in config.py: the start time and a random part
+    printf '%s-%04x%04x' "$(date +%s)" $RANDOM $RANDOM
+}
+
 function chatNewSession() {
     # Start a new session by removing the conversation id
     export CHAT_COMMAND_CONV_ID=""
     export CHAT_COMMAND_LAST_COMMAND=""
     export CHAT_COMMAND_LAST_OUTPUT=""
+    export CHAT_COMMAND_LAST_OUTPUT_FILE=""
     echo "♻️ Started a new chat session."
 }
 
@@ -126,7 +243,264 @@ function chatInstall() {
     $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/quick_install.py
 }
 
+function chatDaemon() {
+    # Manage the optional background process that keeps chat warm between calls (start/stop/status)
+    $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat_daemon.py "$@"
+}
+
+function chatBatch() {
+    # Suggestions for a JSON lines file of failed commands or queries, without any interaction
+    $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat_batch.py "$@"
+}
+
+function chatStats() {
+    # Percentiles of the time every phase of the requests took, and how often the model was not needed
+    $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat_stats.py "$@"
+}
+
 function chatHistory() {
-    less <<< "$(eval "$CHAT_COMMAND_PYTHON $CHAT_COMMAND_PATH/read_history.py")"
+    # the current conversation, or the past messages that match chatHistory --search "words"
+    less -R <<< "$($CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/read_history.py "$@")"
 }
 
+
+# Opt-in recording of the output of every command, so that `chat` does not have to rerun it.
+# Enable with `chatCapture on` or by setting CHAT_COMMAND_CAPTURE=1 before this file is sourced.
+# The commands that run a program from CHAT_COMMAND_CAPTURE_SKIP (interactive programs that need a terminal)
+# are not recorded, as a recorded command writes into a pipe instead of the terminal.
+CHAT_COMMAND_CAPTURE_SKIP_DEFAULT="chat chatHistory vim vi nvim nano emacs less more man top htop watch ssh tmux screen"
+CHAT_COMMAND_CAPTURE_SKIP_DEFAULT+=" python python3 ipython node irb psql mysql sqlite3 bash zsh sh fzf"
+
+function __chat_capture_preexec() {
+    # zsh passes the command line, bash reads it from the history
+    local command_line="$1"
+    if [[ -z "$command_line" ]]; then
+        command_line=$(HISTTIMEFORMAT='' builtin history 1)
+        command_line="${command_line#*[0-9]  }"
+    fi
+    local capture_dir="$CHAT_COMMAND_PATH/sessions/$$"
+
+    # the previous command has finished for sure, keep only the end of its output
+    __chat_capture_trim "$capture_dir" preexec
+
+    local program="${command_line%% *}"
+    # the fix prepared in the background is for the previous command
+    if [[ "$program" != chat* ]]; then
+        __chat_prefetch_cancel
+    fi
+    if __chat_capture_needs_tty "$command_line"; then
+        return
+    fi
+
+    # keep the terminal's descriptors to restore them after the command, and copy the output to a file
+    # that keeps only about the last CHAT_COMMAND_CAPTURE_MAX_BYTES, even while the command runs
+    local record=($CHAT_COMMAND_PYTHON -S "$CHAT_COMMAND_PATH"/output_reducer.py --record
+                  "$capture_dir/output.partial" "${CHAT_COMMAND_CAPTURE_MAX_BYTES:-65536}")
+    # created right away, a command without output has an empty one
+    : > "$capture_dir/output.partial"
+    exec {__chat_capture_stdout}>&1 {__chat_capture_stderr}>&2
+    exec > >(tee >("${record[@]}")) 2> >(tee >("${record[@]}") >&2)
+}
+
+function __chat_capture_needs_tty() {
+    # whether the command line runs a program from CHAT_COMMAND_CAPTURE_SKIP anywhere in its pipelines and lists,
+    # also after sudo, env, time and the like
+    local skip=" ${CHAT_COMMAND_CAPTURE_SKIP:-$CHAT_COMMAND_CAPTURE_SKIP_DEFAULT} "
+    local line="${1//|/ | }"
+    line="${line//;/ ; }"
+    line="${line//&/ & }"
+    line="${line//(/ ( }"
+    line="${line//)/ ) }"
+    local -a words
+    if [[ -n $ZSH_VERSION ]]; then
+        read -r -A words <<< "$line"
+    else
+        read -r -a words <<< "$line"
+    fi
+    local word at_start=1
+    for word in "${words[@]}"; do
+        case "$word" in
+            "|"|"&"|";"|"("|")"|"{"|"}"|"!"|then|do|else)
+                at_start=1
+                ;;
+            *)
+                if (( at_start )); then
+                    case "$word" in
+                        # the variable assignments, the wrappers and their options come before the program
+                        *=*|-*|sudo|doas|env|time|nohup|nice|command|exec|builtin|stdbuf) ;;
+                        *)
+                            if [[ "$skip" == *" ${word##*/} "* ]]; then
+                                return 0
+                            fi
+                            at_start=0
+                            ;;
+                    esac
+                fi
+                ;;
+        esac
+    done
+    return 1
+}
+
+function __chat_capture_precmd() {
+    local exit_code=$?
+    if [[ -z "$__chat_capture_stdout" ]]; then
+        return $exit_code
+    fi
+    exec 1>&$__chat_capture_stdout 2>&$__chat_capture_stderr
+    exec {__chat_capture_stdout}>&- {__chat_capture_stderr}>&-
+    unset __chat_capture_stdout __chat_capture_stderr
+
+    local capture_dir="$CHAT_COMMAND_PATH/sessions/$$"
+    # fc would skip the current line when called from PROMPT_COMMAND, history does not
+    local command_line
+    if [[ -n $ZSH_VERSION ]]; then
+        command_line=$(fc -ln -1 -1)
+    else
+        command_line=$(HISTTIMEFORMAT='' builtin history 1)
+        command_line="${command_line#*[0-9]  }"
+    fi
+    # trim the whitespaces the same way as `chat` does
+    command_line="${command_line#"${command_line%%[![:space:]]*}"}"
+    command_line="${command_line%"${command_line##*[![:space:]]}"}"
+    # tee may still be writing, but it keeps writing to the renamed file
+    mv -f "$capture_dir/output.partial" "$capture_dir/output.raw" 2>/dev/null
+    rm -f "$capture_dir/output"
+    printf '%s' "$command_line" > "$capture_dir/command"
+    printf '%s' "$exit_code" > "$capture_dir/status"
+    printf '%s' "$PWD" > "$capture_dir/cwd"
+    # 130 is Ctrl-C, the user stopped the command on purpose
+    if [[ "$CHAT_COMMAND_PREFETCH" == 1 && $exit_code -ne 0 && $exit_code -ne 130 ]]; then
+        __chat_prefetch_start "$command_line" "$exit_code"
+    fi
+    return $exit_code
+}
+
+function __chat_capture_trim() {
+    # moving the file first makes sure that only one of the concurrent callers trims it
+    local capture_dir="$1"
+    if mv "$capture_dir/output.raw" "$capture_dir/output.$2" 2>/dev/null; then
+        tail -c "${CHAT_COMMAND_CAPTURE_MAX_BYTES:-65536}" "$capture_dir/output.$2" > "$capture_dir/output.$2.tmp"
+        mv -f "$capture_dir/output.$2.tmp" "$capture_dir/output"
+        rm -f "$capture_dir/output.$2"
+    fi
+}
+
+function __chat_prefetch_start() {
+    local capture_dir="$CHAT_COMMAND_PATH/sessions/$$"
+    # the suggestions are kept under the conversation that the next chat continues
+    if [[ -z "$CHAT_COMMAND_CONV_ID" ]]; then
+        export CHAT_COMMAND_CONV_ID=$(__chat_conversation_id)
+    fi
+    # started from a subshell, the job does not show up in the shell's job list
+    (
+        (
+            (
+                # give tee a moment to write the end of the output
+                sleep 0.1
+                __chat_capture_trim "$capture_dir" prefetch
+                exec $CHAT_COMMAND_PYTHON "$CHAT_COMMAND_PATH"/chat.py --prefetch --last_command="$1" \
+                    --last_output_file="$capture_dir/output" --last_status="$2"
+            ) &
+            local pid=$!
+            echo "$pid" > "$capture_dir/prefetch.pid"
+            wait "$pid"
+            # the pid file is there only while the prefetch runs, its pid may be reused by another process later
+            if [[ "$(< "$capture_dir/prefetch.pid")" == "$pid" ]]; then
+                rm -f "$capture_dir/prefetch.pid"
+            fi
+        ) > /dev/null 2>&1 < /dev/null &
+    )
+}
+
+function __chat_prefetch_cancel() {
+    local pid_file="$CHAT_COMMAND_PATH/sessions/$$/prefetch.pid"
+    if [[ -f "$pid_file" ]]; then
+        # a prefetch that has finished keeps its suggestions, chat only uses them for the same command
+        if kill "$(< "$pid_file")" 2>/dev/null; then
+            rm -f "$CHAT_COMMAND_PATH/chat_history/$CHAT_COMMAND_CONV_ID.prefetch.json"
+        fi
+        rm -f "$pid_file"
+    fi
+}
+
+function __chat_capture_debug_trap() {
+    # bash runs the DEBUG trap before every simple command, only the first one after the prompt is relevant
+    local status=$?
+    if [[ -n "$__chat_capture_at_prompt" && -z "$COMP_LINE" ]]; then
+        __chat_capture_at_prompt=""
+        __chat_capture_preexec
+    fi
+    # the DEBUG trap that was there before runs right after this one, with the same $?
+    return $status
+}
+
+function chatCapture() {
+    local capture_dir="$CHAT_COMMAND_PATH/sessions/$$"
+    case "$1" in
+        on)
+            __chat_session_dir > /dev/null
+            if [[ -n $ZSH_VERSION ]]; then
+                autoload -Uz add-zsh-hook
+                add-zsh-hook preexec __chat_capture_preexec
+                add-zsh-hook precmd __chat_capture_precmd
+            elif [[ "$PROMPT_COMMAND" != *__chat_capture_precmd* ]]; then
+                # the precmd hook has to run first to see the exit code, and the prompt flag has to be set last
+                PROMPT_COMMAND=$'__chat_capture_precmd\n'"$PROMPT_COMMAND"$'\n__chat_capture_at_prompt=1'
+                # the user's own DEBUG trap keeps running after ours, and is restored by chatCapture off
+                __chat_capture_previous_trap=$(trap -p DEBUG)
+                local previous_command=""
+                if [[ -n "$__chat_capture_previous_trap" ]]; then
+                    eval "set -- $__chat_capture_previous_trap"
+                    previous_command="$3"
+                fi
+                trap "__chat_capture_debug_trap${previous_command:+; $previous_command}" DEBUG
+            fi
+            export CHAT_COMMAND_CAPTURE=1
+            echo "📼 Recording command outputs, chat will not need to rerun them."
+            ;;
+        off)
+            if [[ -n $ZSH_VERSION ]]; then
+                add-zsh-hook -d preexec __chat_capture_preexec
+                add-zsh-hook -d precmd __chat_capture_precmd
+            else
+                PROMPT_COMMAND="${PROMPT_COMMAND#__chat_capture_precmd$'\n'}"
+                PROMPT_COMMAND="${PROMPT_COMMAND%$'\n'__chat_capture_at_prompt=1}"
+                # unless the trap was replaced since
+                if [[ "$(trap -p DEBUG)" == *__chat_capture_debug_trap* ]]; then
+                    if [[ -n "$__chat_capture_previous_trap" ]]; then
+                        eval "$__chat_capture_previous_trap"
+                    else
+                        trap - DEBUG
+                    fi
+                fi
+                unset __chat_capture_previous_trap
+            fi
+            # the rest of the session's files are still used by chat
+            rm -f "$capture_dir"/{command,status,cwd,output,output.partial,output.raw,prefetch.pid}
+            export CHAT_COMMAND_CAPTURE=0
+            echo "⏹️ Stopped recording command outputs."
+            ;;
+        *)
+            if [[ "$CHAT_COMMAND_CAPTURE" == 1 ]]; then
+                echo "📼 Command outputs are being recorded (chatCapture off to stop)."
+            else
+                echo "ℹ️ Command outputs are not recorded (chatCapture on to start)."
+            fi
+            ;;
+    esac
+}
+
+if [[ -z $ZSH_VERSION ]]; then
+    # bash hides the DEBUG trap inside functions, unless they have the trace attribute
+    declare -ft chatCapture
+fi
+
+if [[ "$CHAT_COMMAND_CAPTURE" == 1 ]]; then
+    chatCapture on > /dev/null
+fi
+
+# $EPOCHREALTIME tells chat when it was started, bash has it since 5.0
+if [[ -n $ZSH_VERSION ]]; then
+    zmodload zsh/datetime 2>/dev/null
+fi
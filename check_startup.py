@@ -0,0 +1,67 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# these are only needed once a request is actually sent, so they must not be imported at startup
+LAZY_MODULES = ("requests", "urllib3", "ssl", "http.client", "pickle", "argparse", "examples")
+DEFAULT_BUDGET_MS = 30
+
+
+def measure_import(module, runs):
+    """
+    Imports the module in fresh interpreters with `-X importtime`.
+    :param module:
+    :param runs:
+    :return: the fastest cumulative import time in milliseconds, and the names of all imported modules
+    """
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    best = None
+    imported = set()
+    with tempfile.TemporaryDirectory() as chat_command_path:
+        env = dict(os.environ, CHAT_COMMAND_PATH=chat_command_path)
+        for _ in range(runs):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=script_dir, env=env, capture_output=True, text=True, check=True,
+            )
+            for line in result.stderr.splitlines():
+                # import time: self [us] | cumulative | imported package
+                if not line.startswith("import time:") or "|" not in line:
+                    continue
+                _, cumulative, name = line.split("|")
+                if not cumulative.strip().isdigit():
+                    continue
+                imported.add(name.strip())
+                if name.strip() == module:
+                    elapsed = int(cumulative) / 1000
+                    best = elapsed if best is None else min(best, elapsed)
+    return best, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that `chat` starts within the time budget.")
+    parser.add_argument("--budget_ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="Maximum time to import the chat command module")
+    parser.add_argument("--runs", type=int, default=5, help="The fastest of this many runs is used")
+    args = parser.parse_args()
+
+    elapsed, imported = measure_import("chat_command", args.runs)
+    eager = sorted(module for module in LAZY_MODULES if module in imported)
+
+    print(f"⏱️ Importing chat_command takes {elapsed:.1f} ms (budget {args.budget_ms:.1f} ms).")
+    failed = False
+    if elapsed > args.budget_ms:
+        print("❌ Startup is over budget.")
+        failed = True
+    if eager:
+        print(f"❌ Modules that should be imported lazily are loaded at startup: {', '.join(eager)}")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("✅ Startup is within budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,11 @@ BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
 RESET = '\033[0m'
 
+DAEMON_SOCKET_NAME = 'daemon.sock'
+METRICS_FILE_NAME = 'metrics.jsonl'
+HISTORY_DIR_NAME = 'chat_history'
+HISTORY_INDEX_FILE_NAME = 'history_index.db'
+
 
 class Config:
     def __init__(self):
@@ -27,19 +32,73 @@ class Config:
 
         self.api_url = os.getenv("CHAT_COMMAND_API_URL", "https://api.openai.com/v1/chat/completions")
         self.model = os.getenv("CHAT_COMMAND_MODEL", "gpt-4o-mini")
+        self.stream = os.getenv("CHAT_COMMAND_STREAM", "0") == "1"
+        self.candidates = int(os.getenv("CHAT_COMMAND_CANDIDATES", 1))
 
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
 
+        # a small model that is asked first, the one above only when its answer is not good enough
+        self.local_api_url = os.getenv("CHAT_COMMAND_LOCAL_API_URL", "")
+        self.local_model = os.getenv("CHAT_COMMAND_LOCAL_MODEL", "local")
+        self.local_timeout = float(os.getenv("CHAT_COMMAND_LOCAL_TIMEOUT", 10))
+        self.local_headers = {
+            "Authorization": f"Bearer {os.getenv('CHAT_COMMAND_LOCAL_API_KEY', 'none')}",
+            "Content-Type": "application/json"
+        }
+
+        # the endpoints to choose from, the configured one by default
+        self.endpoints = parse_endpoints(os.getenv("CHAT_COMMAND_ENDPOINTS", ""), self.api_url, self.model, self.api_key)
+        self.router_file_path = os.path.join(self.path, "endpoints.json")
+
+        # the shell passes a file of its own with --result_file, this one is for the older shell functions
         self.result_file_path = os.path.join(self.path, 'command_to_execute.txt')
-        self.conv_id = os.getenv("CHAT_COMMAND_CONV_ID")
-        if not self.conv_id:
-            # also updates the value if its empty string
-            self.conv_id = time.time()
-        self.conv_id = int(self.conv_id)
-        self.history_file_path = os.path.join(self.path, "chat_history", f"{self.conv_id}.pkl")
+        # also replaces the empty string
+        self.conv_id = os.getenv("CHAT_COMMAND_CONV_ID") or new_conversation_id()
+        self.history_dir = os.path.join(self.path, HISTORY_DIR_NAME)
+        self.history_file_path = os.path.join(self.history_dir, f"{self.conv_id}.jsonl")
+        self.summary_file_path = os.path.join(self.history_dir, f"{self.conv_id}.summary.json")
+        self.history_index_path = os.path.join(self.path, HISTORY_INDEX_FILE_NAME)
+        self.context_tokens = int(os.getenv("CHAT_COMMAND_CONTEXT_TOKENS", 4000))
+        self.history_max_age_days = float(os.getenv("CHAT_COMMAND_HISTORY_MAX_AGE_DAYS", 30))
+        self.history_max_bytes = int(float(os.getenv("CHAT_COMMAND_HISTORY_MAX_MB", 50)) * 1024 * 1024)
+        self.daemon_socket_path = os.path.join(self.path, DAEMON_SOCKET_NAME)
+
+        self.connect_timeout = float(os.getenv("CHAT_COMMAND_CONNECT_TIMEOUT", 5))
+        self.read_timeout = float(os.getenv("CHAT_COMMAND_READ_TIMEOUT", 60))
+        self.retries = int(os.getenv("CHAT_COMMAND_RETRIES", 2))
+        self.hedge_percentile = float(os.getenv("CHAT_COMMAND_HEDGE_PERCENTILE", 0))
+        self.latency_file_path = os.path.join(self.path, "latency.json")
+
+        self.cache_enabled = os.getenv("CHAT_COMMAND_CACHE", "1") == "1"
+        self.cache_ttl = int(os.getenv("CHAT_COMMAND_CACHE_TTL", 7 * 24 * 60 * 60))
+        self.cache_size = int(os.getenv("CHAT_COMMAND_CACHE_SIZE", 1000))
+        self.cache_file_path = os.path.join(self.path, "response_cache.db")
+
+        self.rules_enabled = os.getenv("CHAT_COMMAND_RULES", "1") == "1"
+        self.rules_dir = os.path.join(self.path, "rules")
+
+        self.learning_enabled = os.getenv("CHAT_COMMAND_LEARN", "1") == "1"
+        self.learned_file_path = os.path.join(self.path, "learned_fixes.db")
+        self.learned_size = int(os.getenv("CHAT_COMMAND_LEARNED_SIZE", 2000))
+        self.learned_max_age_days = float(os.getenv("CHAT_COMMAND_LEARNED_MAX_AGE_DAYS", 180))
+        self.learned_threshold = float(os.getenv("CHAT_COMMAND_LEARNED_THRESHOLD", 0.8))
+
+        self.context_timeout = float(os.getenv("CHAT_COMMAND_CONTEXT_TIMEOUT", 10))
+        self.context_max_bytes = int(os.getenv("CHAT_COMMAND_CONTEXT_MAX_BYTES", 1024 * 1024))
+        self.environment_bytes = int(os.getenv("CHAT_COMMAND_ENVIRONMENT_BYTES", 1500))
+        self.environment_file_path = os.path.join(self.path, "environment.json")
+        self.path_index_file_path = os.path.join(self.path, "path_index.json")
+        self.validate = os.getenv("CHAT_COMMAND_VALIDATE", "1") == "1"
+
+        self.prefetch_file_path = os.path.join(self.history_dir, f"{self.conv_id}.prefetch.json")
+        self.prefetch_rate_file_path = os.path.join(self.path, "prefetch_times.json")
+        self.prefetch_per_minute = int(os.getenv("CHAT_COMMAND_PREFETCH_PER_MINUTE", 3))
+
+        self.metrics_enabled = os.getenv("CHAT_COMMAND_METRICS", "1") == "1"
+        self.metrics_file_path = os.path.join(self.path, METRICS_FILE_NAME)
 
     @staticmethod
     def configuration_help_string():
@@ -56,4 +115,99 @@ class Config:
             f"  - {BOLD}CHAT_COMMAND_MODEL{RESET}: The model used for completion. Defaults to \"gpt-4o-mini\"\n"
             f"  - {BOLD}CHAT_COMMAND_PATH{RESET}: The file path for storing chat command data. "
             f"By default, is set to \"~/.chat_command\" during installation.\n"
+            f"  - {BOLD}CHAT_COMMAND_ENDPOINTS{RESET}: Several endpoints to choose from, separated by semicolons. "
+            f"Every one is \"URL [MODEL [API_KEY_VARIABLE]]\", the model and the key default to the ones above. "
+            f"Every request goes to the fastest endpoint that works, and fails over to the next one. "
+            f"Defaults to the single endpoint above\n"
+            f"  - {BOLD}CHAT_COMMAND_LOCAL_API_URL{RESET}: An OpenAI-compatible endpoint of a small local model "
+            f"(e.g. a llama.cpp server at \"http://localhost:8080/v1/chat/completions\") that is asked first. "
+            f"The model above is only asked when the local answer is empty, cannot run here, asks for context "
+            f"too often, or you reject it. Not set by default\n"
+            f"  - {BOLD}CHAT_COMMAND_LOCAL_MODEL{RESET}, {BOLD}CHAT_COMMAND_LOCAL_API_KEY{RESET}, "
+            f"{BOLD}CHAT_COMMAND_LOCAL_TIMEOUT{RESET}: The name of the local model, the key of its endpoint "
+            f"and the seconds to wait for its response. Default to \"local\", none and 10\n"
+            f"  - {BOLD}CHAT_COMMAND_STREAM{RESET}: Set to 1 to stream the response and show each suggestion "
+            f"as soon as it is generated. Defaults to 0\n"
+            f"  - {BOLD}CHAT_COMMAND_CANDIDATES{RESET}: How many completions to request at once. Their suggestions "
+            f"are pooled, the duplicates are merged and the most agreed on are shown first. "
+            f"Not used when streaming. Defaults to 1\n"
+            f"  - {BOLD}CHAT_COMMAND_CONTEXT_TOKENS{RESET}: Approximate token budget of a request. "
+            f"Older parts of long conversations are summarized to fit. Defaults to 4000\n"
+            f"  - {BOLD}CHAT_COMMAND_HISTORY_MAX_AGE_DAYS{RESET}, {BOLD}CHAT_COMMAND_HISTORY_MAX_MB{RESET}: "
+            f"Older conversations are deleted, as well as the oldest ones above the total size. "
+            f"Default to 30 days and 50 MB\n"
+            f"  - {BOLD}CHAT_COMMAND_CONNECT_TIMEOUT{RESET}, {BOLD}CHAT_COMMAND_READ_TIMEOUT{RESET}: "
+            f"Seconds to wait for the connection and for the response data. Default to 5 and 60\n"
+            f"  - {BOLD}CHAT_COMMAND_RETRIES{RESET}: How many times a failed or rate limited request is retried. "
+            f"Defaults to 2\n"
+            f"  - {BOLD}CHAT_COMMAND_HEDGE_PERCENTILE{RESET}: If set (e.g. to 95), a duplicate request is sent "
+            f"when the first one is slower than this percentile of the recent requests. Disabled by default\n"
+            f"  - {BOLD}CHAT_COMMAND_CACHE{RESET}: Set to 0 to never reuse the suggestions for a repeated failure. "
+            f"Defaults to 1\n"
+            f"  - {BOLD}CHAT_COMMAND_CACHE_TTL{RESET}: How long the cached suggestions are reused, in seconds. "
+            f"Defaults to a week\n"
+            f"  - {BOLD}CHAT_COMMAND_CACHE_SIZE{RESET}: The maximum number of cached responses. Defaults to 1000\n"
+            f"  - {BOLD}CHAT_COMMAND_CAPTURE{RESET}: Set to 1 to record the output of every command "
+            f"(same as chatCapture on). Defaults to 0\n"
+            f"  - {BOLD}CHAT_COMMAND_CAPTURE_SKIP{RESET}: Space-separated programs whose output is not recorded. "
+            f"Defaults to editors, pagers and other interactive programs\n"
+            f"  - {BOLD}CHAT_COMMAND_CAPTURE_MAX_BYTES{RESET}: How much of the end of a recorded output is kept. "
+            f"Defaults to 65536\n"
+            f"  - {BOLD}CHAT_COMMAND_RULES{RESET}: Set to 0 to always ask the model, even for the common errors "
+            f"that have a known fix. More rules can be added as JSON files in CHAT_COMMAND_PATH/rules. Defaults to 1\n"
+            f"  - {BOLD}CHAT_COMMAND_LEARN{RESET}: Set to 0 to not remember the accepted suggestions "
+            f"and not offer them again for similar problems. Defaults to 1\n"
+            f"  - {BOLD}CHAT_COMMAND_LEARNED_SIZE{RESET}: The maximum number of remembered suggestions. "
+            f"Defaults to 2000\n"
+            f"  - {BOLD}CHAT_COMMAND_LEARNED_MAX_AGE_DAYS{RESET}: After how many days without use a remembered "
+            f"suggestion is forgotten. Defaults to 180\n"
+            f"  - {BOLD}CHAT_COMMAND_LEARNED_THRESHOLD{RESET}: How similar (0-1) a problem has to be to one solved "
+            f"before for its solution to be offered. Defaults to 0.8\n"
+            f"  - {BOLD}CHAT_COMMAND_CONTEXT_TIMEOUT{RESET}: Seconds after which a context command "
+            f"is stopped. Defaults to 10\n"
+            f"  - {BOLD}CHAT_COMMAND_CONTEXT_MAX_BYTES{RESET}: How much output of such a command is read "
+            f"before it is stopped. Defaults to 1 MiB\n"
+            f"  - {BOLD}CHAT_COMMAND_RERUN_TIMEOUT{RESET}: Seconds after which the rerun of the last command "
+            f"is stopped, and chat goes on with the output it has so far. Defaults to 10\n"
+            f"  - {BOLD}CHAT_COMMAND_RERUN_MAX_BYTES{RESET}: How much output of the rerun is kept "
+            f"before it is stopped. Defaults to 1 MiB\n"
+            f"  - {BOLD}CHAT_COMMAND_ENVIRONMENT_BYTES{RESET}: Size of the description of the system, the current "
+            f"directory, its git status and the installed programs that is sent with every new request, "
+            f"0 to send none. Defaults to 1500\n"
+            f"  - {BOLD}CHAT_COMMAND_VALIDATE{RESET}: Set to 0 to show the suggestions that are not valid shell or "
+            f"run programs that are not installed as they are, instead of marking them and asking again "
+            f"when none of them can run. Defaults to 1\n"
+            f"  - {BOLD}CHAT_COMMAND_PREFETCH{RESET}: Set to 1 to request a fix in the background as soon as "
+            f"a recorded command fails, so that chat can show it right away. Needs chatCapture. Defaults to 0\n"
+            f"  - {BOLD}CHAT_COMMAND_PREFETCH_PER_MINUTE{RESET}: The maximum number of background requests "
+            f"in a minute. Defaults to 3\n"
+            f"  - {BOLD}CHAT_COMMAND_METRICS{RESET}: Set to 0 to not record how long every phase of a request takes "
+            f"(see chatStats). Defaults to 1\n"
         )
+
+
+def new_conversation_id():
+    """
+    :return: id that sorts by the start of the conversation, and does not collide with the ones started
+    in the same second by other shells. The shell functions make the same ones
+    """
+    return f"{int(time.time())}-{os.urandom(4).hex()}"
+
+
+def parse_endpoints(value, default_url, default_model, default_api_key):
+    """
+    :param value: "URL [MODEL [API_KEY_VARIABLE]]; ..."
+    :param default_url: used if no endpoints are listed
+    :param default_model:
+    :param default_api_key:
+    :return: list of (url, model, api key)
+    """
+    endpoints = []
+    for entry in value.replace("\n", ";").split(";"):
+        fields = entry.split()
+        if not fields:
+            continue
+        model = fields[1] if len(fields) > 1 else default_model
+        api_key = os.getenv(fields[2], "") if len(fields) > 2 else default_api_key
+        endpoints.append((fields[0], model, api_key))
+    return endpoints or [(default_url, default_model, default_api_key)]
@@ -0,0 +1,197 @@
+import codecs
+import concurrent.futures
+import os
+import shlex
+import signal
+import subprocess
+import threading
+
+from output_reducer import OUTPUT_BUDGET, READ_CHUNK_SIZE, OutputReducer
+from streaming import CONTEXT_MARKER
+
+# programs that only read, whatever their arguments are
+READ_ONLY_PROGRAMS = {
+    "ls", "cat", "head", "tail", "grep", "egrep", "fgrep", "rg", "pwd", "whoami", "id", "groups", "uname",
+    "printenv", "echo", "which", "type", "whereis", "file", "stat", "wc", "du", "df", "free", "ps", "cut", "tr",
+    "jq", "diff", "cmp", "md5sum", "sha1sum", "sha256sum", "readlink", "realpath", "basename", "dirname", "nproc",
+    "lscpu", "lsblk", "uptime", "locale", "getent", "ss", "netstat", "lsof", "nvidia-smi",
+}
+# programs that only read with these subcommands
+READ_ONLY_SUBCOMMANDS = {
+    "git": {"status", "log", "diff", "show", "rev-parse", "ls-files", "describe", "blame", "shortlog"},
+    "docker": {"ps", "images", "inspect", "logs", "version", "info"},
+    "kubectl": {"get", "describe", "logs", "version"},
+    "pip": {"list", "show", "freeze", "--version"},
+    "pip3": {"list", "show", "freeze", "--version"},
+    "conda": {"list", "info"},
+    "npm": {"ls", "list", "view", "--version"},
+    "systemctl": {"status", "list-units"},
+    "apt": {"list", "show", "policy"},
+    "brew": {"list", "info"},
+    "python": {"--version", "-V"},
+    "python3": {"--version", "-V"},
+    "node": {"--version", "-v"},
+}
+# git subcommands that change something when given other arguments than these
+GIT_LISTING_ARGUMENTS = {
+    "branch": {"-a", "-r", "-v", "-vv", "--all", "--list", "--show-current"},
+    "remote": {"-v"},
+}
+# options that make the read-only git subcommands write a file, and the subcommands where they mean something else
+GIT_OUTPUT_OPTIONS = {"--output", "-o"}
+GIT_READ_ONLY_OUTPUT_OPTIONS = {"ls-files": {"-o"}}
+FIND_ACTIONS = {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"}
+SEPARATORS = {"|", "||", "&&", ";"}
+HARMLESS_REDIRECTS = {(">", "/dev/null"), ("2>", "/dev/null"), (">&", "1"), (">&", "2")}
+
+
+def strip_context_marker(suggestion):
+    return suggestion.split(CONTEXT_MARKER)[0].strip()
+
+
+def is_read_only(command):
+    """
+    Conservatively decides whether a command can be run without asking: every part of the pipeline
+    has to be a known program that does not change anything, and the output may only go to /dev/null.
+    """
+    # substitutions can run anything
+    if "`" in command or "$(" in command or "<(" in command or ">(" in command:
+        return False
+    try:
+        lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        tokens = list(lexer)
+    except ValueError:
+        return False
+    if not tokens:
+        return False
+
+    segment = []
+    for token in tokens:
+        if token in SEPARATORS:
+            if not is_read_only_segment(segment):
+                return False
+            segment = []
+            continue
+        segment.append(token)
+    return is_read_only_segment(segment)
+
+
+def is_read_only_segment(tokens):
+    words = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.isdigit() and index + 1 < len(tokens) and tokens[index + 1] in (">", ">&"):
+            # the file descriptor of the redirection that follows
+            token = "2>" if tokens[index + 1] == ">" and token == "2" else tokens[index + 1]
+            index += 1
+        if token == "2>" or set(token) <= set("<>&|;()"):
+            target = tokens[index + 1] if index + 1 < len(tokens) else None
+            # reading a file is fine, writing one is not
+            if token != "<" and (token, target) not in HARMLESS_REDIRECTS:
+                return False
+            index += 2
+            continue
+        words.append(token)
+        index += 1
+
+    if not words or "=" in words[0]:
+        return False
+    program = os.path.basename(words[0])
+    if program == "find":
+        return not FIND_ACTIONS.intersection(words)
+    if program in READ_ONLY_PROGRAMS:
+        return True
+    if program == "git" and len(words) > 1 and words[1] in GIT_LISTING_ARGUMENTS:
+        return set(words[2:]) <= GIT_LISTING_ARGUMENTS[words[1]]
+    if program == "git" and len(words) > 1 and writes_git_output(words[1], words[2:]):
+        return False
+    subcommands = READ_ONLY_SUBCOMMANDS.get(program)
+    return subcommands is not None and len(words) > 1 and words[1] in subcommands
+
+
+def writes_git_output(subcommand, arguments):
+    """
+    :return: whether the arguments of the git subcommand make it write a file, such as `git log --output=FILE`
+    """
+    allowed = GIT_READ_ONLY_OUTPUT_OPTIONS.get(subcommand, set())
+    for argument in arguments:
+        if argument == "--":
+            return False
+        option = argument.split("=", 1)[0]
+        if option in GIT_OUTPUT_OPTIONS and option not in allowed:
+            return True
+    return False
+
+
+def run_context_commands(commands, timeout, max_bytes, budget=OUTPUT_BUDGET):
+    """
+    Runs the commands concurrently.
+    :param commands:
+    :param timeout: seconds after which a command is stopped
+    :param max_bytes: how much of a command's output is read before it is stopped
+    :param budget: characters of every reduced output
+    :return: list of (command, reduced output), in the order of the commands
+    """
+    processes = []
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(commands))
+    futures = [pool.submit(run_context_command, command, timeout, max_bytes, budget, processes)
+               for command in commands]
+    try:
+        return [(command, future.result()) for command, future in zip(commands, futures)]
+    except KeyboardInterrupt:
+        for process in list(processes):
+            kill(process)
+        raise
+    finally:
+        pool.shutdown(wait=False)
+
+
+def run_context_command(command, timeout, max_bytes, budget=OUTPUT_BUDGET, processes=None):
+    # in its own session, so that the whole pipeline can be stopped
+    process = subprocess.Popen(
+        command, shell=True, executable=os.environ.get("SHELL") or None, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True,
+    )
+    if processes is not None:
+        processes.append(process)
+    timed_out = threading.Event()
+
+    def stop():
+        timed_out.set()
+        kill(process)
+
+    timer = threading.Timer(timeout, stop)
+    timer.daemon = True
+    timer.start()
+
+    reducer = OutputReducer(budget)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    read_bytes = 0
+    try:
+        while chunk := process.stdout.read1(READ_CHUNK_SIZE):
+            reducer.feed(decoder.decode(chunk))
+            read_bytes += len(chunk)
+            if read_bytes >= max_bytes:
+                kill(process)
+                break
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        process.wait()
+    reducer.feed(decoder.decode(b'', final=True))
+
+    lines = [reducer.result()]
+    if timed_out.is_set():
+        lines.append(f"[stopped after {timeout:g} seconds]")
+    elif read_bytes >= max_bytes:
+        lines.append(f"[stopped after {max_bytes} bytes of output]")
+    return "\n".join(line for line in lines if line)
+
+
+def kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
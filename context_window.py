@@ -0,0 +1,101 @@
+import json
+import logging
+import math
+import os
+
+# rough, but errs on the side of overestimating for commands and outputs
+CHARACTERS_PER_TOKEN = 3
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(messages):
+    return sum(
+        math.ceil(len(message["content"]) / CHARACTERS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS for message in messages
+    )
+
+
+class ContextWindow:
+    """
+    Keeps the requests under a token budget.
+    The system prompt and the recent turns are sent verbatim, the older turns are replaced by a summary.
+    The summary is stored next to the conversation and reused until the recent turns outgrow the budget again,
+    at which point it is extended with the turns that no longer fit.
+    """
+    def __init__(self, budget, summary_path, summarize):
+        """
+        :param budget: maximum number of tokens in a request
+        :param summary_path: where the summary of this conversation is kept
+        :param summarize: function(previous_summary, messages) that returns the new summary text
+        """
+        self.budget = budget
+        self.summary_path = summary_path
+        self.summarize = summarize
+
+    def fit(self, messages):
+        """
+        :param messages: the full conversation, starting with the system prompt
+        :return: the messages to send
+        """
+        full_tokens = count_tokens(messages)
+        if full_tokens <= self.budget:
+            logging.info(f"Request tokens: ~{full_tokens}")
+            return messages
+
+        system, history = messages[0], messages[1:]
+        covered, summary = self.load_summary()
+        if covered > len(history) - 1:
+            # the conversation changed under the summary, it has to be redone
+            covered, summary = 0, ""
+
+        fitted = self.with_summary(system, summary, history[covered:])
+        if count_tokens(fitted) > self.budget:
+            # leave room for the next turns, so that the summary does not have to be extended on every request
+            cut = self.find_cut(history, covered, self.budget // 2 - count_tokens([system]))
+            if cut > covered:
+                summary = self.summarize(summary, history[covered:cut])
+                covered = cut
+                self.save_summary(covered, summary)
+                fitted = self.with_summary(system, summary, history[covered:])
+
+        logging.info(f"Request tokens: ~{count_tokens(fitted)} (full history: ~{full_tokens}, "
+                     f"{covered} messages summarized)")
+        return fitted
+
+    @staticmethod
+    def find_cut(history, start, recent_budget):
+        """
+        Finds the first message that is sent verbatim: the recent messages that fit into the budget,
+        but at least the last one, and starting with a user message.
+        """
+        cut = len(history) - 1
+        tokens = count_tokens(history[cut:])
+        while cut > start and tokens + count_tokens([history[cut - 1]]) <= recent_budget:
+            cut -= 1
+            tokens += count_tokens([history[cut]])
+        while cut < len(history) - 1 and history[cut]["role"] != "user":
+            cut += 1
+        return max(cut, start)
+
+    @staticmethod
+    def with_summary(system, summary, recent):
+        if not summary:
+            return [system] + recent
+        content = f"{system['content']}\nSummary of the earlier part of this conversation:\n{summary}\n"
+        return [{"role": "system", "content": content}] + recent
+
+    def load_summary(self):
+        try:
+            with open(self.summary_path) as file:
+                saved = json.load(file)
+            return saved["covered"], saved["summary"]
+        except (OSError, ValueError, KeyError):
+            return 0, ""
+
+    def save_summary(self, covered, summary):
+        temporary_path = f"{self.summary_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, 'w') as file:
+                json.dump({"covered": covered, "summary": summary}, file)
+            os.replace(temporary_path, self.summary_path)
+        except OSError as e:
+            logging.warning(f"Could not save the conversation summary: {e}")
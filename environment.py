@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+
+# the programs worth telling the model about, if they are installed
+NOTABLE_PROGRAMS = (
+    "apt", "dnf", "yum", "pacman", "apk", "brew", "snap", "flatpak", "nix",
+    "git", "gh", "docker", "podman", "docker-compose", "kubectl", "helm", "terraform", "ansible",
+    "python", "python3", "pip", "pip3", "uv", "poetry", "conda", "mamba", "node", "npm", "yarn", "pnpm", "bun",
+    "deno", "java", "mvn", "gradle", "go", "cargo", "rustc", "gcc", "g++", "clang", "make", "cmake", "ninja",
+    "ruby", "gem", "php", "composer", "dotnet", "perl",
+    "systemctl", "service", "journalctl", "sudo", "ssh", "rsync", "curl", "wget", "jq", "rg", "fd", "fzf",
+    "tmux", "screen", "vim", "nvim", "nano", "emacs", "code", "nvidia-smi", "ffmpeg", "sqlite3", "psql", "mysql",
+    "redis-cli", "aws", "gcloud", "az",
+)
+# the entries of the current directory that are listed at most
+MAX_LISTED = 60
+# the number of directories whose listing is kept
+MAX_CACHED_DIRECTORIES = 50
+GIT_STATUS_TIMEOUT = 1.
+# the porcelain codes of the git status summary
+GIT_CHANGES = (("??", "untracked"), ("M", "modified"), ("A", "added"), ("D", "deleted"), ("R", "renamed"),
+               ("U", "conflicted"))
+
+
+class EnvironmentSnapshot:
+    """
+    A short description of where the user runs their commands: the system and the shell, the current directory
+    and what is in it, the state of its git repository and the notable programs that are installed.
+    With it, the model does not have to ask for `ls`, `git status` or `which python` first.
+    Every part but the git status is kept in a file together with the mtimes it depends on, and it is only
+    recomputed when one of them changes.
+    """
+    def __init__(self, cache_file_path, path_index, budget):
+        """
+        :param cache_file_path: where the parts of the description are kept
+        :param path_index: PathIndex of the installed programs
+        :param budget: the maximum length of the description in bytes
+        """
+        self.cache_file_path = cache_file_path
+        self.path_index = path_index
+        self.budget = budget
+        self.cache = None
+        self.changed = False
+
+    def describe(self, cwd=None):
+        """
+        :param cwd: the current directory by default
+        :return: the description of the environment, at most `budget` bytes, with the new line at the end
+        """
+        if self.budget <= 0:
+            return ""
+        cwd = cwd or os.getcwd()
+        self.cache = self.load()
+        self.changed = False
+        shell = os.path.basename(os.environ.get("SHELL", ""))
+        system = self.cached("system", ["/etc/os-release"], self.describe_system)
+        lines = [
+            f"{system}, shell: {shell}" if shell else system,
+            self.describe_git(cwd),
+            self.describe_programs(),
+        ]
+        header = "My environment:\n"
+        used = len(header.encode())
+        fitting = []
+        for line in lines:
+            size = len(f"- {line}\n".encode())
+            if line and used + size <= self.budget:
+                fitting.append(line)
+                used += size
+        # the listing gets what is left of the budget
+        listing = self.describe_directory(cwd, self.budget - used - len("- \n"))
+        if listing:
+            fitting.insert(1 if fitting else 0, listing)
+        if self.changed:
+            self.save()
+        if not fitting:
+            return ""
+        return header + "".join(f"- {line}\n" for line in fitting)
+
+    def cached(self, name, paths, compute, key_extra=()):
+        """
+        :param name: the part of the description
+        :param paths: files or directories, the part is computed again when one of their mtimes changes
+        :param compute: function that computes the part
+        :param key_extra: anything else the part depends on
+        :return: the part
+        """
+        key = [self.mtime(path) for path in paths] + list(key_extra)
+        entry = self.cache.get(name)
+        if entry is None or entry["key"] != key:
+            entry = {"key": key, "text": compute()}
+            self.cache[name] = entry
+            self.changed = True
+        return entry["text"]
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    @staticmethod
+    def describe_system():
+        uname = os.uname()
+        system = f"{uname.sysname} {uname.release}"
+        try:
+            with open("/etc/os-release", encoding='utf-8') as file:
+                for line in file:
+                    if line.startswith("PRETTY_NAME="):
+                        system = f"{line.split('=', 1)[1].strip().strip(chr(34))} ({system})"
+                        break
+        except OSError:
+            pass
+        return f"OS: {system}, {uname.machine}"
+
+    def describe_directory(self, cwd, budget):
+        """
+        :param cwd:
+        :param budget: bytes that the line may take
+        :return: the current directory and as many of its entries as fit into the budget
+        """
+        text = self.cached(f"listing:{cwd}", [cwd], lambda: self.list_directory(cwd))
+        line = f"Current directory: {cwd}"
+        if text:
+            entries = text.split("\n")
+            listed = line + ", containing: " + ", ".join(entries)
+            while entries and len(listed.encode()) > budget:
+                entries.pop()
+                listed = line + ", containing: " + ", ".join(entries) + ", ..."
+            if entries:
+                line = listed
+        return line if len(line.encode()) <= budget else ""
+
+    @staticmethod
+    def list_directory(cwd):
+        """
+        :return: the entries of the directory, one per line, the directories with a slash
+        """
+        try:
+            with os.scandir(cwd) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except OSError:
+            return ""
+        names = []
+        for entry in entries[:MAX_LISTED]:
+            try:
+                names.append(entry.name + ("/" if entry.is_dir() else ""))
+            except OSError:
+                names.append(entry.name)
+        if len(entries) > MAX_LISTED:
+            names.append(f"and {len(entries) - MAX_LISTED} more")
+        return "\n".join(names)
+
+    @classmethod
+    def describe_git(cls, cwd):
+        root, _ = find_git_repository(cwd)
+        if root is None:
+            return ""
+        # not cached: editing a tracked file or creating one in a subdirectory changes no mtime that could be checked
+        return cls.git_status(root)
+
+    @staticmethod
+    def git_status(root):
+        import subprocess
+
+        try:
+            result = subprocess.run(
+                # without refreshing the index, which would take its lock from the user's own git commands
+                ["git", "--no-optional-locks", "status", "--porcelain", "--branch"], cwd=root, capture_output=True, text=True,
+                timeout=GIT_STATUS_TIMEOUT
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.info(f"Could not get the git status of {root}: {e}")
+            return f"Git repository at {root}"
+        if result.returncode != 0:
+            return f"Git repository at {root}"
+        lines = result.stdout.splitlines()
+        branch = lines[0][3:] if lines and lines[0].startswith("## ") else "unknown"
+        counts = {}
+        for line in lines[1:]:
+            code = line[:2]
+            for symbol, name in GIT_CHANGES:
+                if symbol in code:
+                    counts[name] = counts.get(name, 0) + 1
+                    break
+        changes = ", ".join(f"{count} {name}" for name, count in counts.items()) or "clean"
+        return f"Git repository at {root}, branch {branch}, {changes}"
+
+    def describe_programs(self):
+        executables = self.path_index.executables()
+        installed = [program for program in NOTABLE_PROGRAMS if program in executables]
+        return f"Installed: {', '.join(installed)}" if installed else ""
+
+    def load(self):
+        try:
+            with open(self.cache_file_path, encoding='utf-8') as file:
+                cache = json.load(file)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        listings = [name for name in self.cache if name.startswith("listing:")]
+        # the oldest directories are forgotten first, dicts keep the insertion order
+        for name in listings[:-MAX_CACHED_DIRECTORIES]:
+            del self.cache[name]
+        temporary_path = f"{self.cache_file_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                json.dump(self.cache, file)
+            os.replace(temporary_path, self.cache_file_path)
+        except OSError as e:
+            logging.warning(f"Could not save the environment description: {e}")
+
+
+def find_git_repository(cwd):
+    """
+    :param cwd:
+    :return: the root of the git working tree that contains cwd and its git directory, or (None, None)
+    """
+    directory = cwd
+    while True:
+        dot_git = os.path.join(directory, ".git")
+        if os.path.isdir(dot_git):
+            return directory, dot_git
+        if os.path.isfile(dot_git):
+            # a worktree or a submodule, the file points to its git directory
+            try:
+                with open(dot_git, encoding='utf-8') as file:
+                    content = file.read().strip()
+            except OSError:
+                return None, None
+            if content.startswith("gitdir:"):
+                return directory, os.path.join(directory, content[len("gitdir:"):].strip())
+            return None, None
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None, None
+        directory = parent
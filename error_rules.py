@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import re
+import shutil
+
+MAX_SUGGESTIONS = 3
+
+# Every rule has a regular expression for the output, and optionally one for the command.
+# The named groups of both can be used in the suggestions, as well as {command}.
+# A group named in both has to capture the same text in both, or the rule does not match.
+# A rule that "requires" a program is only used if that program is installed.
+BUILTIN_RULES = [
+    # a missing program is only installed when the system names its package,
+    # as the command-not-found handlers of Ubuntu, Debian and Homebrew do
+    {
+        "name": "apt-install-hint",
+        "output": r"can be installed with:\s*(?P<install>(?:sudo )?apt(?:-get)? install [\w.+-]+)(?!\S)",
+        "suggestions": ["{install}"],
+    },
+    {
+        "name": "brew-install-hint",
+        "output": r"You can install it by typing:\s*(?P<install>brew install [\w@./+-]+)(?!\S)",
+        "suggestions": ["{install}"],
+    },
+    {
+        "name": "not-a-git-repository",
+        "output": r"fatal: not a git repository",
+        "suggestions": ["git init"],
+    },
+    {
+        "name": "git-no-upstream",
+        "output": r"The current branch (?P<branch>\S+) has no upstream branch",
+        "suggestions": ["git push --set-upstream origin {branch}"],
+    },
+    # only for a relative script that the shell itself could not execute, as bash and zsh report it
+    {
+        "name": "script-not-executable",
+        "output": r"(?m)^[\w.-]+: (?P<script>\.\.?/[^\s:]+): Permission denied",
+        "command": r"^(?P<script>\.\.?/\S+)",
+        "suggestions": ["chmod +x {script} && {command}"],
+    },
+    {
+        "name": "script-not-executable-zsh",
+        "output": r"permission denied: (?P<script>\.\.?/\S+)",
+        "command": r"^(?P<script>\.\.?/\S+)",
+        "suggestions": ["chmod +x {script} && {command}"],
+    },
+    {
+        "name": "docker-socket-permission",
+        "output": r"permission denied while trying to connect to the Docker daemon socket",
+        "command": r"^(?!sudo\b)",
+        "suggestions": ["sudo {command}", "sudo usermod -aG docker $USER"],
+    },
+    {
+        "name": "needs-root",
+        "output": r"are you root\?|must be run as root|Operation not permitted",
+        "command": r"^(?!sudo\b)",
+        "suggestions": ["sudo {command}"],
+    },
+    {
+        "name": "apt-unknown-package",
+        "output": r"E: Unable to locate package",
+        "suggestions": ["sudo apt update && {command}"],
+    },
+    {
+        "name": "pip-externally-managed",
+        "output": r"externally-managed-environment",
+        "suggestions": ["python3 -m venv .venv && . .venv/bin/activate && {command}",
+                        "{command} --break-system-packages"],
+    },
+    # the modules whose package is named differently go before the general rule
+    *(
+        {
+            "name": f"python-module-{module}",
+            "output": rf"No module named '?{module}\b",
+            "suggestions": [f"pip install {package}"],
+        }
+        for module, package in {
+            "cv2": "opencv-python", "yaml": "pyyaml", "PIL": "pillow", "sklearn": "scikit-learn",
+            "bs4": "beautifulsoup4", "dotenv": "python-dotenv",
+        }.items()
+    ),
+    {
+        "name": "python-module",
+        "output": r"No module named '?(?P<module>[\w-]+)",
+        "suggestions": ["pip install {module}"],
+    },
+    {
+        "name": "node-module",
+        "output": r"Cannot find module '(?P<module>(?:@[\w.-]+/)?[\w-][\w.-]*)'",
+        "suggestions": ["npm install {module}"],
+    },
+]
+
+GROUP_PATTERN = re.compile(r'\(\?P<(\w+)>')
+BACKREFERENCE_PATTERN = re.compile(r'\(\?P=(\w+)\)')
+NUMBERED_BACKREFERENCE_PATTERN = re.compile(r'(?<!\\)\\[1-9]')
+GLOBAL_FLAGS_PATTERN = re.compile(r'^\(\?([aiLmsux]+)\)')
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+
+# the index of the last loaded rules, reused while the rule packs are unchanged (useful in the daemon)
+_index = None
+
+
+class RuleIndex:
+    """
+    Answers the common failures without the network.
+    The output patterns of all rules are compiled into a single alternation, so the output is scanned once
+    however many rules there are. Its named groups are prefixed with the rule's number to keep them apart.
+    """
+    def __init__(self, rules):
+        self.rules = []
+        alternatives = []
+        for rule in rules:
+            if not isinstance(rule, dict):
+                logging.warning(f"Skipping the invalid rule {rule!r}")
+                continue
+            try:
+                number = len(self.rules)
+                if NUMBERED_BACKREFERENCE_PATTERN.search(rule["output"]):
+                    raise TypeError("numbered backreferences do not work in the combined pattern, name the groups")
+                alternative = self.prefix_groups(rule["output"], number)
+                re.compile(alternative)
+                command_pattern = re.compile(rule["command"]) if rule.get("command") else None
+                if not all(isinstance(template, str) for template in rule["suggestions"]):
+                    raise TypeError("the suggestions have to be strings")
+            except (KeyError, TypeError, re.error) as e:
+                logging.warning(f"Skipping the invalid rule {rule.get('name')}: {e}")
+                continue
+            if rule.get("requires") and shutil.which(rule["requires"]) is None:
+                continue
+            alternatives.append(f"(?P<r{number}>{alternative})")
+            self.rules.append((rule, command_pattern))
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    @staticmethod
+    def prefix_groups(pattern, number):
+        # flags at the start would apply to the whole alternation, they are scoped to the rule instead
+        flags = GLOBAL_FLAGS_PATTERN.match(pattern)
+        if flags:
+            pattern = f"(?{flags.group(1)}:{pattern[flags.end():]})"
+        pattern = GROUP_PATTERN.sub(lambda m: f"(?P<r{number}_{m.group(1)}>", pattern)
+        return BACKREFERENCE_PATTERN.sub(lambda m: f"(?P=r{number}_{m.group(1)})", pattern)
+
+    def match(self, command, output):
+        """
+        :param command: the command that failed
+        :param output: its output
+        :return: list of suggestions of the matching rules in the order of the rules, empty if none matched
+        """
+        if self.pattern is None:
+            return []
+        matched = []
+        for output_match in self.pattern.finditer(output):
+            number = int(output_match.lastgroup[1:])
+            rule, command_pattern = self.rules[number]
+            values = {"command": command}
+            command_values = {}
+            if command_pattern is not None:
+                command_match = command_pattern.search(command)
+                if command_match is None:
+                    continue
+                command_values = {k: v for k, v in command_match.groupdict().items() if v is not None}
+                values.update(command_values)
+            prefix = f"r{number}_"
+            for name, value in output_match.groupdict().items():
+                if name.startswith(prefix):
+                    values[name[len(prefix):]] = value or ""
+            if any(values[name] != value for name, value in command_values.items()):
+                # such as the error of another file than the script that was run
+                continue
+
+            matched.append((number, [
+                PLACEHOLDER_PATTERN.sub(lambda m: values.get(m.group(1), m.group(0)), template)
+                for template in rule["suggestions"]
+            ]))
+
+        suggestions = []
+        for _, rule_suggestions in sorted(matched, key=lambda item: item[0]):
+            for suggestion in rule_suggestions:
+                if suggestion not in suggestions and not repeats_fix(suggestion, command):
+                    suggestions.append(suggestion)
+        return suggestions[:MAX_SUGGESTIONS]
+
+
+def repeats_fix(suggestion, command):
+    """
+    :return: whether the suggestion is the command itself, or the command with the fix it already has around it,
+    such as `sudo apt update && sudo apt update && ...`
+    """
+    if not command or command not in suggestion:
+        return False
+    before, _, after = suggestion.partition(command)
+    if not before and not after:
+        return True
+    return bool(before) and command.startswith(before) or bool(after) and command.endswith(after)
+
+
+def load_rule_packs(directory):
+    """
+    :param directory: where the user's rule packs are, JSON files with a list of rules each
+    :return: list of rules, the user's ones first, so that they take precedence over the built-in ones
+    """
+    rules = []
+    for path in rule_pack_paths(directory):
+        try:
+            with open(path) as file:
+                pack = json.load(file)
+            if not isinstance(pack, list):
+                raise ValueError("a rule pack has to be a list of rules")
+            rules.extend(pack)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load the rule pack {path}: {e}")
+    return rules + BUILTIN_RULES
+
+
+def rule_pack_paths(directory):
+    try:
+        return sorted(entry.path for entry in os.scandir(directory) if entry.name.endswith(".json"))
+    except OSError:
+        return []
+
+
+def get_rule_index(directory):
+    global _index
+
+    version = []
+    for path in rule_pack_paths(directory):
+        try:
+            version.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+    if _index is None or _index[0] != version:
+        _index = (version, RuleIndex(load_rule_packs(directory)))
+    return _index[1]
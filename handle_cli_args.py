@@ -3,7 +3,7 @@ import argparse
 from config import Config, BOLD, RESET, UNDERLINE
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(
         prog="chat",
         description=
@@ -22,7 +22,15 @@ def main():
         f"1. {BOLD}{UNDERLINE}chatNewSession{RESET}, which resets the conversation history.\n"
         f"2. {BOLD}{UNDERLINE}chatInstall{RESET}, which copies an express installation string to your clipboard. "
         f"This can be useful when you just logged into a new machine or a docker container.\n"
-        f"3. {BOLD}{UNDERLINE}chatHistory{RESET}, which lets you inspect you current conversation in full.\n",
+        f"3. {BOLD}{UNDERLINE}chatHistory{RESET}, which lets you inspect you current conversation in full, "
+        f"or search all the past ones with {BOLD}{UNDERLINE}chatHistory --search \"words\"{RESET}.\n"
+        f"4. {BOLD}{UNDERLINE}chatDaemon start|stop|status{RESET}, which manages an optional background process "
+        f"that keeps {BOLD}{UNDERLINE}chat{RESET} warm and makes it respond faster.\n"
+        f"5. {BOLD}{UNDERLINE}chatCapture on|off|status{RESET}, which records the output of every command, "
+        f"so that {BOLD}{UNDERLINE}chat{RESET} does not have to rerun it.\n"
+        f"6. {BOLD}{UNDERLINE}chatStats [--days N]{RESET}, which shows how long the requests took, phase by phase.\n"
+        f"7. {BOLD}{UNDERLINE}chatBatch records.jsonl{RESET}, which gets suggestions for many failed commands "
+        f"or queries at once, without asking anything.\n",
         epilog=Config.configuration_help_string() +
                "\n🌟 Don't forget to star the project on GitHub if you like it!\n"
                "https://github.com/mikhail-vlasenko/chat-command",
@@ -35,21 +43,9 @@ def main():
                         help="Do not rerun the last command")
     parser.add_argument("--with_context", action="store_true",
                         help="This is a follow-up request that provides context to the previous interaction")
-    args = parser.parse_args()
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Do not use or store cached suggestions for this request")
+    parser.add_argument("--refresh_cache", action="store_true",
+                        help="Ask the model even if the suggestions are cached, and cache the new ones")
+    return parser
 
-    def format_string(s):
-        if not s:
-            # empty strings mess up parsing
-            return "\"\""
-        return s.replace("\t", "\\t")
-
-    # Output all arguments back to the shell, separated by tabs so that they can be easily parsed
-    print(format_string(args.query), end='\t')
-    # convert to ints to avoid dealing with truthy values
-    print(int(args.clipboard), end='\t')
-    print('true' if args.no_rerun else 'false', end='\t')
-    print(int(args.with_context), end='\t')
-
-
-if __name__ == "__main__":
-    main()
@@ -0,0 +1,150 @@
+import logging
+import os
+import sqlite3
+import time
+
+EXECUTED_PREFIX = "I executed "
+SNIPPET_WORDS = 16
+
+
+class HistoryIndex:
+    """
+    Full-text index (SQLite FTS5) of the messages of all the conversations in the chat_history directory,
+    together with the commands that the user accepted in them.
+    It is updated with the new messages every time a conversation is written, and the conversations
+    written before the index existed are added the first time it is searched.
+    """
+    def __init__(self, path, history_dir):
+        """
+        :param path: the index database
+        :param history_dir: the directory of the conversation files
+        """
+        self.path = path
+        self.history_dir = history_dir
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=1.)
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "content, conv_id UNINDEXED, position UNINDEXED, role UNINDEXED, time UNINDEXED)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS accepted ("
+                "conv_id TEXT NOT NULL, position INTEGER NOT NULL, command TEXT NOT NULL, "
+                "PRIMARY KEY (conv_id, position))"
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS conversations (conv_id TEXT PRIMARY KEY)")
+        return self.connection
+
+    def add(self, conv_id, start, messages, accepted=None):
+        """
+        Indexes the new messages of a conversation, the same ones that were appended to its file.
+        :param conv_id:
+        :param start: the position of the first new message, the ones after it that were indexed before are replaced
+        :param messages: the new messages
+        :param accepted: (position of the suggestions, the command the user chose from them), if any
+        """
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                known = connection.execute(
+                    "SELECT 1 FROM conversations WHERE conv_id = ?", (str(conv_id),)
+                ).fetchone()
+                if known is None and start > 0:
+                    # a conversation that started before the index existed, its file has the new messages already
+                    self.add_file(connection, str(conv_id))
+                else:
+                    self.replace(connection, conv_id, start, messages, now)
+                if accepted is not None:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO accepted (conv_id, position, command) VALUES (?, ?, ?)",
+                        (str(conv_id), *accepted)
+                    )
+        except sqlite3.Error as e:
+            logging.warning(f"Could not index the conversation {conv_id}: {e}")
+
+    @staticmethod
+    def replace(connection, conv_id, start, messages, now):
+        conv_id = str(conv_id)
+        connection.execute("INSERT OR IGNORE INTO conversations (conv_id) VALUES (?)", (conv_id,))
+        connection.execute(
+            "DELETE FROM messages WHERE conv_id = ? AND CAST(position AS INTEGER) >= ?", (conv_id, start)
+        )
+        connection.execute("DELETE FROM accepted WHERE conv_id = ? AND position >= ?", (conv_id, start))
+        connection.executemany(
+            "INSERT INTO messages (content, conv_id, position, role, time) VALUES (?, ?, ?, ?, ?)",
+            [(message["content"], conv_id, start + offset, message["role"], now)
+             for offset, message in enumerate(messages)]
+        )
+
+    def add_missing(self):
+        """
+        Indexes the conversations that were written before the index existed, and forgets the deleted ones.
+        """
+        try:
+            names = os.listdir(self.history_dir)
+        except OSError:
+            names = []
+        stored = {name[:-len(".jsonl")] for name in names if name.endswith(".jsonl")}
+        with self.connect() as connection:
+            indexed = {row[0] for row in connection.execute("SELECT conv_id FROM conversations")}
+            for conv_id in indexed - stored:
+                connection.execute("DELETE FROM messages WHERE conv_id = ?", (conv_id,))
+                connection.execute("DELETE FROM accepted WHERE conv_id = ?", (conv_id,))
+                connection.execute("DELETE FROM conversations WHERE conv_id = ?", (conv_id,))
+            for conv_id in stored - indexed:
+                self.add_file(connection, conv_id)
+
+    def add_file(self, connection, conv_id):
+        """
+        Indexes a whole conversation file.
+        The commands accepted in it are taken from the messages that report their outputs.
+        """
+        from history_store import ConversationStore
+
+        path = os.path.join(self.history_dir, f"{conv_id}.jsonl")
+        try:
+            messages = ConversationStore.read(path)[0]
+            modified = os.path.getmtime(path)
+        except OSError:
+            return
+        self.replace(connection, conv_id, 0, messages, modified)
+        for position, message in enumerate(messages):
+            if message["role"] == "user" and message["content"].startswith(EXECUTED_PREFIX) and position:
+                command = message["content"][len(EXECUTED_PREFIX):].split("\n")[0]
+                connection.execute(
+                    "INSERT OR REPLACE INTO accepted (conv_id, position, command) VALUES (?, ?, ?)",
+                    (conv_id, position - 1, command)
+                )
+        logging.info(f"Indexed the conversation {conv_id}")
+
+    def search(self, query, limit=10):
+        """
+        :param query: words to look for, the last one may be the start of a word
+        :param limit: the maximum number of results
+        :return: list of dicts with the conversation, the time, the role, a snippet of the message with the words
+        highlighted, and the first command accepted after it
+        """
+        self.add_missing()
+        words = query.split()
+        if not words:
+            return []
+        # quoted, so that the words are never taken for the FTS5 operators
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in words) + "*"
+        rows = self.connect().execute(
+            "SELECT messages.conv_id, messages.time, messages.role, "
+            "snippet(messages, 0, '\033[1m', '\033[0m', '...', ?), "
+            "(SELECT accepted.command FROM accepted WHERE accepted.conv_id = messages.conv_id "
+            "AND accepted.position >= CAST(messages.position AS INTEGER) ORDER BY accepted.position LIMIT 1) "
+            "FROM messages WHERE messages MATCH ? ORDER BY bm25(messages) LIMIT ?",
+            # the repeated suggestions of a conversation are shown once
+            (SNIPPET_WORDS, match, limit * 3)
+        ).fetchall()
+        results = {}
+        for conv_id, at, role, snippet, accepted in rows:
+            results.setdefault((conv_id, snippet), {
+                "conv_id": conv_id, "time": float(at), "role": role, "snippet": snippet, "accepted": accepted
+            })
+        return list(results.values())[:limit]
@@ -0,0 +1,241 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+RETENTION_CHECK_INTERVAL = 24 * 60 * 60
+RETENTION_MARKER = ".retention_checked"
+# the files of a conversation, the current and the old format
+CONVERSATION_SUFFIXES = (".jsonl", ".pkl")
+# the files that other features keep next to a conversation, removed together with it
+COMPANION_SUFFIXES = (".summary.json", ".prefetch.json")
+
+# loaded conversations, reused while the file is unchanged (useful in the daemon)
+_cache = {}
+
+
+class ConversationStore:
+    """
+    Append-only storage of the conversations in the chat_history directory, one JSON lines file per conversation.
+    Every line is either a message or a {"truncate": n} record,
+    which drops all but the first n messages (the last user message is sometimes merged into a new one).
+    Only the new messages are appended on every turn, and the files are compacted in the background.
+    """
+    def __init__(self, directory, max_age_days=30, max_total_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.max_total_bytes = max_total_bytes
+        self.background_thread = None
+
+    def path(self, conv_id):
+        return os.path.join(self.directory, f"{conv_id}.jsonl")
+
+    def legacy_path(self, conv_id):
+        return os.path.join(self.directory, f"{conv_id}.pkl")
+
+    def load(self, conv_id):
+        """
+        Reads the whole conversation, a process that loads it again (the daemon) reuses it while the file
+        is unchanged.
+        :param conv_id:
+        :return: a fresh list of messages that can be modified by the caller
+        """
+        path = self.path(conv_id)
+        if not os.path.exists(path) and os.path.exists(self.legacy_path(conv_id)):
+            self.migrate(conv_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return []
+
+        cached = _cache.get(path)
+        if cached is None or cached[0] != (stat.st_mtime_ns, stat.st_size):
+            cached = ((stat.st_mtime_ns, stat.st_size), self.read(path)[0])
+            _cache[path] = cached
+        return [dict(message) for message in cached[1]]
+
+    @staticmethod
+    def read(path):
+        """
+        Replays the records of a conversation file.
+        :param path:
+        :return: list of messages, and whether the file contains records that compaction would remove
+        """
+        messages = []
+        has_garbage = False
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # most likely the last line, cut short by a crash
+                    logging.warning(f"Skipping a damaged record in {path}")
+                    has_garbage = True
+                    continue
+                if "truncate" in record:
+                    del messages[record["truncate"]:]
+                    has_garbage = True
+                else:
+                    messages.append(record)
+        return messages, has_garbage
+
+    def append(self, conv_id, messages, keep=None):
+        """
+        Appends the new messages of a conversation.
+        :param conv_id:
+        :param messages: messages to append
+        :param keep: if given, only this many of the already stored messages are kept before appending
+        :return:
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        records = []
+        if keep is not None:
+            records.append({"truncate": keep})
+        records.extend(messages)
+        if not records:
+            return
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        with locked(self.path(conv_id)) as file:
+            # a single write, so that a crash can only damage the last line
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        if keep is not None:
+            self.run_in_background(self.compact, conv_id)
+        elif self.retention_due():
+            self.run_in_background(self.enforce_retention)
+
+    def run_in_background(self, function, *args):
+        # not a daemon thread: the process waits for it to finish before exiting
+        self.background_thread = threading.Thread(target=function, args=args)
+        self.background_thread.start()
+
+    def compact(self, conv_id):
+        """
+        Rewrites the conversation file with only its current messages.
+        """
+        path = self.path(conv_id)
+        try:
+            # the other processes wait with their new messages until the file is replaced
+            with locked(path):
+                messages, has_garbage = self.read(path)
+                if has_garbage:
+                    temporary_path = f"{path}.{os.getpid()}.tmp"
+                    with open(temporary_path, 'w', encoding='utf-8') as file:
+                        file.write("".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages))
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.replace(temporary_path, path)
+        except OSError as e:
+            logging.warning(f"Could not compact {path}: {e}")
+        if self.retention_due():
+            self.enforce_retention()
+
+    def migrate(self, conv_id):
+        """
+        Converts a conversation from the old pickle format.
+        """
+        import pickle
+
+        legacy_path = self.legacy_path(conv_id)
+        try:
+            # written by the previous versions of chat itself
+            with open(legacy_path, 'rb') as file:
+                messages = pickle.load(file)
+            self.append(conv_id, messages)
+            os.remove(legacy_path)
+            logging.info(f"Migrated {legacy_path} to {self.path(conv_id)}")
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.warning(f"Could not migrate {legacy_path}: {e}")
+
+    def retention_due(self):
+        try:
+            last_check = os.path.getmtime(os.path.join(self.directory, RETENTION_MARKER))
+        except OSError:
+            return True
+        return time.time() - last_check > RETENTION_CHECK_INTERVAL
+
+    def enforce_retention(self):
+        """
+        Deletes the conversations that are too old, and then the oldest ones until the total size fits the limit.
+        The summary and the prefetched suggestions of a conversation are deleted together with it,
+        and any other file in the directory is left alone.
+        """
+        marker = os.path.join(self.directory, RETENTION_MARKER)
+        with open(marker, 'w'):
+            pass
+
+        # conversation id: [mtime of the conversation file, total size, paths]
+        conversations = {}
+        for entry in os.scandir(self.directory):
+            suffix = next((suffix for suffix in CONVERSATION_SUFFIXES + COMPANION_SUFFIXES
+                           if entry.name.endswith(suffix)), None)
+            if suffix is None:
+                continue
+            stat = entry.stat()
+            conversation = conversations.setdefault(entry.name[:-len(suffix)], [0, 0, []])
+            if suffix in CONVERSATION_SUFFIXES:
+                conversation[0] = max(conversation[0], stat.st_mtime)
+            conversation[1] += stat.st_size
+            conversation[2].append(entry.path)
+
+        now = time.time()
+        kept = []
+        for mtime, size, paths in conversations.values():
+            # the companions of a conversation that is gone already have the mtime 0
+            if now - mtime > self.max_age:
+                for path in paths:
+                    self.remove(path)
+            else:
+                kept.append((mtime, size, paths))
+
+        total_size = sum(size for _, size, _ in kept)
+        for _, size, paths in sorted(kept):
+            if total_size <= self.max_total_bytes:
+                break
+            for path in paths:
+                self.remove(path)
+            total_size -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+            logging.info(f"Removed old conversation {path}")
+        except OSError as e:
+            logging.warning(f"Could not remove {path}: {e}")
+
+
+def clear_cache():
+    """
+    Forgets the loaded conversations, the next load reads its file again as a new process would.
+    """
+    _cache.clear()
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Opens a conversation file for appending, with an exclusive lock on it.
+    Several shells may continue the same conversation at once, and compaction replaces the file.
+    :param path:
+    :return: context manager with the open file
+    """
+    while True:
+        file = open(path, 'a', encoding='utf-8')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                replaced = os.fstat(file.fileno()).st_ino != os.stat(path).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if not replaced:
+                yield file
+                return
+        finally:
+            # closing the file releases the lock
+            file.close()
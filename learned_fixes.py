@@ -0,0 +1,168 @@
+import collections
+import logging
+import math
+import re
+import sqlite3
+import time
+
+TOKEN_PATTERN = re.compile(r'<\w+>|[\w.+-]+')
+MAX_CONTEXT_LENGTH = 2000
+MAX_QUERY_TERMS = 300
+MAX_CANDIDATES = 20
+
+
+def tokenize(text):
+    """
+    :param text: the request's context, with the volatile parts already masked
+    :return: Counter of the terms
+    """
+    return collections.Counter(
+        token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and not token.isdigit()
+    )
+
+
+class LearnedFixes:
+    """
+    Remembers the suggestions that the user accepted, together with the request they answered,
+    and finds them again for similar requests (cosine similarity of TF-IDF vectors over an inverted index).
+    The least recently used fixes are evicted once there are too many of them or they are too old.
+    """
+    def __init__(self, path, max_entries, max_age_days):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=1.)
+            self.connection.executescript(
+                "CREATE TABLE IF NOT EXISTS fixes ("
+                "id INTEGER PRIMARY KEY, request_type TEXT NOT NULL, context TEXT NOT NULL, command TEXT NOT NULL, "
+                "uses INTEGER NOT NULL, last_used REAL NOT NULL, UNIQUE (request_type, context, command));"
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT NOT NULL, fix_id INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (term, fix_id)"
+                ") WITHOUT ROWID;"
+                "CREATE INDEX IF NOT EXISTS postings_fix ON postings (fix_id);"
+            )
+        return self.connection
+
+    def record(self, request_type, context, command):
+        """
+        Adds an accepted suggestion to the index, or counts one more use of it.
+        """
+        context = context[:MAX_CONTEXT_LENGTH]
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                row = connection.execute(
+                    "SELECT id FROM fixes WHERE request_type = ? AND context = ? AND command = ?",
+                    (request_type, context, command)
+                ).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE fixes SET uses = uses + 1, last_used = ? WHERE id = ?", (now, row[0]))
+                    return
+                fix_id = connection.execute(
+                    "INSERT INTO fixes (request_type, context, command, uses, last_used) VALUES (?, ?, ?, 1, ?)",
+                    (request_type, context, command, now)
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO postings (term, fix_id, count) VALUES (?, ?, ?)",
+                    [(term, fix_id, count) for term, count in tokenize(context).items()]
+                )
+                self.evict(connection, now)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not remember the accepted suggestion: {e}")
+
+    def evict(self, connection, now):
+        stale = [row[0] for row in connection.execute(
+            "SELECT id FROM fixes WHERE last_used < ? OR id NOT IN "
+            "(SELECT id FROM fixes ORDER BY last_used DESC LIMIT ?)", (now - self.max_age, self.max_entries)
+        )]
+        self.remove(connection, stale)
+
+    @staticmethod
+    def remove(connection, fix_ids):
+        connection.executemany("DELETE FROM postings WHERE fix_id = ?", [(fix_id,) for fix_id in fix_ids])
+        connection.executemany("DELETE FROM fixes WHERE id = ?", [(fix_id,) for fix_id in fix_ids])
+
+    def forget(self, command):
+        """
+        Counts a failure of a remembered command, which is forgotten once it failed as often as it was used.
+        """
+        try:
+            with self.connect() as connection:
+                connection.execute("UPDATE fixes SET uses = uses - 1 WHERE command = ?", (command,))
+                failed = [row[0] for row in connection.execute("SELECT id FROM fixes WHERE uses <= 0")]
+                self.remove(connection, failed)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not update the remembered suggestions: {e}")
+
+    def search(self, request_type, context, threshold, limit=2):
+        """
+        :param request_type:
+        :param context: the request's context, prepared the same way as when recording
+        :param threshold: the minimum similarity, between 0 and 1
+        :param limit:
+        :return: list of (command, similarity), the most similar first
+        """
+        query = tokenize(context[:MAX_CONTEXT_LENGTH])
+        if not query:
+            return []
+        terms = [term for term, _ in query.most_common(MAX_QUERY_TERMS)]
+        placeholders = ",".join("?" * len(terms))
+        try:
+            connection = self.connect()
+            candidates = [row[0] for row in connection.execute(
+                f"SELECT fix_id FROM postings JOIN fixes ON fixes.id = postings.fix_id "
+                f"WHERE request_type = ? AND term IN ({placeholders}) "
+                f"GROUP BY fix_id ORDER BY COUNT(*) DESC LIMIT ?", (request_type, *terms, MAX_CANDIDATES)
+            )]
+            if not candidates:
+                return []
+            documents = collections.defaultdict(dict)
+            for fix_id, term, count in connection.execute(
+                    f"SELECT fix_id, term, count FROM postings WHERE fix_id IN ({','.join('?' * len(candidates))})",
+                    candidates
+            ):
+                documents[fix_id][term] = count
+            all_terms = set(terms).union(*(document.keys() for document in documents.values()))
+            document_frequency = self.document_frequency(connection, all_terms)
+            total = connection.execute("SELECT COUNT(*) FROM fixes").fetchone()[0]
+            commands = dict(connection.execute(
+                f"SELECT id, command FROM fixes WHERE id IN ({','.join('?' * len(candidates))})", candidates
+            ).fetchall())
+        except sqlite3.Error as e:
+            logging.warning(f"Could not search the remembered suggestions: {e}")
+            return []
+
+        def weights(counts):
+            vector = {
+                term: (1 + math.log(count)) * (math.log((total + 1) / (document_frequency.get(term, 0) + 1)) + 1)
+                for term, count in counts.items()
+            }
+            norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.
+            return {term: weight / norm for term, weight in vector.items()}
+
+        query_vector = weights({term: query[term] for term in terms})
+        scored = {}
+        for fix_id, document in documents.items():
+            document_vector = weights(document)
+            similarity = sum(weight * document_vector.get(term, 0.) for term, weight in query_vector.items())
+            command = commands.get(fix_id)
+            if similarity >= threshold and command is not None and similarity > scored.get(command, 0.):
+                scored[command] = similarity
+        return sorted(scored.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    @staticmethod
+    def document_frequency(connection, terms):
+        frequency = {}
+        terms = list(terms)
+        # stay under SQLite's limit of the number of parameters
+        for start in range(0, len(terms), 500):
+            chunk = terms[start:start + 500]
+            frequency.update(connection.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE term IN ({','.join('?' * len(chunk))}) GROUP BY term",
+                chunk
+            ).fetchall())
+        return frequency
@@ -0,0 +1,219 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 2
+METRICS_LOGGER = "chat_command.metrics"
+
+
+class RotatingFileHandler(logging.FileHandler):
+    """
+    Keeps the log file under max_bytes by renaming it to .1, .2, ... once it is full.
+    logging.handlers has the same, but importing it costs more than the whole startup budget of chat.
+    """
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super().__init__(path, encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def emit(self, record):
+        try:
+            stat = os.stat(self.baseFilename)
+        except OSError:
+            stat = None
+        if stat is not None and stat.st_size >= self.max_bytes:
+            self.rotate()
+            stat = None
+        if self.stream is not None and (stat is None or os.fstat(self.stream.fileno()).st_ino != stat.st_ino):
+            # another process rotated the file, the daemon would keep writing to the old one otherwise
+            self.stream.close()
+            self.stream = None
+        super().emit(record)
+
+    def rotate(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        try:
+            for number in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.baseFilename}.{number}"):
+                    os.replace(f"{self.baseFilename}.{number}", f"{self.baseFilename}.{number + 1}")
+            os.replace(self.baseFilename, f"{self.baseFilename}.1")
+        except OSError:
+            # rotated by another process at the same time
+            pass
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Hands the records over to a thread that writes them, so that logging never waits for the disk
+    (the same as a QueueHandler with a QueueListener). The remaining records are written when logging shuts down.
+    """
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.handler.setFormatter(fmt)
+
+    def emit(self, record):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write_records, daemon=True)
+            self.thread.start()
+        self.queue.put(record)
+
+    def write_records(self):
+        while (record := self.queue.get()) is not None:
+            self.handler.handle(record)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.handler.close()
+        super().close()
+
+
+def setup_logging(path):
+    """
+    Logs into basic.log in CHAT_COMMAND_PATH, the file is only opened once something is written to it.
+    """
+    handler = BackgroundHandler(RotatingFileHandler(os.path.join(path or "", "basic.log")))
+    logging.basicConfig(
+        handlers=[handler], level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+
+def write_metrics(path, record):
+    """
+    Appends the record of an invocation to the metrics file, as a JSON line.
+    """
+    import json
+
+    logger = logging.getLogger(METRICS_LOGGER)
+    if not logger.handlers:
+        logger.addHandler(BackgroundHandler(RotatingFileHandler(path)))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    logger.info(json.dumps(record))
+
+
+class Span:
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.phase, time.perf_counter() - self.start)
+
+
+class Timings:
+    """
+    The durations of the phases of one invocation of chat, and of every request it made.
+    The phases before the first request (startup, config, history_load) belong to the invocation,
+    the later ones (prompt, lookup, ttfb, network, parse, think) to the current request.
+    """
+    def __init__(self):
+        self.created = time.time()
+        self.started_at = None
+        self.phases = {}
+        self.requests = []
+
+    def set_started_at(self, started_at):
+        """
+        :param started_at: epoch seconds when the shell started chat, the time until now is the startup
+        """
+        self.started_at = started_at
+        self.phases["startup"] = max(0., time.time() - started_at) * 1000
+
+    def measure(self, phase):
+        """
+        :return: context manager that adds its duration to the phase
+        """
+        return Span(self, phase)
+
+    def current_phases(self):
+        return self.requests[-1]["phases"] if self.requests else self.phases
+
+    def add(self, phase, seconds):
+        phases = self.current_phases()
+        phases[phase] = phases.get(phase, 0.) + seconds * 1000
+
+    def set(self, phase, seconds):
+        self.current_phases()[phase] = seconds * 1000
+
+    def start_request(self, request_type):
+        self.requests.append({"type": request_type, "source": "api", "phases": {}})
+
+    def set_source(self, source):
+        """
+        :param source: where the suggestions of the current request came from: api, cache, rules, learned,
+        prefetch, or error if the request failed
+        """
+        if self.requests:
+            self.requests[-1]["source"] = source
+
+    def add_tier(self, tier, seconds, escalation=None):
+        """
+        :param tier: "local" or "remote", the model that was asked for the current request
+        :param seconds: how long it took to answer
+        :param escalation: why the next tier had to be asked, if it had to
+        """
+        if not self.requests:
+            return
+        record = {"tier": tier, "ms": seconds * 1000}
+        if escalation is not None:
+            record["escalation"] = escalation
+        self.requests[-1].setdefault("tiers", []).append(record)
+
+    def set_escalation(self, escalation):
+        """
+        Marks the answer of the last asked tier as not good enough, after it was shown.
+        """
+        if self.requests and self.requests[-1].get("tiers"):
+            self.requests[-1]["tiers"][-1]["escalation"] = escalation
+
+    def count_usage(self, model, usage):
+        """
+        :param model:
+        :param usage: the usage field of the API response, if there is one
+        """
+        if not self.requests or not usage:
+            return
+        request = self.requests[-1]
+        request["model"] = model
+        for name in ("prompt_tokens", "completion_tokens"):
+            request[name] = request.get(name, 0) + (usage.get(name) or 0)
+
+    def record(self):
+        """
+        :return: the JSON-serializable record of the invocation, in milliseconds.
+        The total is the wall time without the time the user spent choosing.
+        """
+        think = sum(request["phases"].get("think", 0.) for request in self.requests)
+        total = (time.time() - (self.started_at or self.created)) * 1000 - think
+        phases = dict(self.phases, total=total)
+        return {
+            "time": round(self.created, 3),
+            "phases": {phase: round(ms, 2) for phase, ms in phases.items()},
+            "requests": [
+                dict(
+                    request, phases={phase: round(ms, 2) for phase, ms in request["phases"].items()},
+                    **({"tiers": [dict(tier, ms=round(tier["ms"], 2)) for tier in request["tiers"]]}
+                       if "tiers" in request else {})
+                )
+                for request in self.requests
+            ],
+        }
@@ -0,0 +1,34 @@
+import hashlib
+import re
+
+# Parts of command outputs that change between runs of the same failing command.
+# The order matters: timestamps and hashes have to be masked before the plain numbers inside them.
+VOLATILE_PATTERNS = [
+    (re.compile(r'\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2})?(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'), '<time>'),
+    (re.compile(r'\b\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?\b'), '<time>'),
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b', re.IGNORECASE), '<uuid>'),
+    (re.compile(r'\b0x[0-9a-f]+\b', re.IGNORECASE), '<hex>'),
+    # commit and container ids, but not ordinary words made of the letters a-f
+    (re.compile(r'\b(?=[a-f]*\d)[0-9a-f]{7,64}\b'), '<hash>'),
+    (re.compile(r'(?:~|\.{1,2})?(?:/[\w.@%+~-]+)+/?'), '<path>'),
+    (re.compile(r'\d+'), '<n>'),
+]
+
+
+def normalize_command(command):
+    return " ".join(command.split())
+
+
+def mask_volatile(text):
+    for pattern, replacement in VOLATILE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return " ".join(text.split())
+
+
+def fingerprint(text):
+    """
+    Hashes the text with its volatile parts masked, so that reruns of the same failure get the same fingerprint.
+    :param text:
+    :return: hex digest
+    """
+    return hashlib.sha256(mask_volatile(text).encode()).hexdigest()
@@ -0,0 +1,237 @@
+import codecs
+import collections
+import os
+import re
+import sys
+
+# the budget that truncate_output always had
+OUTPUT_BUDGET = 1000
+HEAD_SHARE = 0.3
+ERRORS_SHARE = 0.3
+# at least this much of the budget goes to the end of the output, where the final error usually is
+MIN_TAIL_SHARE = 0.3
+READ_CHUNK_SIZE = 64 * 1024
+
+ANSI_PATTERN = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]')
+OVERSTRIKE_PATTERN = re.compile(r'[^\x08]\x08')
+ERROR_PATTERN = re.compile(
+    r'error|fatal|fail|exception|traceback|panic|abort|denied|refused|not found|no such|cannot|can\'t|'
+    r'unable|undefined|invalid|missing|unknown|segmentation fault|warning',
+    re.IGNORECASE
+)
+
+
+def clean_line(line):
+    """
+    Removes the terminal formatting from a line: colors, overstrikes (like `col -b`)
+    and everything but the final state of a progress bar that was redrawn with carriage returns.
+    """
+    line = ANSI_PATTERN.sub('', line)
+    if '\r' in line:
+        line = line.rstrip('\r').rsplit('\r', 1)[-1]
+    while '\x08' in line:
+        reduced = OVERSTRIKE_PATTERN.sub('', line)
+        # the remaining backspaces are at the start of the line
+        line = reduced if reduced != line else line.replace('\x08', '')
+    return line.rstrip()
+
+
+class OutputReducer:
+    """
+    Reduces a command's output to a fixed budget of characters while it is being read, with bounded memory.
+    Keeps the beginning and the end of the output, and in between the lines that look like errors.
+    Repeated lines are collapsed into one.
+    """
+    def __init__(self, budget=OUTPUT_BUDGET):
+        self.budget = budget
+        self.head_budget = int(budget * HEAD_SHARE)
+        self.errors_budget = int(budget * ERRORS_SHARE)
+        self.line_limit = budget // 2
+
+        self.partial = ""
+        # the characters of the partial line that were dropped already
+        self.partial_omitted = 0
+        self.line_count = 0
+        self.previous_line = None
+        self.repeats = 0
+
+        # (line number, text)
+        self.head = []
+        self.head_size = 0
+        self.errors = []
+        self.errors_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+
+    def feed(self, text):
+        self.partial += text
+        lines = self.partial.split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.feed_line(line, self.partial_omitted)
+            self.partial_omitted = 0
+        if len(self.partial) > 4 * self.budget:
+            # a huge line without a newline, only its beginning is of any use
+            self.partial_omitted += len(self.partial) - self.line_limit
+            self.partial = self.partial[:self.line_limit]
+
+    def feed_line(self, line, omitted=0):
+        """
+        :param line:
+        :param omitted: how many characters at the end of the line were dropped before
+        """
+        line = clean_line(line)
+        if line == self.previous_line and not omitted:
+            self.repeats += 1
+            return
+        self.flush_repeats()
+        self.previous_line = line
+        omitted += max(len(line) - self.line_limit, 0)
+        if omitted:
+            line = f"{line[:self.line_limit]} ... {omitted} characters omitted ..."
+        self.add_line(line)
+
+    def flush_repeats(self):
+        if self.repeats:
+            self.add_line(f"[previous line repeated {self.repeats} more times]")
+            self.repeats = 0
+
+    def add_line(self, line):
+        entry = (self.line_count, line)
+        self.line_count += 1
+        size = len(line) + 1
+        if self.head_size + size <= self.head_budget and len(self.head) == self.line_count - 1:
+            self.head.append(entry)
+            self.head_size += size
+            return
+
+        self.tail.append(entry)
+        self.tail_size += size
+        while self.tail_size > self.budget - self.head_size and len(self.tail) > 1:
+            evicted = self.tail.popleft()
+            self.tail_size -= len(evicted[1]) + 1
+            self.keep_if_error(evicted)
+
+    def keep_if_error(self, entry):
+        size = len(entry[1]) + 1
+        if ERROR_PATTERN.search(entry[1]) and self.errors_size + size <= self.errors_budget:
+            self.errors.append(entry)
+            self.errors_size += size
+
+    def result(self):
+        if self.partial:
+            self.feed_line(self.partial, self.partial_omitted)
+            self.partial = ""
+            self.partial_omitted = 0
+        self.flush_repeats()
+
+        # the errors take the place of the oldest lines at the end, the first errors are the most useful
+        tail = list(self.tail)
+        errors = list(self.errors)
+        min_tail = int(self.budget * MIN_TAIL_SHARE)
+
+        def size(entries):
+            return sum(len(line) + 1 for _, line in entries)
+
+        while size(self.head) + size(errors) + size(tail) > self.budget and len(tail) > 1:
+            if size(tail[1:]) < min_tail and errors:
+                errors.pop()
+            else:
+                tail.pop(0)
+
+        lines = []
+        expected = 0
+        for number, line in self.head + errors + list(tail):
+            if number > expected:
+                lines.append("...")
+            lines.append(line)
+            expected = number + 1
+        if expected < self.line_count:
+            lines.append("...")
+        return "\n".join(lines)
+
+
+def reduce_text(text, budget=OUTPUT_BUDGET):
+    reducer = OutputReducer(budget)
+    reducer.feed(text)
+    return reducer.result()
+
+
+def reduce_file(path, budget=OUTPUT_BUDGET):
+    """
+    Reads the output from a file in chunks, so that even huge outputs take little memory.
+    :param path:
+    :param budget:
+    :return: the reduced output, or an empty string if the file does not exist
+    """
+    reducer = OutputReducer(budget)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    try:
+        with open(path, 'rb') as file:
+            while chunk := file.read(READ_CHUNK_SIZE):
+                reducer.feed(decoder.decode(chunk))
+    except OSError:
+        return ""
+    reducer.feed(decoder.decode(b'', final=True))
+    return reducer.result()
+
+
+def capture(path, max_bytes, source=0):
+    """
+    Copies the output of a rerun command from the descriptor to the file as it comes, so that nothing is lost
+    when the command is stopped, and stops reading after max_bytes, which ends a command that keeps writing.
+    Then the note "PATH.note" tells the shell why, without it having to measure the file.
+    The budget is applied later, by reduce_file.
+    :param path:
+    :param max_bytes:
+    :param source: the descriptor of the output, stdin by default
+    """
+    remaining = max_bytes
+    with open(path, 'wb', buffering=0) as file:
+        while remaining > 0 and (chunk := os.read(source, min(READ_CHUNK_SIZE, remaining))):
+            file.write(chunk)
+            remaining -= len(chunk)
+    if remaining <= 0:
+        with open(path + ".note", 'w') as file:
+            file.write(f"stopped after {max_bytes} bytes of output\n")
+
+
+def record(path, max_bytes, source=0):
+    """
+    Appends the output of a recorded command to the file as it comes, but the file never grows
+    past twice max_bytes: then only its last max_bytes are kept.
+    The stdout and the stderr of the command are recorded into the same file by two of these,
+    so every write to it is done under a lock.
+    :param path:
+    :param max_bytes:
+    :param source: the descriptor of the output, stdin by default
+    """
+    import fcntl
+    import signal
+
+    # Ctrl-C is for the command, its output is recorded until it ends
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    descriptor = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        while chunk := os.read(source, READ_CHUNK_SIZE):
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            try:
+                os.write(descriptor, chunk)
+                size = os.fstat(descriptor).st_size
+                if size > 2 * max_bytes:
+                    end = os.pread(descriptor, max_bytes, size - max_bytes)
+                    os.ftruncate(descriptor, 0)
+                    os.write(descriptor, end)
+            finally:
+                fcntl.flock(descriptor, fcntl.LOCK_UN)
+    finally:
+        os.close(descriptor)
+
+
+if __name__ == "__main__":
+    # used by the shell as `command | python output_reducer.py FILE MAX_BYTES` to rerun a command,
+    # and with --record before them to record one
+    if sys.argv[1] == "--record":
+        record(sys.argv[2], int(sys.argv[3]))
+    else:
+        capture(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import stat
+
+
+class PathIndex:
+    """
+    The names of the executables in the PATH directories.
+    Listing the directories is kept in a file, and a directory is listed again only when its mtime changes,
+    which happens whenever a program is installed into it or removed from it.
+    """
+    def __init__(self, cache_file_path, path=None):
+        """
+        :param cache_file_path: where the listings of the directories are kept
+        :param path: the PATH to index, the one of the environment by default
+        """
+        self.cache_file_path = cache_file_path
+        self.path = os.environ.get("PATH", "") if path is None else path
+        self.names = None
+
+    def directories(self):
+        """
+        :return: the PATH directories, without the duplicates and the relative ones, in their order
+        """
+        directories = []
+        for directory in self.path.split(os.pathsep):
+            if os.path.isabs(directory) and directory not in directories:
+                directories.append(directory)
+        return directories
+
+    def executables(self):
+        """
+        :return: set of the names of all the executables that can be run without their path
+        """
+        if self.names is not None:
+            return self.names
+        cached = self.load()
+        listings = {}
+        changed = False
+        for directory in self.directories():
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            listing = cached.get(directory)
+            if listing is None or listing["mtime"] != mtime:
+                listing = {"mtime": mtime, "names": self.list_executables(directory)}
+                changed = True
+            listings[directory] = listing
+        if changed or len(listings) != len(cached):
+            self.save(listings)
+        self.names = {name for listing in listings.values() for name in listing["names"]}
+        return self.names
+
+    def __contains__(self, name):
+        return name in self.executables()
+
+    @staticmethod
+    def list_executables(directory):
+        names = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        # follows the symlinks, most of the executables in /usr/bin are ones
+                        mode = entry.stat().st_mode
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(mode) and mode & 0o111:
+                        names.append(entry.name)
+        except OSError:
+            pass
+        return sorted(names)
+
+    def load(self):
+        try:
+            with open(self.cache_file_path, encoding='utf-8') as file:
+                cached = json.load(file)
+            return cached if isinstance(cached, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, listings):
+        # written to a temporary file first, so that a concurrent reader never sees half of it
+        temporary_path = f"{self.cache_file_path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                json.dump(listings, file)
+            os.replace(temporary_path, self.cache_file_path)
+        except OSError as e:
+            logging.warning(f"Could not save the index of the PATH executables: {e}")
@@ -0,0 +1,114 @@
+import fcntl
+import json
+import logging
+import os
+import time
+
+POLL_INTERVAL = 0.05
+
+
+class Prefetch:
+    """
+    The suggestions for a failed command, requested in the background before the user asks for them.
+    The file holds the key of the request and the pid of the process that sends it,
+    and then the suggestions once they arrive. They are only used for the very same request, and only once.
+    """
+    def __init__(self, path, rate_file_path, per_minute):
+        """
+        :param path: where the prefetched suggestions of this conversation are kept
+        :param rate_file_path: where the start times of the recent prefetches are kept
+        :param per_minute: the maximum number of prefetches started in a minute, across all shells
+        """
+        self.path = path
+        self.rate_file_path = rate_file_path
+        self.per_minute = per_minute
+
+    def acquire(self):
+        """
+        Counts a new prefetch against the rate limit.
+        :return: whether the prefetch may be sent
+        """
+        now = time.time()
+        try:
+            with open(self.rate_file_path, 'a+') as file:
+                # a burst of failures starts several prefetches at once
+                fcntl.flock(file, fcntl.LOCK_EX)
+                file.seek(0)
+                try:
+                    started = [t for t in json.loads(file.read() or "[]") if now - t < 60]
+                except ValueError:
+                    started = []
+                if len(started) >= self.per_minute:
+                    return False
+                started.append(now)
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(started))
+        except OSError as e:
+            logging.warning(f"Could not check the prefetch rate limit: {e}")
+            return False
+        return True
+
+    def start(self, key):
+        self.write({"key": key, "pid": os.getpid()})
+
+    def finish(self, key, suggestions):
+        record = self.read()
+        # the file is removed when the prefetch is cancelled
+        if record is None or record.get("pid") != os.getpid():
+            logging.info("The prefetch was cancelled")
+            return
+        self.write({"key": key, "suggestions": suggestions})
+
+    def take(self, key, timeout):
+        """
+        Waits for the prefetch of this request if it is still running.
+        :param key:
+        :param timeout: seconds to wait for a running prefetch
+        :return: list of suggestions, or None if there is nothing ready for this request
+        """
+        deadline = time.monotonic() + timeout
+        record = self.read()
+        if record is not None and record["key"] == key and "suggestions" not in record:
+            print("⏳ Waiting for the suggestions requested in the background...")
+            while "suggestions" not in record and is_alive(record["pid"]) and time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL)
+                record = self.read()
+                if record is None or record["key"] != key:
+                    break
+        self.discard()
+        if record is None or record["key"] != key:
+            return None
+        return record.get("suggestions")
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, record):
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, 'w') as file:
+                json.dump(record, file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save the prefetched suggestions: {e}")
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -1,22 +1,70 @@
-import os.path
-import pickle
+import argparse
+import os
+import sqlite3
+import sys
+import time
 
-from chat_command import ChatCommand
+from config import BOLD, RESET, HISTORY_DIR_NAME, HISTORY_INDEX_FILE_NAME
+from history_store import ConversationStore
 
 
 def make_bold(text):
     return f'\033[1m{text}\033[0m'
 
 
-chat = ChatCommand('', '')
+def print_conversation(history_dir, conv_id):
+    messages = ConversationStore(history_dir).load(conv_id) if conv_id else []
+    if not messages:
+        print("No chat history found.")
+        return
 
-if not os.path.exists(chat.config.history_file_path):
-    print("No chat history found.")
-    exit()
-
-with open(chat.config.history_file_path, 'rb') as file:
-    messages = pickle.load(file)
     for message in messages:
         print(make_bold(message['role'] + ':'))
         print(message['content'])
         print()
+
+
+def print_search_results(path, history_dir, query, limit):
+    from history_index import HistoryIndex
+
+    try:
+        results = HistoryIndex(os.path.join(path, HISTORY_INDEX_FILE_NAME), history_dir).search(query, limit)
+    except sqlite3.Error as e:
+        print(f"❌ Could not search the conversations: {e}")
+        sys.exit(1)
+    if not results:
+        print(f"No messages match \"{query}\".")
+        return
+
+    print(f"🔎 {BOLD}{len(results)} best matches for \"{query}\"{RESET} (chatHistory --conversation ID shows one)\n")
+    for number, result in enumerate(results, start=1):
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(result["time"]))
+        print(f"{number}. {when}, conversation {result['conv_id']}, {result['role']}:")
+        print("   " + " ".join(result["snippet"].split()))
+        if result["accepted"]:
+            print(f"   ✅ executed: {result['accepted']}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="chatHistory", description="Show the current conversation, or search all the past ones."
+    )
+    parser.add_argument("-s", "--search", metavar="WORDS", help="Find the messages with these words, best first")
+    parser.add_argument("--limit", type=int, default=10, help="The maximum number of search results. Defaults to 10")
+    parser.add_argument("--conversation", metavar="ID", help="Show this conversation instead of the current one")
+    args = parser.parse_args()
+
+    path = os.getenv("CHAT_COMMAND_PATH")
+    if not path:
+        print("❌ CHAT_COMMAND_PATH environment variable is not set.")
+        sys.exit(1)
+    history_dir = os.path.join(path, HISTORY_DIR_NAME)
+    if args.search is not None:
+        print_search_results(path, history_dir, args.search, args.limit)
+    else:
+        print_conversation(history_dir, args.conversation or os.getenv("CHAT_COMMAND_CONV_ID"))
+
+
+if __name__ == "__main__":
+    main()
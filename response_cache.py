@@ -0,0 +1,65 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+
+class ResponseCache:
+    """
+    Persistent cache of the suggestions for the first request in a conversation.
+    Entries expire after the TTL, and the least recently used ones are evicted once the cache is full.
+    """
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=1.)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, suggestions TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+        return self.connection
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        :param key:
+        :return: list of suggestions, or None if there is no fresh entry
+        """
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                row = connection.execute(
+                    "SELECT suggestions FROM entries WHERE key = ? AND created > ?", (key, now - self.ttl)
+                ).fetchone()
+                if row is None:
+                    return None
+                connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache lookup failed: {e}")
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, suggestions):
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, suggestions, created, last_used) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(suggestions), now, now)
+                )
+                connection.execute("DELETE FROM entries WHERE created <= ?", (now - self.ttl,))
+                connection.execute(
+                    "DELETE FROM entries WHERE key NOT IN "
+                    "(SELECT key FROM entries ORDER BY last_used DESC LIMIT ?)", (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache update failed: {e}")
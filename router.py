@@ -0,0 +1,194 @@
+import fcntl
+import json
+import logging
+import time
+
+# weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+# consecutive failures after which an endpoint is not used for a while
+FAILURE_THRESHOLD = 3
+MIN_COOLDOWN = 30.
+MAX_COOLDOWN = 600.
+
+
+class Endpoint:
+    def __init__(self, url, model, api_key):
+        self.url = url
+        self.model = model
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    @property
+    def name(self):
+        return f"{self.model} at {self.url}"
+
+
+class Router:
+    """
+    Chooses the endpoint of every request among the configured OpenAI-compatible ones.
+    Every endpoint has an exponentially weighted moving average of its latency and of its error rate,
+    kept in a file so that they outlive the process, and the fastest healthy endpoint goes first.
+    An endpoint that failed several times in a row is skipped (its circuit is open) for a cooldown,
+    after which the next request probes it again. The cooldown doubles every time the probe fails.
+    """
+    def __init__(self, endpoints, state_file_path):
+        """
+        :param endpoints: list of Endpoint, in the order of preference when nothing is known about them
+        :param state_file_path: where the statistics of the endpoints are kept
+        """
+        self.endpoints = endpoints
+        self.state_file_path = state_file_path
+        self.state = None
+
+    def load_state(self):
+        if self.state is None:
+            try:
+                with open(self.state_file_path) as file:
+                    self.state = json.load(file)
+            except (OSError, ValueError):
+                self.state = {}
+        return self.state
+
+    def stats(self, endpoint):
+        return self.load_state().get(endpoint.name, {})
+
+    def order(self):
+        """
+        :return: list of the endpoints in the order they should be tried.
+        The ones whose cooldown is over are probed first, then the healthy ones from the fastest
+        (the ones without any latency yet before the others), and the broken ones last, as a last resort.
+        """
+        if len(self.endpoints) == 1:
+            return self.endpoints
+        now = time.time()
+        probed, healthy, broken = [], [], []
+        for index, endpoint in enumerate(self.endpoints):
+            stats = self.stats(endpoint)
+            open_until = stats.get("open_until")
+            if open_until is None:
+                healthy.append((self.expected_latency(stats), index, endpoint))
+            elif open_until <= now:
+                probed.append((open_until, index, endpoint))
+            else:
+                broken.append((open_until, index, endpoint))
+        ordered = [endpoint for *_, endpoint in sorted(probed) + sorted(healthy) + sorted(broken)]
+        first = self.stats(ordered[0])
+        if first.get("open_until") is not None:
+            logging.info(f"Routing to {ordered[0].name} to probe whether it works again")
+        else:
+            logging.info(f"Routing to {ordered[0].name} (latency {first.get('latency', 0.):.0f} ms, "
+                         f"errors {first.get('errors', 0.):.0%})")
+        return ordered
+
+    def post(self, transport, request_data, stream=False, on_failover=None):
+        """
+        Sends the request to the best endpoint, and fails over to the next ones if it does not work.
+        :param transport: Transport that sends the request
+        :param request_data: the body of the request, its model is set to the one of the endpoint
+        :param stream:
+        :param on_failover: if given, called with the endpoint that failed and the next one
+        :return: the response, with any status that is not a failure of the endpoint itself, and its endpoint
+        :raises TransportError: if the last endpoint did not respond at all
+        """
+        from transport import RETRY_STATUSES, TransportError
+
+        endpoints = self.order()
+        for index, endpoint in enumerate(endpoints):
+            is_last = index == len(endpoints) - 1
+            request_data["model"] = endpoint.model
+            logging.info(f"Asking {endpoint.name} for suggestions.")
+            start = time.monotonic()
+            try:
+                # retrying is only worth it when there is nowhere else to go
+                response = transport.post(
+                    endpoint.url, request_data, endpoint.headers, stream=stream, retries=None if is_last else 0
+                )
+            except TransportError as e:
+                self.record_failure(endpoint)
+                if is_last:
+                    raise
+                failure = str(e)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code == 200:
+                        self.record_success(endpoint, time.monotonic() - start)
+                    return response, endpoint
+                self.record_failure(endpoint)
+                if is_last:
+                    return response, endpoint
+                failure = f"status {response.status_code}"
+
+            logging.warning(f"{endpoint.name} failed ({failure}), failing over to {endpoints[index + 1].name}")
+            if on_failover is not None:
+                on_failover(endpoint, endpoints[index + 1])
+
+    @staticmethod
+    def expected_latency(stats):
+        """
+        :return: the latency, longer the more often the endpoint fails.
+        An endpoint that was never tried comes first, one that never worked after the others.
+        """
+        errors = stats.get("errors", 0.)
+        if "latency" not in stats:
+            return 0. if errors == 0 else float("inf")
+        return stats["latency"] / (1 - min(errors, 0.99))
+
+    def record_success(self, endpoint, latency):
+        """
+        :param endpoint:
+        :param latency: seconds until the response arrived
+        """
+        def update(stats):
+            if stats.get("open_until") is not None:
+                logging.info(f"{endpoint.name} works again, closing its circuit")
+            previous = stats.get("latency")
+            latency_ms = latency * 1000
+            stats["latency"] = latency_ms if previous is None else previous + EWMA_ALPHA * (latency_ms - previous)
+            stats["errors"] = stats.get("errors", 0.) * (1 - EWMA_ALPHA)
+            for key in ("failures", "open_until", "cooldown"):
+                stats.pop(key, None)
+
+        self.update(endpoint, update)
+
+    def record_failure(self, endpoint):
+        def update(stats):
+            stats["errors"] = stats.get("errors", 0.) * (1 - EWMA_ALPHA) + EWMA_ALPHA
+            stats["failures"] = stats.get("failures", 0) + 1
+            if stats.get("open_until") is not None:
+                # the probe failed
+                cooldown = min(MAX_COOLDOWN, stats.get("cooldown", MIN_COOLDOWN) * 2)
+            elif stats["failures"] >= FAILURE_THRESHOLD:
+                cooldown = MIN_COOLDOWN
+            else:
+                return
+            stats["cooldown"] = cooldown
+            stats["open_until"] = time.time() + cooldown
+            logging.warning(f"{endpoint.name} failed {stats['failures']} times in a row, "
+                            f"not using it for {cooldown:.0f} seconds")
+
+        self.update(endpoint, update)
+
+    def update(self, endpoint, update):
+        """
+        Changes the statistics of an endpoint, merged with the ones the other processes saved meanwhile.
+        :param endpoint:
+        :param update: function that modifies the endpoint's statistics dict in place
+        """
+        if len(self.endpoints) == 1:
+            return
+        try:
+            with open(self.state_file_path, 'a+') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                file.seek(0)
+                try:
+                    self.state = json.loads(file.read() or "{}")
+                except ValueError:
+                    self.state = {}
+                update(self.state.setdefault(endpoint.name, {}))
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(self.state))
+        except OSError as e:
+            logging.warning(f"Could not save the statistics of the endpoints: {e}")
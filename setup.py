@@ -1,3 +1,4 @@
+import compileall
 import os
 import shutil
 import re
@@ -33,6 +34,8 @@ def copy_script_contents(chat_command_path):
         return ignored
 
     shutil.copytree(script_dir, chat_command_path, ignore=ignore_some_files, dirs_exist_ok=True)
+    # the bytecode is written next to the installed files, so the first `chat` does not have to compile anything
+    compileall.compile_dir(chat_command_path, maxlevels=0, quiet=1)
 
 
 def check_and_set_api_key():
@@ -0,0 +1,96 @@
+import json
+
+# appended by the model to a command whose output it needs, shared with context_gathering.py
+CONTEXT_MARKER = "# for context"
+
+
+def iter_stream_content(chunks):
+    """
+    Extracts the text deltas from the server-sent events of a streamed chat completion.
+    :param chunks: bytes or strings as they arrive from the network, not necessarily aligned with the events
+    :return: generator of content pieces
+    """
+    buffer = ""
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("utf-8", errors="replace")
+        buffer += chunk
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            line = line.strip()
+            if not line.startswith("data:"):
+                # comments, event names and the empty lines between events
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                return
+            choices = json.loads(payload).get("choices") or []
+            if choices:
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    yield content
+
+
+class SuggestionStream:
+    """
+    Incrementally splits a streamed response into suggestions, giving the same result as clean_suggestions.
+    A line is reported as soon as it is complete and it is known that the next line
+    does not start with "# for context" (in which case the two lines are merged).
+    """
+    def __init__(self, clean_suggestion, on_suggestion):
+        """
+        :param clean_suggestion: cleans a single line, returns None if the line is not a suggestion
+        :param on_suggestion: called with every new suggestion
+        """
+        self.clean_suggestion = clean_suggestion
+        self.on_suggestion = on_suggestion
+        self.buffer = ""
+        # the last complete line, kept until the next line shows whether it has to be merged into it
+        self.pending = None
+        self.suggestions = []
+
+    def feed(self, text):
+        self.buffer += text
+        while True:
+            lines = self.buffer.splitlines(keepends=True)
+            if not lines:
+                break
+            line = lines[0].splitlines()[0]
+            # the line is not complete yet, or its trailing \r may be the first half of \r\n
+            if line == lines[0] or lines[0] == self.buffer and self.buffer.endswith("\r"):
+                break
+            self.buffer = self.buffer[len(lines[0]):]
+            self.complete_line(line)
+
+        if self.pending is not None and self.buffer and not self.may_be_context_marker(self.buffer):
+            self.emit(self.pending)
+            self.pending = None
+
+    def close(self):
+        if self.buffer:
+            self.complete_line(self.buffer.splitlines()[0])
+            self.buffer = ""
+        if self.pending is not None:
+            self.emit(self.pending)
+            self.pending = None
+        return self.suggestions
+
+    def complete_line(self, line):
+        if self.pending is not None and line.startswith(CONTEXT_MARKER):
+            self.emit(self.pending + " " + line)
+            # the merged line is left empty, but a following marker can still be merged into it
+            self.pending = ""
+            return
+        if self.pending is not None:
+            self.emit(self.pending)
+        self.pending = line
+
+    def emit(self, line):
+        suggestion = self.clean_suggestion(line)
+        if suggestion is not None:
+            self.suggestions.append(suggestion)
+            self.on_suggestion(suggestion)
+
+    @staticmethod
+    def may_be_context_marker(partial_line):
+        return CONTEXT_MARKER.startswith(partial_line) or partial_line.startswith(CONTEXT_MARKER)
@@ -0,0 +1,132 @@
+import contextlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# chat_command logs into basic.log of CHAT_COMMAND_PATH unless the logging is set up already
+logging.getLogger().addHandler(logging.NullHandler())
+from chat_command import LOCAL_CONTEXT_REQUESTS, ChatCommand  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from mock_llm_server import MockLLMServer  # noqa: E402
+
+
+class CascadeTest(unittest.TestCase):
+    """
+    The local model is asked first, and the configured one only when the local answer is not good enough.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.servers = []
+        self.remote = self.start_server(reply="echo remote")
+        self.environment = mock.patch.dict(os.environ, {
+            "CHAT_COMMAND_PATH": self.directory.name,
+            "CHAT_COMMAND_CONV_ID": "",
+            "CHAT_COMMAND_LAST_COMMAND": "",
+            "OPENAI_API_KEY": "key",
+            "CHAT_COMMAND_API_URL": self.remote.url,
+            "CHAT_COMMAND_ENDPOINTS": "",
+            "CHAT_COMMAND_STREAM": "0",
+            "CHAT_COMMAND_CANDIDATES": "1",
+            "CHAT_COMMAND_RETRIES": "0",
+            "CHAT_COMMAND_CACHE": "1",
+            "CHAT_COMMAND_RULES": "0",
+            "CHAT_COMMAND_LEARN": "0",
+            "CHAT_COMMAND_PREFETCH": "0",
+            "CHAT_COMMAND_METRICS": "0",
+            "CHAT_COMMAND_ENVIRONMENT_BYTES": "0",
+        })
+        self.environment.start()
+
+    def tearDown(self):
+        self.environment.stop()
+        for server in self.servers:
+            server.stop()
+        self.directory.cleanup()
+
+    def start_server(self, **settings):
+        server = MockLLMServer(**settings).start()
+        self.servers.append(server)
+        return server
+
+    def make_chat(self, local_url):
+        os.environ["CHAT_COMMAND_LOCAL_API_URL"] = local_url
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ChatCommand("make", "make: *** No rule to make target 'all'.", last_status=2)
+
+    def request(self, chat, request_type="fix_command"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            suggestions, _ = chat.request_suggestions(request_type)
+        return suggestions
+
+    def test_good_local_answer_is_used(self):
+        local = self.start_server(reply="ls -la")
+        chat = self.make_chat(local.url)
+        self.assertEqual(self.request(chat), ["ls -la"])
+        self.assertTrue(chat.answered_locally)
+        self.assertEqual((local.requests, self.remote.requests), (1, 0))
+
+    def test_local_answer_is_not_cached_as_the_configured_model_one(self):
+        local = self.start_server(reply="ls -la")
+        self.request(self.make_chat(local.url))
+        self.assertEqual(self.request(self.make_chat(local.url)), ["ls -la"])
+        self.assertEqual(local.requests, 2)
+
+    def assertEscalates(self, local_url):
+        chat = self.make_chat(local_url)
+        self.assertEqual(self.request(chat), ["echo remote"])
+        self.assertTrue(chat.escalated)
+        self.assertFalse(chat.answered_locally)
+        self.assertEqual(self.remote.requests, 1)
+        return chat
+
+    def test_empty_local_answer_escalates(self):
+        self.assertEscalates(self.start_server(reply="").url)
+
+    def test_invalid_local_answer_escalates(self):
+        self.assertEscalates(self.start_server(reply="nosuchprogram-for-the-test --fix").url)
+
+    def test_local_failure_escalates(self):
+        local = self.start_server(fail_every=1)
+        self.assertEscalates(local.url)
+        # the local model is not retried
+        self.assertEqual(local.requests, 1)
+
+    def test_unreachable_local_model_escalates(self):
+        local = self.start_server()
+        url = local.url
+        local.stop()
+        self.servers.remove(local)
+        self.assertEscalates(url)
+
+    def test_escalated_session_stays_with_the_configured_model(self):
+        local = self.start_server(reply="")
+        chat = self.assertEscalates(local.url)
+        self.request(chat, "rejected")
+        self.assertEqual((local.requests, self.remote.requests), (1, 2))
+
+    def test_repeated_context_requests_escalate(self):
+        local = self.start_server(reply="ls # for context")
+        chat = self.make_chat(local.url)
+        for _ in range(LOCAL_CONTEXT_REQUESTS):
+            self.assertEqual(self.request(chat), ["ls # for context"])
+        self.assertEqual(self.request(chat), ["echo remote"])
+        self.assertEqual(local.requests, LOCAL_CONTEXT_REQUESTS + 1)
+
+    def test_rejected_local_answer_escalates(self):
+        local = self.start_server(reply="ls -la")
+        chat = self.make_chat(local.url)
+        self.request(chat)
+        self.assertTrue(chat.escalate_rejected())
+        self.assertEqual(self.request(chat, "rejected"), ["echo remote"])
+        self.assertEqual((local.requests, self.remote.requests), (1, 1))
+        # the configured model's suggestions are not escalated any further
+        self.assertFalse(chat.escalate_rejected())
+
+
+if __name__ == "__main__":
+    unittest.main()
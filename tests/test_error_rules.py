@@ -0,0 +1,31 @@
+import unittest
+
+from error_rules import BUILTIN_RULES, RuleIndex
+
+
+class RuleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = RuleIndex(BUILTIN_RULES)
+
+    def test_missing_program_uses_the_package_the_system_names(self):
+        output = "Command 'convert' not found, but can be installed with:\n\nsudo apt install imagemagick\n"
+        self.assertEqual(self.index.match("convert a.png a.jpg", output), ["sudo apt install imagemagick"])
+
+    def test_missing_program_without_a_package_is_left_to_the_model(self):
+        self.assertEqual(self.index.match("foo", "bash: foo: command not found"), [])
+        self.assertEqual(self.index.match("foo", "zsh: command not found: foo"), [])
+
+    def test_fix_is_not_applied_twice(self):
+        output = "E: Unable to locate package foo"
+        self.assertEqual(self.index.match("sudo apt install foo", output), ["sudo apt update && sudo apt install foo"])
+        self.assertEqual(self.index.match("sudo apt update && sudo apt install foo", output), [])
+
+    def test_script_permission(self):
+        self.assertEqual(
+            self.index.match("./run.sh", "bash: ./run.sh: Permission denied"), ["chmod +x ./run.sh && ./run.sh"]
+        )
+        self.assertEqual(self.index.match("cat /etc/shadow", "cat: /etc/shadow: Permission denied"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
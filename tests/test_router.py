@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import requests
+
+from router import FAILURE_THRESHOLD, MIN_COOLDOWN, Endpoint, Router
+from transport import Transport, TransportError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from mock_llm_server import MockLLMServer  # noqa: E402
+
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.session = requests.Session()
+        self.transport = Transport(self.session, connect_timeout=1, read_timeout=2, retries=1, backoff=0.)
+        self.broken_server = MockLLMServer(fail_every=1).start()
+        self.server = MockLLMServer().start()
+        self.broken = Endpoint(self.broken_server.url, "broken", "key")
+        self.working = Endpoint(self.server.url, "working", "key")
+        self.router = Router([self.broken, self.working], os.path.join(self.directory.name, "router.json"))
+        # the broken endpoint looks faster, so that it is tried first
+        self.router.update(self.broken, lambda stats: stats.update(latency=1.))
+        self.router.update(self.working, lambda stats: stats.update(latency=1000.))
+        self.failovers = []
+
+    def tearDown(self):
+        self.broken_server.stop()
+        self.server.stop()
+        self.session.close()
+        self.directory.cleanup()
+
+    def post(self):
+        return self.router.post(
+            self.transport, {"messages": []}, on_failover=lambda *endpoints: self.failovers.append(endpoints)
+        )
+
+    def test_failover(self):
+        response, endpoint = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(endpoint, self.working)
+        self.assertEqual(self.failovers, [(self.broken, self.working)])
+        # not retried, as there was another endpoint
+        self.assertEqual(self.broken_server.requests, 1)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        for _ in range(FAILURE_THRESHOLD):
+            self.post()
+        stats = self.router.stats(self.broken)
+        self.assertEqual(stats["failures"], FAILURE_THRESHOLD)
+        self.assertGreater(stats["open_until"], time.time() + MIN_COOLDOWN / 2)
+        self.assertEqual(self.router.order(), [self.working, self.broken])
+
+        self.post()
+        self.assertEqual(self.broken_server.requests, FAILURE_THRESHOLD)
+
+    def test_circuit_closes_when_the_probe_works(self):
+        for _ in range(FAILURE_THRESHOLD):
+            self.post()
+        self.router.update(self.broken, lambda stats: stats.update(open_until=time.time() - 1))
+        self.broken_server.fail_every = 0
+
+        response, endpoint = self.post()
+        self.assertIs(endpoint, self.broken)
+        stats = self.router.stats(self.broken)
+        self.assertNotIn("open_until", stats)
+        self.assertNotIn("failures", stats)
+
+    def test_cooldown_doubles_when_the_probe_fails(self):
+        for _ in range(FAILURE_THRESHOLD):
+            self.post()
+        self.router.update(self.broken, lambda stats: stats.update(open_until=time.time() - 1))
+
+        response, endpoint = self.post()
+        self.assertIs(endpoint, self.working)
+        self.assertEqual(self.router.stats(self.broken)["cooldown"], 2 * MIN_COOLDOWN)
+
+    def test_state_is_shared_between_processes(self):
+        self.post()
+        other = Router([self.broken, self.working], self.router.state_file_path)
+        self.assertEqual(other.stats(self.broken)["failures"], 1)
+
+    def test_last_endpoint_failure_is_returned(self):
+        self.server.fail_every = 1
+        response, endpoint = self.post()
+        self.assertEqual(response.status_code, 503)
+        self.assertIs(endpoint, self.working)
+        # only the last endpoint is retried
+        self.assertEqual((self.broken_server.requests, self.server.requests), (1, 2))
+
+    def test_no_endpoint_responds(self):
+        unreachable = [Endpoint(f"http://127.0.0.1:9/{index}", "unreachable", "key") for index in range(2)]
+        router = Router(unreachable, self.router.state_file_path)
+        with self.assertRaises(TransportError):
+            router.post(self.transport, {"messages": []})
+        self.assertEqual([router.stats(endpoint)["failures"] for endpoint in unreachable], [1, 1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import unittest
+
+import requests
+
+from transport import Transport, TransportError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from mock_llm_server import MockLLMServer  # noqa: E402
+
+REQUEST = {"model": "mock", "messages": [{"role": "user", "content": "hi"}]}
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.session = requests.Session()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        self.session.close()
+
+    def start_server(self, **settings):
+        server = MockLLMServer(**settings).start()
+        self.servers.append(server)
+        return server
+
+    def make_transport(self, retries, backoff=0.):
+        return Transport(self.session, connect_timeout=1, read_timeout=2, retries=retries, backoff=backoff)
+
+    def test_failed_attempt_is_retried(self):
+        server = self.start_server(fail_every=2)
+        transport = self.make_transport(retries=2)
+        self.assertEqual(transport.post(server.url, REQUEST, {}).status_code, 200)
+        # the second request fails, the third one is its retry
+        self.assertEqual(transport.post(server.url, REQUEST, {}).status_code, 200)
+        self.assertEqual(server.requests, 3)
+
+    def test_last_failed_attempt_is_returned(self):
+        server = self.start_server(fail_every=1)
+        response = self.make_transport(retries=2).post(server.url, REQUEST, {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests, 3)
+
+    def test_override_of_the_retries(self):
+        server = self.start_server(fail_every=1)
+        self.make_transport(retries=2).post(server.url, REQUEST, {}, retries=0)
+        self.assertEqual(server.requests, 1)
+
+    def test_retry_waits_for_retry_after(self):
+        server = self.start_server(fail_every=1, retry_after="0.5")
+        start = time.monotonic()
+        response = self.make_transport(retries=1).post(server.url, REQUEST, {})
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests, 2)
+
+    def test_non_retryable_status_is_not_retried(self):
+        server = self.start_server(fail_every=1, error_status=400)
+        self.assertEqual(self.make_transport(retries=2).post(server.url, REQUEST, {}).status_code, 400)
+        self.assertEqual(server.requests, 1)
+
+    def test_unreachable_server(self):
+        server = self.start_server()
+        url = server.url
+        server.stop()
+        self.servers.remove(server)
+        with self.assertRaises(TransportError):
+            self.make_transport(retries=1).post(url, REQUEST, {})
+
+    def test_invalid_url_is_not_retried(self):
+        with self.assertRaises(TransportError):
+            self.make_transport(retries=3, backoff=10.).post("http://", REQUEST, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
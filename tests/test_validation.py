@@ -0,0 +1,45 @@
+import unittest
+
+from validation import CommandValidator, command_names
+
+INSTALLED = {"ls", "mkdir", "python", "make", "grep", "git", "sort", "diff", "date", "id", "cat"}
+
+
+class CommandValidatorTest(unittest.TestCase):
+    def setUp(self):
+        # a set answers `in` as the PathIndex does
+        self.validator = CommandValidator(INSTALLED)
+
+    def assertValid(self, command):
+        self.assertIsNone(self.validator.problem(command), command)
+
+    def test_conditional_operands_are_not_programs(self):
+        self.assertValid("[[ -d build ]] || mkdir build")
+        self.assertValid("if [[ -f a && ( -r a ) ]]; then cat a; fi")
+        self.assertEqual(command_names("[[ -d build ]] || mkdir build"), ["mkdir"])
+
+    def test_arithmetic_expansion_is_a_word(self):
+        self.assertValid("echo $((1+2))")
+
+    def test_command_substitution_is_a_word(self):
+        self.assertValid("$(which python) -V")
+        self.assertValid('echo "$(date) (today)" `id -u`')
+        self.assertValid("diff <(ls a) <(sort b)")
+
+    def test_case_patterns_are_not_parentheses(self):
+        self.assertValid("case $x in a) ls;; esac")
+        self.assertValid("for f in *; do echo $f; done")
+
+    def test_missing_program(self):
+        self.assertEqual(self.validator.problem("[[ -d x ]] && nosuchprogram"), "nosuchprogram not found")
+        self.assertEqual(self.validator.problem("sudo -u root nosuchprogram -x"), "nosuchprogram not found")
+
+    def test_invalid_shell(self):
+        self.assertEqual(self.validator.problem("ls ("), "not valid shell: unbalanced parentheses")
+        self.assertEqual(self.validator.problem("echo $(ls"), "not valid shell: unclosed $(")
+        self.assertEqual(self.validator.problem("[[ -d x"), "not valid shell: unclosed [[")
+        self.assertEqual(self.validator.problem("git log |"), "not valid shell: ends with |")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import email.utils
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+MAX_BACKOFF = 30.
+# hedging needs some history to know what a slow request is
+MIN_LATENCY_SAMPLES = 5
+MAX_LATENCY_SAMPLES = 50
+
+
+class TransportError(Exception):
+    pass
+
+
+class Transport:
+    """
+    Sends the API requests over a pooled keep-alive session.
+    Every attempt has connect and read deadlines, failed attempts are retried with jittered backoff,
+    and slow requests can be hedged by sending a duplicate once the first one is slower than usual.
+    """
+    def __init__(self, session, connect_timeout, read_timeout, retries, backoff=0.5,
+                 hedge_percentile=0, latency_file_path=None):
+        """
+        :param session: requests.Session shared between the requests
+        :param connect_timeout: seconds
+        :param read_timeout: seconds without receiving any data
+        :param retries: number of additional attempts after a failed one
+        :param backoff: base delay before the first retry, doubled for every next one
+        :param hedge_percentile: percentile (0-100) of the past latencies after which a duplicate request is sent,
+        0 disables hedging
+        :param latency_file_path: where the past latencies are kept between runs
+        """
+        self.session = session
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.latency_file_path = latency_file_path
+        self.latencies = None
+
+    def post(self, url, json_data, headers, stream=False, retries=None):
+        """
+        :param retries: overrides the number of retries, e.g. when there is another endpoint to fail over to
+        :return: the response, which has a non-retryable status or is the last failed attempt
+        :raises TransportError: if no response could be received, whatever the reason
+        """
+        # a streamed response is already shown while it arrives, so it cannot be raced
+        if self.hedge_percentile and not stream:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is not None:
+                return self.post_hedged(url, json_data, headers, hedge_delay, retries)
+        return self.post_with_retries(url, json_data, headers, stream, retries)
+
+    def post_with_retries(self, url, json_data, headers, stream=False, retries=None):
+        if retries is None:
+            retries = self.retries
+        error = None
+        response = None
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session.post(url, json=json_data, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                response = None
+                retry_after = None
+                logging.warning(f"Request attempt {attempt + 1} failed: {e}")
+            except requests.RequestException as e:
+                # such as an invalid URL or too many redirects, another attempt would fail the same way
+                raise TransportError(f"the request failed: {e}") from e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code == 200 and not stream:
+                        self.record_latency(time.monotonic() - start)
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                logging.warning(f"Request attempt {attempt + 1} failed with status {response.status_code}")
+
+            if attempt < retries:
+                time.sleep(self.backoff_delay(attempt, retry_after))
+
+        if response is not None:
+            return response
+        raise TransportError(f"no response after {retries + 1} attempts: {error}")
+
+    def post_hedged(self, url, json_data, headers, hedge_delay, retries=None):
+        """
+        Sends the request, and if it takes longer than the hedge delay, sends a duplicate.
+        Whichever successful response comes first is used.
+        """
+        results = queue.Queue()
+
+        def attempt():
+            try:
+                results.put(self.post_with_retries(url, json_data, headers, retries=retries))
+            except TransportError as e:
+                results.put(e)
+
+        def start_attempt():
+            # daemon threads, so that the slower request does not delay the exit
+            threading.Thread(target=attempt, daemon=True).start()
+
+        start_attempt()
+        pending = 1
+        try:
+            result = results.get(timeout=hedge_delay)
+            pending -= 1
+        except queue.Empty:
+            logging.info(f"No response after {hedge_delay:.2f}s, sending a hedged request")
+            start_attempt()
+            pending += 1
+            result = results.get()
+            pending -= 1
+
+        # prefer a successful response if the other request is still running
+        while pending and (isinstance(result, TransportError) or result.status_code != 200):
+            result = results.get()
+            pending -= 1
+        if isinstance(result, TransportError):
+            raise result
+        return result
+
+    def backoff_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        if retry_after:
+            delay = max(delay, parse_retry_after(retry_after))
+        return min(delay, MAX_BACKOFF)
+
+    def hedge_delay(self):
+        latencies = sorted(self.load_latencies())
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+        return latencies[index]
+
+    def load_latencies(self):
+        if self.latencies is None:
+            self.latencies = []
+            if self.latency_file_path and os.path.exists(self.latency_file_path):
+                try:
+                    with open(self.latency_file_path) as file:
+                        self.latencies = json.load(file)[-MAX_LATENCY_SAMPLES:]
+                except (OSError, ValueError):
+                    pass
+        return self.latencies
+
+    def record_latency(self, latency):
+        if not self.hedge_percentile:
+            return
+        latencies = self.load_latencies()
+        latencies.append(round(latency, 3))
+        del latencies[:-MAX_LATENCY_SAMPLES]
+        if self.latency_file_path:
+            try:
+                with open(self.latency_file_path, 'w') as file:
+                    json.dump(latencies, file)
+            except OSError as e:
+                logging.warning(f"Could not save the request latencies: {e}")
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, either seconds or an HTTP date
+    :return: seconds to wait
+    """
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.
+    return max(0., retry_at.timestamp() - time.time())
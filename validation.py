@@ -0,0 +1,282 @@
+import shlex
+
+from context_gathering import strip_context_marker
+
+# the builtins and the keywords of bash and zsh, they are not on PATH
+SHELL_BUILTINS = {
+    ".", ":", "[", "alias", "bg", "bind", "break", "builtin", "caller", "cd", "command", "compgen", "complete",
+    "compopt", "continue", "declare", "dirs", "disown", "echo", "enable", "eval", "exec", "exit", "export", "false",
+    "fc", "fg", "getopts", "hash", "help", "history", "jobs", "kill", "let", "local", "logout", "mapfile", "popd",
+    "printf", "pushd", "pwd", "read", "readarray", "readonly", "return", "set", "shift", "shopt", "source",
+    "suspend", "test", "times", "trap", "true", "type", "typeset", "ulimit", "umask", "unalias", "unset", "wait",
+    "autoload", "bindkey", "print", "setopt", "unsetopt", "whence", "where", "which", "zmodload", "zstyle", "rehash",
+    "noglob", "emulate",
+}
+# the words after which the next one is a command
+KEYWORDS = {"if", "then", "else", "elif", "fi", "do", "done", "while", "until", "{", "}", "!", "time"}
+# the words that start the parts that are not commands, such as the loop's values or the case's patterns
+UNCHECKED_KEYWORDS = {"for", "select", "case", "function"}
+# the programs that run another one, and their options that take a value
+WRAPPERS = {
+    "sudo": {"-u", "-g", "-C", "-D", "-h", "-p", "-U", "-r", "-t"},
+    "env": {"-u", "-C", "-S"},
+    "nice": {"-n"},
+    "timeout": {"-s", "-k"},
+    "xargs": {"-I", "-n", "-P", "-d", "-L", "-s", "-a", "-E"},
+    "nohup": set(),
+    "exec": set(),
+    "command": set(),
+    "builtin": set(),
+    "stdbuf": set(),
+    "time": set(),
+    "doas": {"-u", "-C"},
+}
+# the arguments of a wrapper that come before the command it runs
+WRAPPER_POSITIONALS = {"timeout": 1}
+# the words of the commands that install a program, which may be used later in the same command line
+INSTALL_WORDS = {"install", "add"}
+OPERATORS = {"|", "||", "&&", ";", ";;", "&", "|&", "(", ")", "\n"}
+# the substitution that a command substitution, an arithmetic expansion or a process substitution is replaced with
+SUBSTITUTION = "$_"
+
+
+class CommandValidator:
+    """
+    Checks the suggestions before they are shown: they have to be valid shell, and every program they run
+    has to be installed on this host (on PATH, from the cached PathIndex), a shell builtin,
+    or one of the aliases and functions of the user's shell.
+    """
+    def __init__(self, path_index, shell_names=()):
+        """
+        :param path_index: PathIndex of the installed programs
+        :param shell_names: the aliases and functions defined in the user's shell
+        """
+        self.path_index = path_index
+        self.shell_names = set(shell_names)
+
+    def problem(self, suggestion):
+        """
+        :param suggestion:
+        :return: why the suggestion cannot run here, None if it looks fine
+        """
+        command = strip_context_marker(suggestion).split(" # ")[0].strip()
+        try:
+            names = command_names(command)
+        except ValueError as e:
+            return f"not valid shell: {e}"
+        missing = [name for name in names if not self.is_known(name)]
+        if missing:
+            return f"{', '.join(dict.fromkeys(missing))} not found"
+        return None
+
+    def is_known(self, name):
+        return (
+            # a path, a variable or a substitution cannot be checked here
+            "/" in name or "$" in name or "`" in name or
+            name in SHELL_BUILTINS or name in KEYWORDS or name in self.shell_names or
+            name in self.path_index
+        )
+
+
+def command_names(command):
+    """
+    :param command: a command line, with pipelines, lists and compound commands
+    :return: list of the programs it runs, without the ones after a program is installed
+    :raises ValueError: if it is not valid shell
+    """
+    tokens = without_conditionals(tokenize(replace_substitutions(command)))
+    if not tokens:
+        raise ValueError("empty command")
+    if tokens[-1] in ("|", "||", "&&", "|&"):
+        raise ValueError(f"ends with {tokens[-1]}")
+
+    names = []
+    segment = []
+    checked = tokens
+    installed = False
+    for index, token in enumerate(tokens + [";"]):
+        if token not in OPERATORS:
+            segment.append(token)
+            continue
+        words = segment_words(segment)
+        if words is None:
+            # the rest is not checked, its parentheses may be the patterns of a case
+            checked = tokens[:index - len(segment)]
+            break
+        segment = []
+        if words and not installed:
+            names.append(words[0])
+            installed = bool(INSTALL_WORDS.intersection(words[1:]))
+
+    depth = 0
+    for token in checked:
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        if depth < 0:
+            raise ValueError("unbalanced parentheses")
+    if depth != 0:
+        raise ValueError("unbalanced parentheses")
+    return names
+
+
+def replace_substitutions(command):
+    """
+    Replaces every $(...), $((...)), `...`, <(...) and >(...) with a single word, as the programs they run
+    cannot be told apart from their arguments without a full parser.
+    :raises ValueError: if one is not closed
+    """
+    result = []
+    index = 0
+    quote = None
+    while index < len(command):
+        char = command[index]
+        if char == "\\" and quote != "'":
+            result.append(command[index:index + 2])
+            index += 2
+            continue
+        if quote == "'":
+            quote = None if char == "'" else quote
+        elif char in "'\"" and quote is None or char == quote:
+            quote = None if quote else char
+        elif char == "`":
+            end = command.find("`", index + 1)
+            if end < 0:
+                raise ValueError("unclosed `")
+            result.append(SUBSTITUTION)
+            index = end + 1
+            continue
+        elif command[index:index + 2] in ("$(", "<(", ">(") and (char == "$" or quote is None):
+            index = closing_parenthesis(command, index + 1) + 1
+            result.append(SUBSTITUTION)
+            continue
+        result.append(char)
+        index += 1
+    return "".join(result)
+
+
+def closing_parenthesis(command, start):
+    """
+    :param start: the position of an opening parenthesis
+    :return: the position of the one that closes it, skipping the quoted ones
+    :raises ValueError: if there is none
+    """
+    depth = 0
+    quote = None
+    index = start
+    while index < len(command):
+        char = command[index]
+        if char == "\\" and quote != "'":
+            index += 2
+            continue
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return index
+        index += 1
+    raise ValueError("unclosed $(")
+
+
+def without_conditionals(tokens):
+    """
+    :return: the tokens without the [[ ... ]] conditionals, their operands and operators are not commands
+    :raises ValueError: if one is not closed
+    """
+    result = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token == "[[" and (not result or result[-1] in OPERATORS or result[-1] in KEYWORDS):
+            try:
+                index = tokens.index("]]", index) + 1
+            except ValueError:
+                raise ValueError("unclosed [[") from None
+            continue
+        result.append(token)
+        index += 1
+    return result
+
+
+def tokenize(command):
+    """
+    :return: the words, the operators and the redirections of the command line
+    :raises ValueError: if a quote is not closed
+    """
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    tokens = []
+    for token in lexer:
+        if token and set(token) <= set("();|&"):
+            # the adjacent operators come as a single token, such as `);`
+            while token:
+                operator = token[:2] if token[:2] in OPERATORS else token[0]
+                tokens.append(operator)
+                token = token[len(operator):]
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def segment_words(tokens):
+    """
+    :param tokens: the tokens of a simple command
+    :return: its words, starting with the program it runs, None if the rest of the line cannot be checked
+    """
+    words = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.isdigit() and index + 1 < len(tokens) and set(tokens[index + 1]) <= set("<>&"):
+            # the file descriptor of the redirection that follows
+            index += 1
+            continue
+        if set(token) <= set("<>&"):
+            # the target of the redirection
+            index += 2
+            continue
+        words.append(token)
+        index += 1
+
+    position = 0
+    while position < len(words):
+        word = words[position]
+        if word in UNCHECKED_KEYWORDS:
+            return None
+        if word in KEYWORDS or ("=" in word and not word.startswith("=") and word.split("=")[0].isidentifier()):
+            # a keyword, or a variable assignment before the command
+            position += 1
+            continue
+        if word in WRAPPERS and position + 1 < len(words):
+            position = skip_wrapper(words, position)
+            continue
+        break
+    return words[position:]
+
+
+def skip_wrapper(words, position):
+    """
+    :return: the position of the command that the wrapper at the position runs
+    """
+    wrapper = words[position]
+    options = WRAPPERS[wrapper]
+    positionals = WRAPPER_POSITIONALS.get(wrapper, 0)
+    position += 1
+    while position < len(words):
+        word = words[position]
+        if word.startswith("-"):
+            position += 2 if word in options else 1
+        elif wrapper == "env" and "=" in word:
+            position += 1
+        elif positionals:
+            positionals -= 1
+            position += 1
+        else:
+            break
+    return position